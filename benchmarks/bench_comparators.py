@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Benchmark comparing output files in process against running the compare programs.
+
+Compares a number of identical output and truth files with dtest-diff,
+dtest-numerical-diff and cmp, both by running each program with runCmd, as
+dtest did for every file, and with TestComparators.compareInProcess, and
+prints the time per file of each.
+
+Usage: bench_comparators.py [--files N] [--lines N] [--repeat N]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from Dtest import Test
+from Dtest import TestComparators
+
+COMMANDS = ["dtest-diff 0 regexp.lst", "dtest-numerical-diff -a 1e-9", "cmp -s"]
+
+
+def makeFiles(root, files, lines):
+    """Create the output files, their truth files and the filter file, and return the output file names."""
+    names = []
+    for index in range(files):
+        name = "output{}".format(index)
+        content = "".join("step {} position {:.6f} {:.6f}\n".format(i, i * 0.5, index * 0.25) for i in range(lines))
+        for filename in (name, name + ".orig"):
+            with open(os.path.join(root, filename), "w") as f:
+                f.write(content)
+        names.append(name)
+
+    with open(os.path.join(root, "regexp.lst"), "w") as f:
+        f.write("^[0-9]+c[0-9]+$\n")
+    return names
+
+
+def runPrograms(root, cmd, names):
+    """Compare the files by running cmd for each of them, and return the time taken."""
+    start = time.time()
+    for name in names:
+        status, _ = Test.runCmd(cmd, [name + ".orig", name], root, None, log_function=lambda *_: None)
+        assert status, cmd
+    return time.time() - start
+
+
+def compareInProcess(root, cmd, names):
+    """Compare the files in process, and return the time taken."""
+    start = time.time()
+    for name in names:
+        return_code = TestComparators.compareInProcess(cmd, [name + ".orig", name], root, Test.testEnvironment())
+        assert return_code == 0, cmd
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=100, help="number of output files (default: %(default)s)")
+    parser.add_argument("--lines", type=int, default=200, help="number of lines per file (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs (default: %(default)s)")
+    args = parser.parse_args()
+
+    # The compare programs of this tree, as found on the PATH of a test.
+    os.environ["PATH"] = TestComparators.SCRIPTS_DIR + os.pathsep + os.environ.get("PATH", "")
+
+    root = tempfile.mkdtemp()
+    try:
+        names = makeFiles(root, args.files, args.lines)
+        print("{} files of {} lines".format(args.files, args.lines))
+        print("  {:<30} {:>14} {:>14} {:>9}".format("command", "program ms", "in process ms", "speed-up"))
+        for cmd in COMMANDS:
+            program_time = min(runPrograms(root, cmd, names) for _ in range(args.repeat))
+            in_process_time = min(compareInProcess(root, cmd, names) for _ in range(args.repeat))
+            print(
+                "  {:<30} {:>14.3f} {:>14.3f} {:>8.1f}x".format(
+                    cmd,
+                    1000 * program_time / args.files,
+                    1000 * in_process_time / args.files,
+                    program_time / in_process_time,
+                )
+            )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
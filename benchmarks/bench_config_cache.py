@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Benchmark the compiled DTESTDEFS.cfg cache on a synthetic test tree.
+
+Resolves the config of every test in a generated tree three ways: parsing
+every file with configobj (no cache), filling the cache, and loading the
+compiled configs from the cache file written by the previous pass.
+
+Usage: bench_config_cache.py [--groups N] [--tests N] [--repeat N]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from Dtest import Test
+from Dtest import TestConfigCache
+
+CONFIG = """TAGS = group{group}, test{test}
+CHILD_TAGS = bench
+TIMEOUT = 600
+CMP = dtest-diff 0 $ROOTDIR/common/regexp.lst, dtest-diff 1 $ROOTDIR/common/regexp.lst
+DELETE = *.tmp
+
+[ENV]
+BENCH_GROUP = {group}
+BENCH_TEST = {test}
+
+[RESOURCES]
+GPU_MEM = 0
+
+[COMPARE]
+.*[.]png = dtest-perceptual-diff, dtest-perceptual-diff
+.*[.]dat = dtest-numerical-diff, dtest-numerical-diff
+
+[RUN]
+first = python script.py --case 1 >& output1
+second = python script.py --case 2 >& output2
+"""
+
+
+def makeTree(root, groups, tests):
+    """Create the synthetic test tree and return the test directories."""
+    top = os.path.join(root, "test")
+    os.makedirs(top)
+    with open(os.path.join(top, "DTESTDEFS.cfg"), "w") as f:
+        f.write(CONFIG.format(group="top", test="top"))
+
+    test_dirs = []
+    for group in range(groups):
+        group_dir = os.path.join(top, "test_group{}".format(group))
+        os.makedirs(group_dir)
+        with open(os.path.join(group_dir, "DTESTDEFS.cfg"), "w") as f:
+            f.write(CONFIG.format(group=group, test="all"))
+
+        for test in range(tests):
+            test_dir = os.path.join(group_dir, "test_{}".format(test))
+            os.makedirs(test_dir)
+            with open(os.path.join(test_dir, "DTESTDEFS.cfg"), "w") as f:
+                f.write(CONFIG.format(group=group, test=test))
+            test_dirs.append(test_dir)
+
+    return top, test_dirs
+
+
+def resolveAll(test_dirs):
+    """Resolve the configs of all tests from scratch and return the time taken."""
+    Test.resolved_configs.clear()
+    start = time.time()
+    for test_dir in test_dirs:
+        Test.getLocalConfig(Test.getDefaultConfig(test_dir, []), full_dir=test_dir, truth_suffix=[])
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--groups", type=int, default=20, help="number of test groups (default: %(default)s)")
+    parser.add_argument("--tests", type=int, default=50, help="number of tests per group (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs (default: %(default)s)")
+    args = parser.parse_args()
+
+    Test.red = lambda *_: None
+    root = tempfile.mkdtemp()
+    try:
+        top, test_dirs = makeTree(root, args.groups, args.tests)
+        Test.interpolation_data["ROOTDIR"] = top
+
+        Test.compiled_config_cache = None
+        parse_time = min(resolveAll(test_dirs) for _ in range(args.repeat))
+
+        Test.compiled_config_cache = TestConfigCache.ConfigCache()
+        Test.compiled_config_cache.load(top, rebuild=True)
+        fill_time = resolveAll(test_dirs)
+        Test.compiled_config_cache.save()
+
+        cached_times = []
+        for _ in range(args.repeat):
+            start = time.time()
+            Test.compiled_config_cache = TestConfigCache.ConfigCache()
+            Test.compiled_config_cache.load(top)
+            load_time = time.time() - start
+            cached_times.append(load_time + resolveAll(test_dirs))
+        cached_time = min(cached_times)
+
+        print("{} tests ({} config files)".format(len(test_dirs), len(test_dirs) + args.groups + 1))
+        print("  parse every file:     {:8.3f} s".format(parse_time))
+        print("  fill the cache:       {:8.3f} s".format(fill_time))
+        print("  load from the cache:  {:8.3f} s".format(cached_time))
+        print("  speed-up:             {:8.1f}x".format(parse_time / cached_time))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Check the startup of the dtest entry points against a budget.
+
+Imports each module listed in startup_budget.json in a fresh interpreter with
+"python -X importtime" and reports the median cumulative import time and the
+slowest imports. Fails if importing a module loads any of the "lazy" modules,
+which must only be imported where they are used.
+
+Import times in ms vary too much between machines, and with the load of a
+machine, to be checked against a fixed number. With --baseline PYTHONPATH,
+the modules are also imported from another tree, e.g., a checkout of the
+main branch, alternating with the runs of this tree, and the check fails if
+this tree is more than --tolerance slower.
+
+Usage: bench_startup.py [--repeat N] [--top N] [--budget FILE] [--baseline PYTHONPATH [--tolerance F]]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+def importTime(module, pythonpath=None):
+    """Import module in a fresh interpreter, with PYTHONPATH set to pythonpath if it is given.
+
+    Returns the cumulative import time of module in ms, the self times of all
+    imports in ms keyed by name, and the names of all loaded modules.
+    """
+    env = dict(os.environ)
+    if pythonpath is not None:
+        env["PYTHONPATH"] = pythonpath
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import sys, {m}; print(' '.join(sys.modules))".format(m=module),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=env,
+        check=True,
+    )
+
+    total = None
+    self_times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            # Header line
+            continue
+        self_times[name.strip()] = int(self_us) / 1000.0
+        if name.strip() == module:
+            total = int(cumulative_us) / 1000.0
+
+    return total, self_times, set(process.stdout.split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="median of this many runs (default: %(default)s)")
+    parser.add_argument("--top", type=int, default=10, help="show this many of the slowest imports (default: %(default)s)")
+    parser.add_argument(
+        "--budget",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_budget.json"),
+        help="budget file (default: %(default)s)",
+    )
+    parser.add_argument("--baseline", help="PYTHONPATH of the tree to compare the import times with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="fraction by which the modules may be slower than the baseline (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    with open(args.budget) as f:
+        budget = json.load(f)
+
+    failed = False
+    for module in budget["modules"]:
+        runs = []
+        baseline_runs = []
+        for _ in range(args.repeat):
+            runs.append(importTime(module))
+            if args.baseline is not None:
+                baseline_runs.append(importTime(module, args.baseline)[0])
+        total = statistics.median(run[0] for run in runs)
+        _, self_times, loaded = runs[-1]
+
+        if args.baseline is None:
+            print("{}: {:.1f} ms".format(module, total))
+        else:
+            baseline = statistics.median(baseline_runs)
+            slower = total > baseline * (1 + args.tolerance)
+            print(
+                "{}: {:.1f} ms (baseline {:.1f} ms) {}".format(
+                    module, total, baseline, "SLOWER THAN BASELINE" if slower else "ok"
+                )
+            )
+            failed = failed or slower
+        for name, ms in sorted(self_times.items(), key=lambda x: -x[1])[: args.top]:
+            print("    {:8.1f} ms  {}".format(ms, name))
+
+        eager = sorted(loaded.intersection(budget["lazy"]))
+        if eager:
+            print("    imports modules that should be lazy: {}".format(", ".join(eager)))
+        failed = failed or bool(eager)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
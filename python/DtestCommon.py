@@ -11,36 +11,51 @@ import atexit
 import contextlib
 import datetime
 import fnmatch
-import getpass
 import os
-import platform
-import pprint
-import smtplib
 import subprocess
 import sys
+import threading
 import time
-from functools import reduce
 
 # Try to import Pool if it exists
 try:
-    from multiprocessing import Pool, cpu_count, Value, get_context
-    from multiprocessing.context import ForkServerProcess
+    from multiprocessing import Pool, cpu_count, Value, Event
+    from multiprocessing.pool import ThreadPool
 
-    shared_num_active_tests = Value("i", 0)
     failure_count = Value("i", 0)
-except:
-    pass
 
-# Try to import GPUMemUsage if it exists (which is only if we have cuda)
-try:
-    from Dtest.DtestGpuMem_Py import getGPUMemUsage
+    # Set on the first failure with --fail-fast, to cancel the tests that are running. See Test.cancel_event.
+    cancel_event = Event()
 except:
     pass
 
-from Dutils.typing import List, overload, Tuple, Dict, Optional, Any, Union, Generator, Callable, TypeAlias, cast
+from typing import TYPE_CHECKING
+from Dutils.typing import (
+    List,
+    overload,
+    Tuple,
+    Dict,
+    Optional,
+    Any,
+    Set,
+    Union,
+    Generator,
+    Callable,
+    TypeAlias,
+    cast,
+)
 from Dtest import Test
 from Dtest import TestModifiers
 
+# The other Dtest modules serve optional features, so they are only imported
+# by the functions that use them, to keep the startup of dtest fast.
+if TYPE_CHECKING:
+    from Dtest import TestAdmission
+    from Dtest import TestIndex
+
+# Ledger of the resources used by the tests running in the pool. It is created by setupAdmission.
+admission_controller: Optional["TestAdmission.AdmissionController"] = None
+
 if sys.stdout.isatty() and os.getenv("TERM") != "dumb":
     RED = Test.ansi("31m")
     GREEN = Test.ansi("32m")
@@ -91,6 +106,11 @@ def statusOfDisplay():
 
 def email(to_addresses, subject, body):
     """Send an email."""
+    # These are only imported when needed, as they are slow to import.
+    import getpass
+    import platform
+    import smtplib
+
     from_address = "{user}@{host}".format(user=getpass.getuser(), host=platform.node())
 
     message = """From: {from_address}
@@ -192,15 +212,24 @@ def failures(results, root_dir):
         if r[1]:
             failure_data.update(r[2])
 
-    all_lines = []
-    for name, data in failure_data.items():
-        line = os.path.relpath(os.path.join(root_dir, name), os.getcwd())
-        if runTimeError(data):
-            line = red(line)
+    return (failure_data.keys(), failureMessage(failure_data, root_dir))
+
+
+def failureLine(name, data, root_dir):
+    """Return the line listing the failed test name in the failure message."""
+    line = os.path.relpath(os.path.join(root_dir, name), os.getcwd())
+    if runTimeError(data):
+        line = red(line)
+    if data.get("error"):
+        # See ResultCollector.addError and Test.runUnitTest.
+        line += ": " + data["error"]
+    return line
 
-        all_lines.append(line)
 
-    return (failure_data.keys(), "\nFailed test(s):\n{}\n".format(indent("\n".join(all_lines))))
+def failureMessage(failure_data, root_dir):
+    """Return the message listing the failed tests in failure_data."""
+    all_lines = [failureLine(name, data, root_dir) for name, data in failure_data.items()]
+    return "\nFailed test(s):\n{}\n".format(indent("\n".join(all_lines)))
 
 
 class InsaneException(Test.TestException):
@@ -286,9 +315,12 @@ def getTestModifier(args):
     return test_command_modifier
 
 
-def dispatch(dtest_args: Test.DtestArgs, test_command_modifier, full_dir: str):
+def dispatch(dtest_args: Test.DtestArgs, test_command_modifier, full_dir: str, config=None):
     sanityCheck(dtest_args)
 
+    if config is None and dtest_args.from_plan:
+        config = getPlanConfigs(dtest_args.from_plan).get(full_dir)
+
     return Test.dispatchTest(
         full_dir=full_dir,
         common_directory=dtest_args.directory,
@@ -301,9 +333,50 @@ def dispatch(dtest_args: Test.DtestArgs, test_command_modifier, full_dir: str):
         log_num=dtest_args.uuid,
         shell=dtest_args.shell,
         delete_output=dtest_args.delete,
+        config=config,
     )
 
 
+# Loaded execution plans and their configs, keyed by file name. See getPlan.
+loaded_plans: Dict[str, Tuple[Dict[str, Any], Dict[str, Test.ResolvedTestConfig]]] = {}
+
+
+def getPlan(filename: str) -> Dict[str, Any]:
+    """Return the execution plan in filename. Each plan is only loaded once per process."""
+    if filename not in loaded_plans:
+        from Dtest import TestPlan
+
+        plan = TestPlan.loadPlan(filename)
+        loaded_plans[filename] = (plan, TestPlan.planConfigs(plan))
+    return loaded_plans[filename][0]
+
+
+def getPlanConfigs(filename: str) -> Dict[str, Test.ResolvedTestConfig]:
+    """Return the resolved configs of the execution plan in filename, keyed by directory."""
+    getPlan(filename)
+    return loaded_plans[filename][1]
+
+
+# Expected test durations and the predicted makespan of the run, keyed by args uuid. See loadDurations.
+test_durations: Dict[int, Dict[str, float]] = {}
+predicted_makespans: Dict[int, Optional[float]] = {}
+
+
+def loadDurations(args: Test.DtestArgs):
+    """Load the expected test durations for args from the previous run. See TestSchedule."""
+    filename = args.durations or args.data
+    durations: Dict[str, float] = {}
+    if filename and os.path.isfile(filename):
+        try:
+            module_name = Test.getModuleName(args.directory)
+        except Test.TestException:
+            module_name = ""
+        from Dtest import TestSchedule
+
+        durations = TestSchedule.loadDurations(filename, args.directory, module_name)
+    test_durations[args.uuid] = durations
+
+
 def setupEnvAndLogging(args: Test.DtestArgs):
     """Return test dispatcher."""
     Test.interpolation_data["ROOTDIR"] = args.top_test_dir
@@ -316,6 +389,14 @@ def setupEnvAndLogging(args: Test.DtestArgs):
 
     # Set the timeout override value.
     Test.override_timeout = args.timeout
+    Test.compare_jobs = args.compare_jobs
+
+    # Sample the processes of the tests, and with --poll-gpu-memory the GPU memory, see TestMonitor.
+    if args.monitor or args.poll_gpu_memory:
+        from Dtest import TestMonitor
+
+        plugins = [TestMonitor.GpuMemoryPlugin(args.monitor_interval)] if args.poll_gpu_memory else []
+        Test.resource_monitor = TestMonitor.ResourceMonitor(args.monitor_interval, plugins)
 
     # Deprecated. Configuration files should be updated to use regular
     # shell syntax instead. For example, "$YAM_TARGET" instead of
@@ -325,6 +406,9 @@ def setupEnvAndLogging(args: Test.DtestArgs):
         if nval:
             Test.interpolation_data[i] = nval
 
+    # This must be done before the data file of the previous run is removed.
+    loadDurations(args)
+
     Test.logfile.append(None)
     if args.run_tests:
         if args.data and not args.append_data:
@@ -343,87 +427,218 @@ def setupEnvAndLogging(args: Test.DtestArgs):
 
 def outputData(args: Test.DtestArgs, test_results, start_time, module_name):
     """Output test results."""
-    sanityCheck(args)
+    collector = ResultCollector(args, start_time, module_name)
+    for result in test_results:
+        collector.add(result)
+    return collector.finish()
 
-    end_time = datetime.datetime.now()
 
-    success = sum([t[0] for t in test_results])
-    failed = sum([t[1] for t in test_results])
+# Serializes the writes of the result collectors to the regtest data files,
+# which may be shared by the modules of dtest-sbox.
+data_file_lock = threading.Lock()
 
-    extra = " (in {})".format(module_name) if module_name else ""
-    Test.logTee(
-        args.uuid, "SUMMARY: Ran {} tests, {} succeeded, {} failed{}".format(success + failed, success, failed, extra)
-    )
 
-    Test.logTee(args.uuid, "Tests completed in {} seconds".format((end_time - start_time).total_seconds()))
+class ResultCollector(object):
+    """Collects the results of the tests of a module as they finish.
 
-    (failed_test_names, failed_test_message) = failures(test_results, args.directory)
+    Each test record is appended to the regtest data file (args.data) as soon
+    as it is added, so the file is complete up to the last finished test even
+    if dtest is interrupted. Only the counts and the records of the failed
+    tests are kept in memory. finish outputs the summary.
 
-    if failed_test_names:
-        Test.logTee(args.uuid, failed_test_message)
-
-    # close the log file
-    Test.logfile[args.uuid].close()
+    Parameters
+    ----------
+    args : Test.DtestArgs
+        Args for the tests.
+    start_time : datetime.datetime
+        Start time of the tests.
+    module_name : str
+        Name of the module being tested.
+    report_failures : bool
+        If True, each failed test is reported as soon as it is added, e.g., when
+        the test output of the parallel jobs is only shown in short.
+    """
 
-    test_data = {}
-    for res in test_results:
-        test_data.update(res[2])
+    def __init__(self, args: Test.DtestArgs, start_time, module_name: str, report_failures: bool = False):
+        self.args = args
+        self.start_time = start_time
+        self.module_name = module_name
+        self.report_failures = report_failures
+        self.success = 0
+        self.failed = 0
+        self.failure_data: Dict[str, Dict[str, Any]] = {}
+        # The tests that were cancelled by --fail-fast, which count as neither succeeded nor failed.
+        self.cancelled: List[str] = []
+        # The number of errors added with addError.
+        self.errors = 0
+        # The time of the phases of the tests, with --timing-report.
+        self.timing = None
+        if args.timing_report:
+            from Dtest import TestTiming
+
+            self.timing = TestTiming.TimingReport(args.timing_report_count)
+        self._data_started = False
+
+    def add(self, result: Optional[Tuple[int, int, Dict[str, Dict[str, Any]]]]):
+        """Add the result of a test, as returned by dispatch."""
+        if result is None:
+            return
+
+        success, failed, test_data = result
+        self.success += success
+        self.failed += failed
+
+        if failed:
+            self.failure_data.update(test_data)
+            if self.report_failures:
+                for name, data in test_data.items():
+                    Test.logTee(self.args.uuid, "FAILED: " + failureLine(name, data, self.args.directory))
+
+        for name, data in test_data.items():
+            if self.timing is not None:
+                self.timing.add(name, data.get("phases", {}))
+            if data.get("cancelled"):
+                self.cancelled.append(name)
+                if self.report_failures:
+                    Test.logTee(self.args.uuid, "CANCELLED: " + failureLine(name, data, self.args.directory))
+
+        if self.args.data and test_data:
+            self._writeData(test_data)
+
+    def addError(self, error: Exception):
+        """Add a failure that is not the result of a test, e.g., an error while discovering the tests.
+
+        It is recorded as a failed test named "error-N", with the message in its "error" entry, so the
+        summary and the regtest data agree with the exit code.
+        """
+        self.errors += 1
+        name = "error-{}".format(self.errors)
+        message = "{}: {}".format(type(error).__name__, error)
+        self.add(
+            (
+                0,
+                1,
+                {
+                    name: {
+                        "sub_tests": {},
+                        "sub_cmps": {},
+                        "success": 0,
+                        "failed": 1,
+                        "timed_out": 0,
+                        "run": (0, 0),
+                        "cmp": (0, 0),
+                        "elapsed_time": 0.0,
+                        "error": message,
+                    }
+                },
+            )
+        )
 
-    if args.data and test_data:
-        with open(args.data, "a" if args.append_data else "w") as data_file:
-            # Get the end time (approx)
-            newdata = {
-                module_name: {
-                    "root_dir": args.directory,
-                    "top_test_dir": args.top_test_dir,
-                    "tests": test_data,
-                    "display": statusOfDisplay(),
-                    "start_time": start_time,
-                    "end_time": end_time,
-                }
-            }
+    def _writeData(self, test_data: Dict[str, Dict[str, Any]]):
+        """Append test_data to the regtest data file."""
+        import pprint
 
-            data_file.write(
-                """
+        module = repr(self.module_name)
+        text = ""
+        if not self._data_started:
+            # The first record replaces the data of a previous run of this module in the file.
+            text += """
 import datetime
 try:
     regdata
 except:
-    regdata = {}
-""".lstrip()
-            )
+    regdata = {{}}
 
-            data_file.write(
-                """
-newdata = {new_data}
+regdata[{module}] = {header}
+""".format(
+                module=module,
+                header=pprint.pformat(
+                    {
+                        "root_dir": self.args.directory,
+                        "top_test_dir": self.args.top_test_dir,
+                        "tests": {},
+                        "display": statusOfDisplay(),
+                        "start_time": self.start_time,
+                        "end_time": self.start_time,
+                    }
+                ),
+            ).lstrip()
+            self._data_started = True
 
-if len(newdata['{module_name}']['tests']) > 0:
-    regdata.update(newdata)
+        # Get the end time (approx)
+        text += """
+regdata[{module}]["tests"].update({test_data})
+regdata[{module}]["end_time"] = {end_time!r}
 """.format(
-                    new_data=pprint.pformat(newdata), module_name=module_name
-                ).lstrip()
-            )
+            module=module, test_data=pprint.pformat(test_data), end_time=datetime.datetime.now()
+        )
+
+        with data_file_lock:
+            with open(self.args.data, "a") as data_file:
+                data_file.write(text)
+
+    def finish(self) -> int:
+        """Output the summary, and return the exit code of the tests."""
+        args = self.args
+        sanityCheck(args)
 
-    if args.email_on_failure and failed:
-        email_addresses = Test.getListFromConfig(
-            Test.getLocalConfig(None, args.top_test_dir, args.truth_suffix), "EMAIL"
+        end_time = datetime.datetime.now()
+
+        extra = " (in {})".format(self.module_name) if self.module_name else ""
+        if self.cancelled:
+            extra = ", {} cancelled{}".format(len(self.cancelled), extra)
+        Test.logTee(
+            args.uuid,
+            "SUMMARY: Ran {} tests, {} succeeded, {} failed{}".format(
+                self.success + self.failed, self.success, self.failed, extra
+            ),
         )
 
-        if email_addresses:
-            email(
-                to_addresses=email_addresses,
-                subject=("[dtest] Test(s) failed in " '"{}"'.format(module_name)),
-                body="\n\n\n".join(
-                    [
-                        failed_test_message.strip(),
-                        "Directory:\n" + indent(args.top_test_dir),
-                        "Details:\n"
-                        + indent(pprint.pformat({k: v for k, v in test_data.items() if k in failed_test_names})),
-                    ]
+        Test.logTee(args.uuid, "Tests completed in {} seconds".format((end_time - self.start_time).total_seconds()))
+
+        if predicted_makespans.get(args.uuid) is not None:
+            Test.logTee(
+                args.uuid,
+                "Predicted makespan {:.1f} seconds, actual {:.1f} seconds".format(
+                    predicted_makespans[args.uuid], (end_time - self.start_time).total_seconds()
                 ),
             )
 
-    return 0 if not failed else 2
+        failed_test_message = failureMessage(self.failure_data, args.directory)
+        if self.failure_data:
+            Test.logTee(args.uuid, failed_test_message)
+        if self.cancelled:
+            cancelled_lines = [
+                os.path.relpath(os.path.join(args.directory, name), os.getcwd()) for name in self.cancelled
+            ]
+            Test.logTee(args.uuid, "Cancelled test(s):\n{}\n".format(indent("\n".join(cancelled_lines))))
+        if self.timing is not None:
+            Test.logTee(args.uuid, "\n".join(self.timing.lines()))
+
+        # close the log file
+        Test.logfile[args.uuid].close()
+
+        if args.email_on_failure and self.failed:
+            import pprint
+
+            email_addresses = Test.getListFromConfig(
+                Test.getLocalConfig(None, args.top_test_dir, args.truth_suffix), "EMAIL"
+            )
+
+            if email_addresses:
+                email(
+                    to_addresses=email_addresses,
+                    subject=("[dtest] Test(s) failed in " '"{}"'.format(self.module_name)),
+                    body="\n\n\n".join(
+                        [
+                            failed_test_message.strip(),
+                            "Directory:\n" + indent(args.top_test_dir),
+                            "Details:\n" + indent(pprint.pformat(self.failure_data)),
+                        ]
+                    ),
+                )
+
+        return 0 if not self.failed else 2
 
 
 NestedStringList: TypeAlias = List[Union[str, "NestedStringList"]]
@@ -438,8 +653,176 @@ def flattenNestedStringList(ns: NestedStringList) -> Generator[str, None, None]:
             yield val
 
 
-def generateTestList(args: Test.DtestArgs, parallel_mode: bool = False) -> NestedStringList:
-    """Return list of tests."""
+def baseTestPaths(args: Test.DtestArgs) -> List[str]:
+    """Return the directories test discovery starts from."""
+    if args.paths:
+        return [os.path.realpath(d) for d in args.paths]
+    return [args.directory]
+
+
+def setupConfigCache(args: Test.DtestArgs):
+    """Load the compiled config cache of the test tree of args."""
+    if Test.compiled_config_cache is None:
+        from Dtest import TestConfigCache
+
+        Test.compiled_config_cache = TestConfigCache.ConfigCache()
+
+    try:
+        top_test_dir = args.top_test_dir
+    except Test.TestException:
+        return
+
+    Test.compiled_config_cache.load(top_test_dir, rebuild=args.rebuild_config_cache)
+
+
+def compileTestConfigs(args: Test.DtestArgs, test_list: NestedStringList, done: Optional[Set[str]] = None):
+    """Make sure the compiled config cache covers the discovered tests.
+
+    The discovery index lets findTests skip the config files, so compile the
+    configs of the tests and their parent directories here. This only parses
+    files that are not in the cache yet. Directories in done are skipped, and
+    the directories visited here are added to it.
+    """
+    if done is None:
+        done = set()
+    for test_dir in flattenNestedStringList(test_list):
+        path = test_dir
+        while path not in done and path.startswith(args.top_test_dir):
+            done.add(path)
+            config_path = Test.getConfigPath(path)
+            if config_path is not None:
+                Test.loadCompiledConfig(config_path, path)
+            path = os.path.dirname(path)
+
+
+def primeConfigCache(args: Test.DtestArgs):
+    """Resolve the configs of the base test directories and their parents.
+
+    Pool workers are forked from this process, so calling this before the
+    pool is created means the workers start out with these configs (and the
+    compiled config cache) already loaded. Only these base configs are
+    shared: the pool is created before the tests are discovered (with
+    '--stream' the tests are even handed to it during the walk, and
+    dtest-sbox uses one pool for all modules), so each worker resolves the
+    configs of the tests it runs itself. Their parents are among the shared
+    configs, and each worker memoizes what it resolves.
+    """
+    if args.from_plan:
+        # The configs come from the plan instead.
+        getPlanConfigs(args.from_plan)
+        return
+
+    setupConfigCache(args)
+
+    for path in baseTestPaths(args):
+        try:
+            Test.getLocalConfig(
+                Test.getDefaultConfig(path, args.truth_suffix), full_dir=path, truth_suffix=args.truth_suffix
+            )
+        except Exception:
+            # Errors are reported when the tests are discovered.
+            pass
+
+
+# Discovery indexes keyed by the top test directory. See getDiscoveryIndex.
+discovery_indexes: Dict[str, "TestIndex.DiscoveryIndex"] = {}
+
+
+def getDiscoveryIndex(args: Test.DtestArgs) -> Optional["TestIndex.DiscoveryIndex"]:
+    """Return the discovery index of the test tree, or None if it is not used.
+
+    The index is shared by all calls with the same top test directory, so entries
+    prefetched by prefetchDiscovery are reused when the tests are discovered.
+    """
+    if not args.discovery_index:
+        return None
+
+    if args.top_test_dir not in discovery_indexes:
+        # A missing or corrupt index file is ignored by DiscoveryIndex.load, and
+        # errors in the test tree are raised by the walk, as without the index.
+        from Dtest import TestIndex
+
+        discovery_indexes[args.top_test_dir] = TestIndex.DiscoveryIndex(args.top_test_dir, args.truth_suffix)
+
+    return discovery_indexes[args.top_test_dir]
+
+
+def prefetchDiscovery(args_list: List[Test.DtestArgs]):
+    """Walk the test trees of several dtest invocations concurrently.
+
+    This is used by dtest-sbox to walk the test trees of all modules at once,
+    instead of one module at a time. The discovered tests are unchanged.
+    """
+    trees = []
+    max_workers = 0
+    for args in args_list:
+        index = getDiscoveryIndex(args)
+        if index is not None and args.discovery_threads > 1:
+            trees.append((index, baseTestPaths(args)))
+            max_workers = max(max_workers, args.discovery_threads)
+
+    if trees:
+        from Dtest import TestIndex
+
+        TestIndex.prefetch(trees, max_workers=max_workers)
+
+
+def removeIgnored(args: Test.DtestArgs, test: Union[str, NestedStringList]) -> Union[str, NestedStringList, None]:
+    """Remove any tests that match args.ignore.
+
+    Parameters
+    ----------
+    args : Test.DtestArgs
+        Args for the tests.
+    test : Union[str, NestedStringList]
+        A test directory or a (nested) list of test directories, e.g., a SERIAL group.
+
+    Returns
+    -------
+    Union[str, NestedStringList, None]
+        The test with the ignored tests removed, or None if nothing is left.
+    """
+    if isinstance(test, str):
+        if not fnmatch.fnmatch(test, args.ignore):
+            return test
+        return None
+
+    filtered = [t for t in (removeIgnored(args, v) for v in test) if t is not None]
+    if filtered:
+        return filtered
+    return None
+
+
+def iterTestList(args: Test.DtestArgs, parallel_mode: bool = False) -> Generator[Union[str, List[str]], None, None]:
+    """Yield the tests as they are discovered.
+
+    Tests that match args.ignore are left out. In parallel mode, the tests of
+    a SERIAL directory are yielded together as a single list. The discovery
+    index and the compiled config cache are saved once the walk is complete.
+
+    Parameters
+    ----------
+    args : Test.DtestArgs
+        Args for the tests.
+    parallel_mode : bool
+        Whether to group SERIAL directories or not.
+    """
+    if args.from_plan:
+        # Run the tests of the plan instead of walking the tree.
+        from Dtest import TestPlan
+
+        for test in TestPlan.planTests(getPlan(args.from_plan)):
+            if not parallel_mode and not isinstance(test, str):
+                for t in test:
+                    if removeIgnored(args, t) is not None:
+                        yield t
+                continue
+
+            test = removeIgnored(args, test)
+            if test is not None:
+                yield test
+        return
+
     # Figure out the test mode
     test_mode = "REGULAR"
     if args.quarantine:
@@ -447,29 +830,47 @@ def generateTestList(args: Test.DtestArgs, parallel_mode: bool = False) -> Neste
     if args.all:
         test_mode = "ALL"
 
-    if args.paths:
-        base_test_paths = [os.path.realpath(d) for d in args.paths]
-    else:
-        base_test_paths = [args.directory]
-
-    test_list: NestedStringList = list(
-        reduce(
-            lambda x, y: list(x) + list(y),
-            [
-                Test.findTests(
-                    full_dir=t,
-                    test_mode=test_mode,
-                    log_num=args.uuid,
-                    exclude_tags=args.exclude_tags,
-                    run_only_tags=args.run_only_tags,
-                    truth_suffix=args.truth_suffix,
-                    quiet_mode=args.quiet,
-                    parallel_mode=parallel_mode,
-                )
-                for t in base_test_paths
-            ],
-        )
-    )
+    base_test_paths = baseTestPaths(args)
+
+    setupConfigCache(args)
+
+    index = getDiscoveryIndex(args)
+    if index is not None and args.discovery_threads > 1:
+        index.prefetch(base_test_paths, max_workers=args.discovery_threads)
+
+    # Directories whose configs are already compiled.
+    compiled_dirs: Set[str] = set()
+
+    for path in base_test_paths:
+        for test in Test.findTests(
+            full_dir=path,
+            test_mode=test_mode,
+            log_num=args.uuid,
+            exclude_tags=args.exclude_tags,
+            run_only_tags=args.run_only_tags,
+            truth_suffix=args.truth_suffix,
+            quiet_mode=args.quiet,
+            parallel_mode=parallel_mode,
+            index=index,
+        ):
+            test = removeIgnored(args, test)
+            if test is None:
+                continue
+
+            compileTestConfigs(args, [test], compiled_dirs)
+            yield test
+
+    if index is not None:
+        index.save()
+
+    Test.compiled_config_cache.save()
+
+
+def generateTestList(args: Test.DtestArgs, parallel_mode: bool = False) -> NestedStringList:
+    """Return list of tests."""
+    from Dtest import TestSchedule
+
+    test_list: NestedStringList = list(iterTestList(args, parallel_mode=parallel_mode))
 
     if parallel_mode:
         # If in parallel mode, sort so that the lists come before
@@ -484,21 +885,19 @@ def generateTestList(args: Test.DtestArgs, parallel_mode: bool = False) -> Neste
 
         test_list.sort(key=sort_key)
 
-    @overload
-    def remove_ignore(t: str) -> Union[str, None]: ...
-    @overload
-    def remove_ignore(t: NestedStringList) -> NestedStringList: ...
-    def remove_ignore(t):
-        """
-        Remove any tests that match args.ignore
-        """
-        if isinstance(t, str):
-            if not fnmatch.fnmatch(t, args.ignore):
-                return t
-        else:
-            return [v for v in filter(remove_ignore, t)]
+        if args.schedule == "lpt" and not args.from_plan:
+            # Run the longest tests first, so they do not extend the run at the end.
+            # Tests with unknown durations keep the order above.
+            test_list = TestSchedule.orderTests(test_list, test_durations.get(args.uuid, {}))
 
-    test_list = remove_ignore(test_list)
+    # The admission controller may run fewer tests at once than there are jobs.
+    if not parallel_mode:
+        workers = 1
+    elif admission_controller is None:
+        workers = args.jobs
+    else:
+        workers = min(args.jobs, admission_controller.slots)
+    predicted_makespans[args.uuid] = TestSchedule.predictMakespan(test_list, test_durations.get(args.uuid, {}), workers)
 
     return test_list
 
@@ -509,9 +908,76 @@ def dummyLock(_):
     yield
 
 
-def loadPerCPU():
-    """Return average load divided by CPU count."""
-    return os.getloadavg()[0] / cpu_count()
+def setupAdmission(args: Test.BaseArgs):
+    """Create the admission controller of the pool workers, sized from args. Call this before creating the pool."""
+    global admission_controller
+    from Dtest import TestAdmission
+
+    # Each worker waits for or holds the resources of one test at a time.
+    admission_controller = TestAdmission.AdmissionController(max_grants=max(1, args.jobs))
+    admission_controller.configure(
+        args.max_load_saturation, args.max_cpu_pressure, TestAdmission.parseCapacities(args.resource)
+    )
+
+
+def createPool(args: Test.BaseArgs) -> Pool:
+    """Return the pool to run the tests in parallel, as selected by args.executor.
+
+    With the async executor, the pool is a ThreadPool, and the commands of the tests are
+    run by a Test.command_runner. Call stopCommandRunner once the pool is done.
+    """
+    if args.executor == "async":
+        # asyncio is slow to import, so only do so when needed.
+        from Dtest import TestExecutor
+
+        Test.command_runner = TestExecutor.AsyncCommandRunner()
+        Test.command_runner.start()
+        return ThreadPool(processes=args.jobs)
+
+    return Pool(processes=args.jobs)
+
+
+def stopCommandRunner():
+    """Stop the command runner of the async executor, if any. Commands still running are killed."""
+    if Test.command_runner is not None:
+        Test.command_runner.close()
+        Test.command_runner = None
+
+
+def resolveConfig(args: Test.DtestArgs, full_dir: str) -> Optional[Test.ResolvedTestConfig]:
+    """Return the resolved config of the test in full_dir, or None if it has none."""
+    if args.from_plan:
+        return getPlanConfigs(args.from_plan).get(full_dir)
+
+    return Test.getLocalConfig(
+        Test.getDefaultConfig(full_dir, args.truth_suffix), full_dir=full_dir, truth_suffix=args.truth_suffix
+    )
+
+
+def testResources(config: Optional[Test.ResolvedTestConfig], full_dir: str) -> Dict[str, float]:
+    """Return the resources the test in full_dir needs to run, according to the RESOURCES and LOCKS in its config.
+
+    If they are invalid, or there is no room for their names in the admission controller, the test gets the
+    default resources, with its LOCKS if those are valid.
+    """
+    from Dtest import TestAdmission
+
+    def checkedDemand(resources, locks):
+        demand = TestAdmission.resourceDemand(resources, locks)
+        if admission_controller is not None:
+            admission_controller.checkDemand(demand)
+        return demand
+
+    locks = config.get("LOCKS") if config else None
+    try:
+        return checkedDemand(config.get("RESOURCES") if config else None, locks)
+    except ValueError as e:
+        Test.red("{} in the RESOURCES or LOCKS of {}; using the default resources.".format(e, full_dir))
+
+    try:
+        return checkedDemand(None, locks)
+    except ValueError:
+        return TestAdmission.resourceDemand(None)
 
 
 @overload
@@ -536,31 +1002,55 @@ def run(_args: Test.DtestArgs, dispatch, directory: Union[str, List[str]]):
         nesting level of the input.
     """
 
-    # Set environment variables for this test
+    # Set environment variables for this test. The threads of the async executor may
+    # run tests of different test trees at once, so ROOTDIR is also set for this thread.
     os.environ["ROOTDIR"] = _args.top_test_dir
+    Test.thread_environment.variables = {"ROOTDIR": _args.top_test_dir}
+    Test.cancel_event = cancel_event if _args.fail_fast else None
 
     if _args.fail_fast and failure_count.value:
         return (0, 0, {})
 
     if isinstance(directory, str):
-        # Don't launch more than one test at a time if the CPUs are
-        # fully utilized
+        # Wait until the resources of the test are free.
         directory = os.path.join(_args.directory, directory)
-        while loadPerCPU() > _args.max_load_saturation and shared_num_active_tests.value >= 1:
-            time.sleep(1)
-
-        shared_num_active_tests.value += 1
-
-        try:
-            tmp_results = dispatch(full_dir=directory)
+        start_time = time.time()
+        config = resolveConfig(_args, directory)
+        config_time = time.time() - start_time
+        assert admission_controller is not None, "setupAdmission was not called"
+        with admission_controller.slot(testResources(config, directory)):
+            if _args.fail_fast and cancel_event.is_set():
+                # A test failed while this one waited for its resources.
+                return (0, 0, {})
+            queue_time = time.time() - start_time - config_time
+            tmp_results = dispatch(full_dir=directory, config=config)
+
+        for test_data in tmp_results[2].values():
+            test_data.setdefault("phases", {}).update(config=config_time, queue=queue_time)
+
+        with failure_count.get_lock():
             failure_count.value += tmp_results[1]
-            return tmp_results
-        finally:
-            shared_num_active_tests.value -= 1
+        if _args.fail_fast and tmp_results[1]:
+            # Stop the commands of the tests that are still running, so dtest exits right away.
+            cancel_event.set()
+        return tmp_results
     else:
         return [run(_args, dispatch, d) for d in directory]
 
 
+# Threads that collect the results of the parallel test runs. See runTests and joinResultConsumers.
+result_consumers: List[threading.Thread] = []
+
+
+def joinResultConsumers():
+    """Wait until the results of all parallel test runs have been reported.
+
+    This must be called after the pool has been closed and joined.
+    """
+    while result_consumers:
+        result_consumers.pop(0).join()
+
+
 ContainerValue = Tuple[int, int, Dict[str, Dict[str, Any]]]
 Container: TypeAlias = Optional[ContainerValue]
 NestedContainer: TypeAlias = List[Union[Container, List["NestedContainer"]]]
@@ -568,9 +1058,13 @@ NestedContainer: TypeAlias = List[Union[Container, List["NestedContainer"]]]
 
 def runTests(_args: Test.DtestArgs, pool: Union[Pool, None], run: Union[Callable, None]):
     """This function will run the tests in the _args directory. If pool is not None, then
-    it will use a map_async to add the tests to the pool. If it is None, then the main thread
-    will just run these tests one by one. If pool is defined, then run must be defined. run is
-    the function that we will map over when sending jobs to the pool.
+    it will use an imap_unordered to add the tests to the pool, and a thread in result_consumers
+    records the results as the tests finish. Call joinResultConsumers after joining the pool
+    to wait for it. If pool is None, then the main thread will just run these tests one by one.
+    If pool is defined, then run must be defined. run is the function that we will map over
+    when sending jobs to the pool.
+
+    If _args.stream is set, the tests are added to the pool as they are discovered.
 
     Parameters
     ----------
@@ -583,10 +1077,6 @@ def runTests(_args: Test.DtestArgs, pool: Union[Pool, None], run: Union[Callable
         This is the function that is mapped over if jobs are being sent to a pool.
     """
 
-    # If poll_gpu_memory, then do that rather than using the regular runner.
-    if _args.poll_gpu_memory:
-        return getTestMemory(_args)
-
     # Set up the locker
     if _args.ignore_lock or not _args.run_tests:
         locker = dummyLock
@@ -607,18 +1097,35 @@ def runTests(_args: Test.DtestArgs, pool: Union[Pool, None], run: Union[Callable
         print("\n".join(flattenNestedStringList(_test_list)))
         sys.exit(0)
 
+    if _args.plan:
+        if pool is None:
+            # The configs depend on the environment. In parallel mode, this was done before creating the pool.
+            setupEnvAndLogging(_args)
+
+        # Discover the tests with the SERIAL groups, so the plan can be run in parallel or in serial.
+        _test_list = generateTestList(_args, parallel_mode=True)
+        from Dtest import TestPlan
+
+        TestPlan.writePlan(TestPlan.buildPlan(_args, _test_list), _args.plan)
+        sys.exit(0)
+
     try:
         if pool is not None:
             # We are running in parallel and want to add jobs to the pool.
 
-            _test_list = generateTestList(_args, parallel_mode=True)
-            if len(_test_list) == 0:
-                # No tests were found. Just exit.
-                return 0
+            if _args.stream:
+                # Hand the tests to the pool while the tree is still being walked.
+                # The pool pulls the tests from this generator in its task handler thread.
+                _test_list = iterTestList(_args, parallel_mode=True)
+            else:
+                _test_list = generateTestList(_args, parallel_mode=True)
+                if len(_test_list) == 0:
+                    # No tests were found. Just exit.
+                    return 0
 
-            # join() will hang if _test_list is empty
-            # (http://bugs.python.org/issue12157)
-            assert len(_test_list)  # pylint: disable=C1801
+                # join() will hang if _test_list is empty
+                # (http://bugs.python.org/issue12157)
+                assert len(_test_list)  # pylint: disable=C1801
 
             # Process output. Unpack tests that ran in serial.
             def flatten(container: Union[ContainerValue, NestedContainer]) -> Generator[Container, None, None]:
@@ -639,10 +1146,9 @@ def runTests(_args: Test.DtestArgs, pool: Union[Pool, None], run: Union[Callable
             # We cannot use a "with" context here, since we will return out of this function before
             # the tests are complete. Hence, we enter the context manually, and set triggers to ensure
             # it exits. These triggers are in:
-            # * Result callback. If the map_async exits normally.
-            # * Error callback. If something happens in the callback.
-            # * atexit. This is a catch all in case some error happens that causes both of the first two
-            #   triggers to miss.
+            # * The result consumer, once all of the results are in or if something fails in it.
+            # * atexit. This is a catch all in case some error happens that causes the first
+            #   trigger to miss.
             lock = locker(os.path.join(_args.top_test_dir, "dtest_lock"))
 
             # Try to lock. If it fails, just print the exception and return with code 1.
@@ -656,26 +1162,44 @@ def runTests(_args: Test.DtestArgs, pool: Union[Pool, None], run: Union[Callable
             exit_lock = lambda: lock.__exit__(None, None, None)
             atexit.register(exit_lock)
 
-            def callback(test_results: NestedContainer):
-                """This callback is run using the test results whenever map_async is complete."""
+            # imap_unordered must be called here rather than in the consumer thread,
+            # since the pool may be closed as soon as this function returns.
+            # Hand out one test at a time, so the longest tests are spread over the workers.
+            results = pool.imap_unordered(run, _test_list)
+
+            collector = ResultCollector(_args, _test_start_time, module_name, report_failures=True)
+
+            def consume():
+                """Record the results of the tests as they finish, and output the summary at the end."""
                 try:
-                    test_results = [t for t in flatten(test_results)]
+                    while True:
+                        try:
+                            result = next(results)
+                        except StopIteration:
+                            break
+                        except Exception as e:
+                            # Keep collecting, so the summary still covers the tests that ran.
+                            Test.red("Error while running tests: {}".format(e))
+                            with failure_count.get_lock():
+                                failure_count.value += 1
+                            if _args.run_tests:
+                                collector.addError(e)
+                            continue
+
+                        if _args.run_tests:
+                            for test_result in flatten([result]):
+                                collector.add(test_result)
+
                     if _args.run_tests:
-                        outputData(
-                            args=_args, test_results=test_results, start_time=_test_start_time, module_name=module_name
-                        )
+                        collector.finish()
                 except Exception as e:
-                    Test.red("Exception in callback")
+                    Test.red("Exception while collecting the test results")
                     Test.red(str(e))
                 exit_lock()
 
-            def error_callback(results):
-                """This callback is run if the callback fails."""
-                Test.red("Error caused pool to fail, results follow:")
-                print(results)
-                exit_lock()
-
-            pool.map_async(run, _test_list, callback=callback, error_callback=error_callback)
+            consumer = threading.Thread(target=consume, daemon=True)
+            consumer.start()
+            result_consumers.append(consumer)
             return 0
         else:
             # We are running tests in serial
@@ -694,23 +1218,27 @@ def runTests(_args: Test.DtestArgs, pool: Union[Pool, None], run: Union[Callable
                 # running in serial mode
                 _test_list = generateTestList(_args)
 
-                # This is a list so that it can be mutated
-                failure_count = [0]
+                # This is a list so that it can be mutated. It must not be named failure_count, which would
+                # hide the global one from the result consumer of the parallel mode above.
+                serial_failures = [0]
+
+                collector = ResultCollector(_args, _test_start_time, module_name)
 
                 def runSingleProcess(directory):
                     """Run in single process mode."""
-                    if _args.fail_fast and failure_count[0]:
+                    if _args.fail_fast and serial_failures[0]:
                         return (0, 0, {})
                     _tmp_results = dispatch(_args, test_command_modifier, full_dir=directory)
-                    failure_count[0] += _tmp_results[1]
+                    serial_failures[0] += _tmp_results[1]
                     return _tmp_results
 
-                _test_results = [runSingleProcess(_t) for _t in _test_list]
+                for _t in _test_list:
+                    _tmp_results = runSingleProcess(_t)
+                    if _args.run_tests:
+                        collector.add(_tmp_results)
 
                 if _args.run_tests:
-                    return outputData(
-                        args=_args, test_results=_test_results, start_time=_test_start_time, module_name=module_name
-                    )
+                    return collector.finish()
                 else:
                     return 0
     except Test.LockException as lock_exception:
@@ -719,122 +1247,3 @@ def runTests(_args: Test.DtestArgs, pool: Union[Pool, None], run: Union[Callable
     except Test.TestException as test_exception:
         Test.red(str(test_exception))
         sys.exit(1)
-
-
-# Start separate thread to poll the GPU
-def pollGpu(stop, result_queue):
-    """This function polls the gpu until stop is set. Then, it takes the
-    maximum value it got during the poll and puts it on the result queue."""
-    gpu_start = getGPUMemUsage()
-    max_gpu_usage = 0
-
-    # Continuously poll the GPU for the current usage.
-    while not stop.is_set():
-        gpu_usage = getGPUMemUsage() - gpu_start
-        if gpu_usage > max_gpu_usage:
-            max_gpu_usage = gpu_usage
-
-    result_queue.put(max_gpu_usage)
-
-
-class PollGPU:
-    """Class to poll the GPU. It has a context to start/stop polling."""
-
-    def __init__(self):
-        self.gpu_usage: float = 0.0
-        self._context = get_context("forkserver")
-        self.result_queue = self._context.Queue()
-        self.stop_event = self._context.Event()
-        self.process: Optional[ForkServerProcess] = None
-
-    def __enter__(self):
-        # Reset the gpu_usage
-        self.gpu_usage = 0.0
-
-        # Reset the stop event and process
-        self.stop_event.clear()
-        self.process = None
-
-        self.process = self._context.Process(target=pollGpu, args=(self.stop_event, self.result_queue))
-        self.process.start()
-
-    def __exit__(self, *_):
-        # Stop polling
-        self.stop_event.set()
-        if self.process is not None:
-            self.process.join()
-        self.gpu_usage = self.result_queue.get()
-
-
-def getTestMemory(_args: Test.DtestArgs):
-    """This function will run the tests in the _args directory. For each test,
-    it will poll the GPU memory and keep track of how much was used.
-
-    Parameters
-    ----------
-    _args : Test.DtestArgs
-        Args for the tests.
-    """
-    # Set up the locker
-    if _args.ignore_lock or not _args.run_tests:
-        locker = dummyLock
-    else:
-        locker = Test.lock
-
-    # Get the start time (approx)
-    _test_start_time = datetime.datetime.now()
-
-    # Get the name of the module being tested
-    try:
-        module_name = Test.getModuleName(_args.directory)
-    except Test.TestException:
-        module_name = ""
-
-    try:
-        # We are running tests in serial
-        # Set environment variables for the test(s)
-        os.environ["ROOTDIR"] = _args.top_test_dir
-
-        with locker(os.path.join(_args.top_test_dir, "dtest_lock")):
-            # This must run before longLogTee or the test list, as it may change Test.log, and is also used
-            # to create the logfile.
-            setupEnvAndLogging(_args)
-
-            # Get the test command modifier
-            test_command_modifier = getTestModifier(_args)
-
-            # running in serial mode
-            _test_list = generateTestList(_args)
-
-            # This is a list so that it can be mutated
-            failure_count = [0]
-
-            # Create GPU poller
-            poll_gpu = PollGPU()
-
-            def runSingleProcess(directory):
-                """Run in single process mode."""
-                if _args.fail_fast and failure_count[0]:
-                    return (0, 0, {})
-                with poll_gpu:
-                    _tmp_results = dispatch(_args, test_command_modifier, full_dir=directory)
-                test_data = _tmp_results[2]
-                if len(test_data) > 0:
-                    test_data[list(test_data.keys())[0]].update({"gpu_usage": poll_gpu.gpu_usage})
-                failure_count[0] += _tmp_results[1]
-                return _tmp_results
-
-            _test_results = [runSingleProcess(_t) for _t in _test_list]
-
-            if _args.run_tests:
-                return outputData(
-                    args=_args, test_results=_test_results, start_time=_test_start_time, module_name=module_name
-                )
-            else:
-                return 0
-    except Test.LockException as lock_exception:
-        Test.red(str(lock_exception))
-        sys.exit(1)
-    except Test.TestException as test_exception:
-        Test.red(str(test_exception))
-        sys.exit(1)
@@ -6,6 +6,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import bisect
 import contextlib
 import datetime
 import os
@@ -14,18 +15,19 @@ import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-import copy
 import errno
+import functools
+import hashlib
+from collections.abc import Mapping
 from Dutils.typing import Tuple, Dict, Any, Literal, List, Self, Optional, Union, Set
 from pydantic import BaseModel, model_validator
 from functools import cached_property
 from enum import Enum
 
 try:
-    from multiprocessing import cpu_count, Value
-
-    gpu_mem_usage = Value("l", 0)
+    from multiprocessing import cpu_count
 except:
     pass
 
@@ -34,12 +36,25 @@ try:
     from Dtest.DtestGpuMem_Py import getGPUMemTotal, getGPUMemAvailable
 
     has_cuda = True
-    total_gpu_memory = getGPUMemTotal()
 except:
     has_cuda = False
 
+if has_cuda:
+    # The GPU memory reserved by the running tests. This must be created before
+    # the pool is created so that it is shared with the workers.
+    from multiprocessing import Value
+
+    gpu_mem_usage = Value("l", 0)
+
+
+@functools.lru_cache(maxsize=None)
+def totalGpuMemory():
+    """Return the total GPU memory. This is only queried when needed, as it initializes cuda."""
+    return getGPUMemTotal()
+
 from . import killableprocess
 from . import TestMagic
+from . import TestUsage
 
 try:
     basestring
@@ -76,6 +91,38 @@ warning_messages = set()
 # true if running multiple tests in parallel
 parallel_mode = False
 
+# Resolved configs, keyed by (directory, id of the previous config, settings).
+# The values are (config file mtime, previous config, resolved config). The
+# previous config is kept so that its id stays unique. See getLocalConfig.
+resolved_configs = {}
+
+# Persistent cache of compiled config files (a TestConfigCache.ConfigCache),
+# or None to always parse the config files. See loadCompiledConfig.
+compiled_config_cache = None
+
+# containsTestDir results, keyed by directory. The values are
+# (directory mtime, result).
+contains_test_dir_cache = {}
+
+# If set, the test commands are run by this TestExecutor.AsyncCommandRunner
+# rather than with a killableprocess.Popen each. See runCmd.
+command_runner = None
+
+# Number of output files of a test that are compared at once. See compareTruthFiles.
+compare_jobs = 4
+
+# If set, e.g., to a multiprocessing.Event, runCmd stops the running commands
+# once it is set, and does not start new ones (see --fail-fast).
+cancel_event = None
+
+# If set, the TestMonitor.ResourceMonitor that samples the processes of the tests (see --monitor).
+resource_monitor = None
+
+# Environment variables of the tests run by the current thread, on top of
+# os.environ. Threads that run tests of different test trees at once (see
+# TestExecutor) set ROOTDIR here rather than in os.environ. See testEnvironment.
+thread_environment = threading.local()
+
 
 class TestException(Exception):
     """Raised when encountering unresolvable problem during testing."""
@@ -110,7 +157,11 @@ class BaseArgs(BaseModel):
     jobs : int
         Number of jobs to run in parallel. Non-positive values will result in the number of jobs being set to the number of CPUs.
     max_load_saturation : float
-        Throttle jobs after reaching this saturation ratio. 1 represents full saturation
+        Only run as many jobs at once as this ratio of the available CPUs. 1 represents full saturation
+    max_cpu_pressure : Optional[float]
+        Hold back new jobs while the CPU pressure (percentage of time tasks waited for a CPU) is above this.
+    resource : List[str]
+        Capacities of the RESOURCES tests may declare, as NAME=AMOUNT (comma separated list), e.g., MEM=64GB.
     gpu_memory_ratio,
         Only allow jobs to use this ratio of the total GPU memory. 1 represents full GPU memory usage.
     timeout : int
@@ -141,6 +192,10 @@ class BaseArgs(BaseModel):
         Append to the regtest data file (default is False - ie, overwrite file, do not append)
     list_mode : bool
         Simply return list of all test cases that will be run.
+    plan : Optional[str]
+        Write the execution plan of the tests that will be run to this file instead of running them.
+    from_plan : Optional[str]
+        Run the tests of the execution plan in this file instead of discovering them.
     quiet : bool
         Run in quite mode - disable informative messages
     truth_suffix : Union[str, List[str]]
@@ -155,6 +210,36 @@ class BaseArgs(BaseModel):
         Specify the shell run tests with.
     poll_gpu_memory : bool
         If True, then poll the tests for the GPU memory. This will force the tests to run in serial.
+    discovery_index : bool
+        If True, then use and update the persistent test discovery index at the top of the test tree.
+    discovery_threads : int
+        Number of threads used to walk the test tree with the discovery index. Values < 2 walk it serially.
+    make_regtest_dir : bool
+        If True, then dtest-sbox finds the module test directories with "make regtest-dir" rather than
+        reading the module makefiles.
+    rebuild_config_cache : bool
+        If True, then ignore and rebuild the compiled config cache at the top of the test tree.
+    stream : bool
+        If True, then hand tests to the workers while the test tree is still being walked.
+    schedule : str
+        Order in which the tests are handed to the workers in parallel mode. 'lpt' runs the tests
+        with the longest expected duration first, 'discovery' runs them in discovery order.
+    durations : Optional[str]
+        regtest.data file or regtest HDF5 store to read the expected test durations from. Defaults
+        to the data file of the previous run.
+    executor : str
+        How the tests are run in parallel mode. 'process' runs each job in a forked worker process,
+        'async' runs the jobs as threads and their commands from one asyncio event loop.
+    compare_jobs : int
+        Number of output files of a test that are compared with their truth files at once.
+    timing_report : bool
+        If True, then the summary lists the time of each test phase and the slowest phases.
+    timing_report_count : int
+        Number of the slowest phases that '--timing-report' lists.
+    monitor : bool
+        If True, then sample the processes of each test and record their peaks in the regtest data.
+    monitor_interval : float
+        Seconds between the samples of '--monitor' and '--poll-gpu-memory'.
     """
 
     log: Optional[str]
@@ -163,6 +248,8 @@ class BaseArgs(BaseModel):
     short_summary: bool
     jobs: int
     max_load_saturation: float
+    max_cpu_pressure: Optional[float]
+    resource: List[str]
     gpu_memory_ratio: float
     timeout: int
     scale_timeout: float
@@ -178,6 +265,8 @@ class BaseArgs(BaseModel):
     data: Optional[str]
     append_data: bool
     list_mode: bool
+    plan: Optional[str]
+    from_plan: Optional[str]
     quiet: bool
     truth_suffix: Union[str, List[str]]
     email_on_failure: bool
@@ -185,6 +274,19 @@ class BaseArgs(BaseModel):
     ignore_lock: bool
     shell: str
     poll_gpu_memory: bool
+    discovery_index: bool
+    discovery_threads: int
+    make_regtest_dir: bool
+    rebuild_config_cache: bool
+    stream: bool
+    schedule: str
+    durations: Optional[str]
+    executor: str
+    compare_jobs: int
+    timing_report: bool
+    timing_report_count: int
+    monitor: bool
+    monitor_interval: float
 
     @model_validator(mode="after")
     def validate(self) -> Self:
@@ -192,7 +294,8 @@ class BaseArgs(BaseModel):
             self.jobs = cpu_count()
 
         if self.poll_gpu_memory:
-            # Run jobs in serial if polling the GPU
+            # Run jobs in serial if polling the GPU. The GPU memory is used by the whole machine, so it is only the
+            # usage of a test if no other test is running.
             self.jobs = 1
 
         # Ensure exclude_tags and run_only tags are a unique set.
@@ -219,9 +322,27 @@ class BaseArgs(BaseModel):
             self.truth_suffix = list(filter("".__ne__, self.truth_suffix))
 
         # Set quiet mode to true if list mode is true
-        if self.list_mode:
+        if self.list_mode or self.plan:
             self.quiet = True
 
+        if self.compare_jobs < 1:
+            raise ValueError("'--compare-jobs' must be at least 1!")
+
+        if self.timing_report_count < 0:
+            raise ValueError("'--timing-report-count' must not be negative!")
+
+        if self.monitor_interval <= 0:
+            raise ValueError("'--monitor-interval' must be positive!")
+
+        if self.plan and self.from_plan:
+            raise ValueError("Cannot specify both '--plan' and '--from-plan'!")
+
+        # Check the resource capacities. The admission controller parses them again in the main script.
+        if self.resource:
+            from . import TestAdmission
+
+            TestAdmission.parseCapacities(self.resource)
+
         return self
 
     @cached_property
@@ -239,7 +360,8 @@ class DtestArgs(BaseArgs):
     paths : List[str]
         Run subset of tests.
     directory : str
-        Directory to run tests from. Can be set by DTEST_TESTDIR env variable.
+        Directory to run tests from. Can be set by DTEST_TESTDIR env variable. With from_plan, it defaults to
+        the directory of the plan, and must be the same if given.
     """
 
     paths: List[str]
@@ -247,6 +369,18 @@ class DtestArgs(BaseArgs):
 
     @model_validator(mode="before")
     def before_validate(vals: Dict[str, Any]) -> Dict[str, Any]:
+        if vals.get("from_plan"):
+            # The test directories of the plan are relative to where it was written, not to the current directory.
+            plan_directory = _loadPlan(vals["from_plan"])["directory"]
+            if not vals.get("directory", None):
+                vals["directory"] = plan_directory
+            elif os.path.abspath(vals["directory"]) != plan_directory:
+                raise ValueError(
+                    "The plan {} is for the tests in {}, not {}!".format(
+                        vals["from_plan"], plan_directory, os.path.abspath(vals["directory"])
+                    )
+                )
+
         if not vals.get("directory", None):
             vals["directory"] = os.getcwd() if isTestDir(os.getcwd()) else getTopTestDir(os.getcwd())
         return vals
@@ -267,6 +401,10 @@ class DtestArgs(BaseArgs):
 
     @cached_property
     def top_test_dir(self) -> str:
+        if self.from_plan:
+            # The plan has the configs of the tests, so the test tree is not read.
+            return _loadPlan(self.from_plan)["top_test_dir"]
+
         # The top of the test tree
         top_test_directory = getTopTestDir(self.directory)
 
@@ -280,7 +418,17 @@ class DtestArgs(BaseArgs):
 
     @property
     def run_tests(self) -> bool:
-        return not self.compare and not self.list_mode
+        return not self.compare and not self.list_mode and not self.plan
+
+
+def _loadPlan(filename: str) -> Dict[str, Any]:
+    """Return the execution plan in filename, for the arguments. Errors are raised as ValueError."""
+    from . import TestPlan
+
+    try:
+        return TestPlan.loadPlan(filename)
+    except TestException as e:
+        raise ValueError(str(e))
 
 
 def baseOptions():
@@ -338,9 +486,29 @@ def baseOptions():
         "--max-load-saturation",
         type=float,
         default=1.0,
-        help="throttle jobs after reaching this saturation "
-        "ratio; 1 represents full saturation "
-        "(default: %(default)s)",
+        help="only run as many jobs at once as this ratio of the CPUs "
+        "available to dtest (including cgroup CPU quotas); 1 represents "
+        "full saturation (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--max-cpu-pressure",
+        type=float,
+        default=None,
+        help="hold back new jobs while the CPU pressure in /proc/pressure/cpu "
+        "(percentage of the last 10 seconds in which tasks waited for a CPU) "
+        "is above this value; ignored by default",
+    )
+
+    parser.add_argument(
+        "--resource",
+        type=str,
+        action="append",
+        default=[],
+        help="capacity of a resource tests may declare in their RESOURCES section, "
+        "as NAME=AMOUNT (comma separated list), e.g., 'MEM=64GB' or 'LICENSES=4'; "
+        "by default, CPUS and MEM are the CPUs and memory available to dtest and "
+        "other resources have a capacity of 1",
     )
 
     parser.add_argument(
@@ -451,6 +619,21 @@ def baseOptions():
         help="simply return list of all test cases that will be run",
     )
 
+    parser.add_argument(
+        "--plan",
+        metavar="FILE",
+        default=None,
+        help="write the execution plan (tests, SERIAL groups, resolved configs, tags and "
+        "truth files) of the tests that will be run to a JSON file instead of running them",
+    )
+
+    parser.add_argument(
+        "--from-plan",
+        metavar="FILE",
+        default=None,
+        help="run the tests of an execution plan written with --plan, without walking the test tree",
+    )
+
     parser.add_argument(
         "--quiet",
         action="store_true",
@@ -494,6 +677,111 @@ def baseOptions():
         help="If specified, then poll the tests for the GPU memory. This will force the tests to run in serial.",
     )
 
+    parser.add_argument(
+        "--no-discovery-index",
+        action="store_false",
+        dest="discovery_index",
+        default=True,
+        help="do not use the persistent test discovery index (.dtest_index) "
+        "at the top of the test tree; walk the whole tree instead",
+    )
+
+    parser.add_argument(
+        "--discovery-threads",
+        type=int,
+        default=8,
+        help="number of threads used to walk the test tree when the discovery "
+        "index is used; values below 2 walk it serially",
+    )
+
+    parser.add_argument(
+        "--make-regtest-dir",
+        action="store_true",
+        default=False,
+        help="(dtest-sbox only) find the module test directories with 'make regtest-dir' "
+        "instead of reading DTEST_TESTDIR from the module makefiles",
+    )
+
+    parser.add_argument(
+        "--rebuild-config-cache",
+        action="store_true",
+        default=False,
+        help="ignore and rebuild the compiled DTESTDEFS cache (.dtest_config_cache) " "at the top of the test tree",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="when running in parallel, start running tests while the test tree "
+        "is still being walked instead of waiting for the full test list",
+    )
+
+    parser.add_argument(
+        "--schedule",
+        choices=["lpt", "discovery"],
+        default="lpt",
+        help="order in which tests are handed to the workers when running in parallel: "
+        "'lpt' runs the tests with the longest expected duration first, 'discovery' "
+        "runs them in discovery order (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--durations",
+        default=None,
+        help="regtest.data file or regtest HDF5 store (.h5) to read the expected test "
+        "durations from; defaults to the data file of the previous run",
+    )
+
+    parser.add_argument(
+        "--executor",
+        choices=["process", "async"],
+        default="process",
+        help="how tests are run in parallel: 'process' runs each job in a worker "
+        "process, 'async' runs the jobs as threads of one process and supervises "
+        "all of their commands from an asyncio event loop, which makes high --jobs "
+        "values cheaper; 'async' needs the Popen call of TestExecutor.AsyncCommandRunner, "
+        "which is commented out by default (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--compare-jobs",
+        type=int,
+        default=4,
+        help="number of output files of a test that are compared with their truth "
+        "files at once (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--timing-report",
+        action="store_true",
+        help="list the total time of each test phase (config, queue, run, compare, ...) "
+        "and the slowest phases in the summary",
+    )
+
+    parser.add_argument(
+        "--timing-report-count",
+        type=int,
+        default=10,
+        metavar="N",
+        help="number of the slowest phases that --timing-report lists (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--monitor",
+        action="store_true",
+        help="sample the processes of each test and record their peak memory, CPU, threads and processes "
+        "in the regtest data",
+    )
+
+    parser.add_argument(
+        "--monitor-interval",
+        type=float,
+        default=0.5,
+        metavar="SECONDS",
+        help="seconds between the samples of --monitor and --poll-gpu-memory (default: %(default)s)",
+    )
+
     return parser
 
 
@@ -528,10 +816,11 @@ def getModuleName(path):
     raise TestException("Unable to determine module name! Current dir: %s" % path)
 
 
-def applyInterpolations(instr):
+def applyInterpolations(instr, messages=None):
     """Interpolates special key words such as YAM_TARGET with actual values.
 
-    Deprecated. Use shell syntax instead.
+    Deprecated. Use shell syntax instead. Warnings are also appended to
+    messages if given.
 
     """
     outstr = instr
@@ -539,7 +828,10 @@ def applyInterpolations(instr):
         if key in outstr and ("$" + key) not in outstr:
             outstr = outstr.replace(key, value)
 
-            warn('"{key}" should be "${key}"; ' "the former is ambiguous; run dtest-upgrade".format(key=key))
+            message = '"{key}" should be "${key}"; ' "the former is ambiguous; run dtest-upgrade".format(key=key)
+            warn(message)
+            if messages is not None:
+                messages.append(message)
 
     return outstr
 
@@ -557,6 +849,11 @@ def warn(message):
         warning_messages.add(message)
 
 
+def _isExecutable(path):
+    """Return True if path is an executable file."""
+    return os.access(path, os.F_OK) and os.access(path, os.X_OK)
+
+
 def getAbsCmp(cp, full_dir):
     """Get the absolute path for the specified comparison program."""
     import shlex
@@ -565,54 +862,255 @@ def getAbsCmp(cp, full_dir):
     cpcmd = cplist.pop(0)
     if cpcmd[0] == "/":
         # verify that this is a legal executable
-        if not (os.access(cpcmd, os.F_OK) and os.access(cpcmd, os.X_OK)):
+        if not _isExecutable(cpcmd):
             raise TestException('The specified "%s" compare program in %s ' % (cpcmd, cp) + "is not an executable.")
         return cp
     # if relative path, check wrt local directory and convert into a full
     # path
     full_path = os.path.join(full_dir, cpcmd)
-    if os.access(full_path, os.F_OK) and os.access(full_path, os.X_OK):
+    if _isExecutable(full_path):
         return " ".join([full_path] + cplist)
     return " ".join([cpcmd] + cplist)
 
 
-def getLocalConfig(previous_config, full_dir, truth_suffix: Union[str, List[str]]):
-    """Parse and load config data from the current directory."""
+def getConfigPath(full_dir):
+    """Return the path to the config file in full_dir, or None if there is none."""
     config_path = os.path.join(full_dir, "DTESTDEFS.cfg")
     if not os.path.isfile(config_path):
         # Fallback to old naming
         config_path = os.path.join(full_dir, "DTESTDEFS")
         if not os.path.isfile(config_path):
-            return previous_config
+            return None
+    return config_path
 
-    # parse the config file
-    from . import configobj
 
-    new_config = configobj.ConfigObj(config_path, list_values=True, stringify=False, raise_errors=True)
+def getLocalConfig(previous_config, full_dir, truth_suffix: Union[str, List[str]]):
+    """Parse and load config data from the current directory.
+
+    Returns a ResolvedTestConfig, or previous_config if full_dir does not
+    have a config file. Resolved configs are cached, so each config file is
+    only parsed once as long as it is not modified and the previous (parent)
+    config is the same object.
 
-    # PROCESS LOCAL DATA #################
+    """
+    config_path = getConfigPath(full_dir)
+    if config_path is None:
+        return previous_config
+
+    key = (full_dir, id(previous_config), _configSettings(truth_suffix))
+    mtime = os.stat(config_path).st_mtime_ns
+    cached = resolved_configs.get(key)
+    if cached is not None and cached[0] == mtime and cached[1] is previous_config:
+        return cached[2]
+
+    new_config = _loadLocalConfig(previous_config, full_dir, config_path, truth_suffix)
+    resolved_configs[key] = (mtime, previous_config, new_config)
+    return new_config
+
+
+def _configSettings(truth_suffix: Union[str, List[str]]):
+    """Return a hashable summary of the settings getLocalConfig depends on."""
+    if not isinstance(truth_suffix, basestring):
+        truth_suffix = tuple(truth_suffix)
+    return (
+        truth_suffix,
+        override_timeout,
+        tuple(sorted(interpolation_data.items())),
+        os.environ.get("DTEST_TRUTH_SUFFIX"),
+    )
+
+
+class ResolvedTestConfig(Mapping):
+    """Immutable config of a test directory, as returned by getLocalConfig.
+
+    The values used to run a test are stored in slots, all other values of
+    the config file (e.g., SKIPTESTS or EMAIL) in OTHER. Unset values are
+    None. The config is a read-only Mapping, so it can be used like the config
+    dictionaries, e.g., config["RUN"], config.get("ENV", {}) or "CMP" in
+    config. Use replace to get a modified copy.
+
+    The values are shared with the parent configs and the compiled config
+    cache, so they must not be modified either.
+    """
+
+    FIELDS = (
+        "RUN",
+        "RUN_AFTER",
+        "RUN_OUTPUTS",
+        "PARALLEL_RUN",
+        "COMPARE",
+        "CMP",
+        "TIMEOUT",
+        "ENV",
+        "RESOURCES",
+        "LOCKS",
+        "TAGS",
+        "CHILD_TAGS",
+        "DELETE",
+        "TRUTHSUFFIX",
+    )
+
+    __slots__ = FIELDS + ("OTHER",)
+
+    def __init__(self, config):
+        for field in self.FIELDS:
+            object.__setattr__(self, field, config.get(field))
+        object.__setattr__(self, "OTHER", {k: v for k, v in config.items() if k not in self.FIELDS})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ResolvedTestConfig is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ResolvedTestConfig is immutable")
+
+    def __reduce__(self):
+        return (ResolvedTestConfig, (dict(self),))
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.OTHER[key]
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if getattr(self, field) is not None:
+                yield field
+        yield from self.OTHER
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "ResolvedTestConfig(%r)" % (dict(self),)
+
+    def replace(self, **changes):
+        """Return a copy of the config with the given values replaced."""
+        config = dict(self)
+        config.update(changes)
+        return ResolvedTestConfig(config)
+
+
+def compileConfig(config_path, full_dir):
+    """Parse config_path and process the values that only depend on this file.
+
+    Returns a tuple (config, messages), where config is a plain dictionary
+    with the RUN commands interpolated and the local COMPARE and CMP programs
+    resolved to absolute paths, and messages are the warnings issued while
+    doing so.
+
+    """
+    from . import configobj
+
+    config = configobj.ConfigObj(config_path, list_values=True, stringify=False, raise_errors=True).dict()
+    messages = []
 
     # substitute in values for special keys such as YAM_TARGET etc.
-    if "RUN" in new_config:
-        for cmd, val in new_config["RUN"].items():
-            new_config["RUN"][cmd] = applyInterpolations(val)
-    elif previous_config and "RUN" in previous_config:
-        new_config["RUN"] = previous_config["RUN"]
+    if "RUN" in config:
+        for cmd, val in config["RUN"].items():
+            config["RUN"][cmd] = applyInterpolations(val, messages)
 
     # get absolute paths for specified compare & validation routines
-    for i in ["COMPARE"]:
-        if i in new_config:
-            for key, value in new_config[i].items():
-                # update the CMP value with the absolute path
-                new_config[i][key] = cmpList([applyInterpolations(x) for x in value], full_dir=full_dir)
+    if "COMPARE" in config:
+        for key, value in config["COMPARE"].items():
+            # update the CMP value with the absolute path
+            config["COMPARE"][key] = cmpList([applyInterpolations(x, messages) for x in value], full_dir=full_dir)
 
-        elif previous_config and i in previous_config:
-            new_config[i] = previous_config[i]
+    if "CMP" in config:
+        # update the CMP value with the absolute path
+        if isinstance(config["CMP"], basestring):
+            config["CMP"] = [config["CMP"]]
+        config["CMP"] = cmpList([applyInterpolations(x, messages) for x in config["CMP"]], full_dir=full_dir)
+
+    if "DELETE" in config:
+        val = config["DELETE"]
+        if val == "":
+            config["DELETE"] = []
+        elif not isinstance(val, list):
+            config["DELETE"] = [val]
+
+    return config, messages
+
+
+def loadCompiledConfig(config_path, full_dir):
+    """Return the compiled config (see compileConfig) for config_path.
+
+    If compiled_config_cache is set, the compiled config is looked up there
+    by the hash of the file contents and the interpolation data, and only
+    compiled if it is not found. The compare programs are resolved against
+    the test directory, so a cached config is also recompiled if a program
+    it refers to was added to or removed from there (see comparePrograms).
+
+    """
+    cache = compiled_config_cache
+    if cache is None:
+        return compileConfig(config_path, full_dir)[0]
+
+    with open(config_path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    key = (digest, tuple(sorted(interpolation_data.items())))
+
+    cached = cache.get(full_dir, key)
+    if cached is not None:
+        config, messages, programs = cached
+        if all(_isExecutable(path) == executable for path, executable in programs):
+            for message in messages:
+                warn(message)
+            return config
+
+    config, messages = compileConfig(config_path, full_dir)
+    programs = tuple((path, _isExecutable(path)) for path in comparePrograms(config, full_dir))
+    cache.put(full_dir, key, (config, messages, programs))
+    return config
+
+
+def comparePrograms(config, full_dir):
+    """Return the paths that the compare programs of a compiled config were looked up at.
+
+    These are the absolute programs, and the test directory path of the
+    relative ones, which getAbsCmp found to be executable or not.
+
+    """
+    import shlex
+
+    values = list(config.get("CMP", []))
+    for value in config.get("COMPARE", {}).values():
+        values.extend(value)
+
+    paths = []
+    for cp in values:
+        cpcmd = shlex.split(cp)[0]
+        path = cpcmd if cpcmd[0] == "/" else os.path.join(full_dir, cpcmd)
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+
+def _loadLocalConfig(previous_config, full_dir, config_path, truth_suffix: Union[str, List[str]]):
+    """Load config_path and merge it with previous_config."""
+    # PROCESS LOCAL DATA #################
+
+    # The compiled config may be shared through the cache, so only replace
+    # its top level values from here on.
+    new_config = dict(loadCompiledConfig(config_path, full_dir))
+    local_cmp = "CMP" in new_config
+
+    if "RUN" not in new_config and previous_config and "RUN" in previous_config:
+        new_config["RUN"] = previous_config["RUN"]
+        # The dependencies and outputs of the commands come with them.
+        for i in ["RUN_AFTER", "RUN_OUTPUTS"]:
+            if i not in new_config and i in previous_config:
+                new_config[i] = previous_config[i]
+
+    if "COMPARE" not in new_config and previous_config and "COMPARE" in previous_config:
+        new_config["COMPARE"] = previous_config["COMPARE"]
 
     # MERGE PARENT CONFIG DATA #################
 
     # get scalar values from parent config and override
-    for i in ["TRUTHSUFFIX", "CMP", "TIMEOUT", "ENV", "RESOURCES"]:
+    for i in ["TRUTHSUFFIX", "CMP", "TIMEOUT", "ENV", "RESOURCES", "PARALLEL_RUN"]:
         if i not in new_config and previous_config and i in previous_config:
             new_config[i] = previous_config[i]
 
@@ -626,14 +1124,14 @@ def getLocalConfig(previous_config, full_dir, truth_suffix: Union[str, List[str]
         new_tags = new_config["CHILD_TAGS"]
         if isinstance(new_tags, str):
             new_tags = [new_tags]
-        new_config["CHILD_TAGS"] = new_tags + prev_tags
+        new_config["CHILD_TAGS"] = new_tags + list(prev_tags)
 
-    # export CHILD_TAGS info to the environment so it is available to the test Run
-    child_tags = new_config.get("CHILD_TAGS", "")
-    if child_tags:
-        os.environ["DTEST_CHILD_TAGS"] = ",".join(sorted(child_tags))
-    else:
-        os.environ["DTEST_CHILD_TAGS"] = ""
+    # accumulate the locks, so that a lock covers the whole sub-tree
+    locks = getListFromConfig(previous_config, "LOCKS") if previous_config else []
+    for lock in getListFromConfig(new_config, "LOCKS"):
+        if lock not in locks:
+            locks.append(lock)
+    new_config["LOCKS"] = locks
 
     # if no timeout value has been specified in the config files, then
     # use the default value
@@ -658,23 +1156,15 @@ def getLocalConfig(previous_config, full_dir, truth_suffix: Union[str, List[str]
     # set the default compare function
     if "CMP" not in new_config:
         new_config["CMP"] = ["/usr/bin/cmp", "/usr/bin/diff"]
-    else:
-        # update the CMP value with the absolute path
-        if isinstance(new_config["CMP"], basestring):
-            new_config["CMP"] = [new_config["CMP"]]
+    elif not local_cmp:
+        # update the inherited CMP value with the absolute path (the local
+        # value has already been updated by compileConfig)
         new_config["CMP"] = cmpList(
             [applyInterpolations(x) for x in new_config["CMP"]],
             full_dir=full_dir,
         )
 
-    if "DELETE" in new_config:
-        val = new_config["DELETE"]
-        if val == "":
-            new_config["DELETE"] = []
-        elif not isinstance(val, list):
-            new_config["DELETE"] = [val]
-
-    return new_config
+    return ResolvedTestConfig(new_config)
 
 
 def cmpList(value, full_dir):
@@ -703,9 +1193,17 @@ def isTestDir(test_dir):
 
 
 def containsTestDir(test_dir):
-    """Return True if test_dir contains any test directories."""
-    # Save current directory so that we can restore it afterwards
+    """Return True if test_dir contains any test directories.
+
+    Results are cached until the modification time of test_dir changes.
+
+    """
     try:
+        mtime = os.stat(test_dir).st_mtime_ns
+        cached = contains_test_dir_cache.get(test_dir)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
         sdirs = os.listdir(test_dir)
     except OSError as exception:
         raise TestException(str(exception))
@@ -715,6 +1213,7 @@ def containsTestDir(test_dir):
         if isTestDir(os.path.join(test_dir, i)):
             result = True
 
+    contains_test_dir_cache[test_dir] = (mtime, result)
     return result
 
 
@@ -765,38 +1264,121 @@ def getDefaultConfig(path, truth_suffix: Union[str, List[str]]):
     return new_config
 
 
+class DirectorySnapshot:
+    """Listing of a test directory used to match output and truth files.
+
+    The directory is listed once (normally right after the RUN phase) and all
+    truth file and COMPARE pattern queries are answered from that listing, so
+    matching is linear in the number of files rather than re-listing the
+    directory for every truth file.
+
+    Parameters
+    ----------
+    full_dir : str
+        The test directory.
+    """
+
+    def __init__(self, full_dir: str):
+        self.full_dir = full_dir
+
+        # All directory entries, and the subset of them that are files.
+        self.entries: Set[str] = set()
+        self.files: Set[str] = set()
+        with os.scandir(full_dir) as scanner:
+            for entry in scanner:
+                self.entries.add(entry.name)
+                try:
+                    if entry.is_file():
+                        self.files.add(entry.name)
+                except OSError:
+                    pass
+
+        # Sorted names that have a "<name>.<suffix>" file, keyed by suffix.
+        self._bases: Dict[str, List[str]] = {}
+
+        # Compiled COMPARE patterns.
+        self._patterns: Dict[str, Any] = {}
+
+    def isfile(self, filename: str) -> bool:
+        """Return True if filename was a file in the directory."""
+        return filename in self.files
+
+    def remove(self, filename: str):
+        """Delete filename from the directory and the snapshot."""
+        os.remove(os.path.join(self.full_dir, filename))
+        self.entries.discard(filename)
+        self.files.discard(filename)
+
+    def truthFiles(self, suffixes) -> Dict[str, List[str]]:
+        """Return a dictionary of file basenames (keys) and their truth suffixes (values).
+
+        See truthFiles.
+        """
+        # Make sure 'suffixes' is a tuple
+        if isinstance(suffixes, basestring):
+            suffixes = (suffixes,)
+
+        # Get the requested truth files
+        truth_files = set()
+        for suffix in suffixes:
+            suffix_re = self._compile(".*%s$" % suffix)
+            truth_files.update([x for x in self.entries if suffix_re.match(x)])
+        truth_roots = set([os.path.splitext(x)[0] for x in truth_files])
+
+        # For each of the valid 'roots', see which suffixed versions exist
+        files = {}
+        for basename in truth_roots:
+            files[basename] = [suffix for suffix in suffixes if (basename + "." + suffix) in self.files]
+
+        return files
+
+    def testableFiles(self, filename, truth_suffixes, pattern=None) -> Set[str]:
+        """Return the files that start with filename, match pattern and have a truth file.
+
+        See getTestableFiles.
+        """
+        pattern_re = self._compile(pattern) if pattern else None
+
+        testable = set()
+        for ts in truth_suffixes:
+            bases = self._suffixBases(ts)
+            for i in range(bisect.bisect_left(bases, filename), len(bases)):
+                f = bases[i]
+                if not f.startswith(filename):
+                    break
+                if (
+                    f in self.entries
+                    and (f + "." + ts) in self.files
+                    and (pattern_re is None or pattern_re.match(f))
+                ):
+                    testable.add(f)
+
+        return testable
+
+    def _suffixBases(self, suffix: str) -> List[str]:
+        """Return the sorted names f for which "f.suffix" is a file."""
+        bases = self._bases.get(suffix)
+        if bases is None:
+            ending = "." + suffix
+            bases = sorted([x[: -len(ending)] for x in self.files if x.endswith(ending)])
+            self._bases[suffix] = bases
+        return bases
+
+    def _compile(self, pattern: str):
+        """Return the compiled regular expression for pattern."""
+        compiled = self._patterns.get(pattern)
+        if compiled is None:
+            compiled = re.compile(pattern)
+            self._patterns[pattern] = compiled
+        return compiled
+
+
 def truthFiles(suffixes, full_dir):
     """Return list of truth files in the test directory.
     Returns dictionary of file basenames (keys) corresponding truth
     suffixes (values).
     """
-
-    # Make sure 'suffixes' is a tuple
-    if isinstance(suffixes, basestring):
-        suffixes = (suffixes,)
-
-    # Get the requested truth files
-    truth_files = set()
-    for suffix in suffixes:
-        truth_files.update([x for x in os.listdir(full_dir) if re.match(".*%s$" % suffix, x)])
-    truth_roots = set([os.path.splitext(os.path.basename(x))[0] for x in truth_files])
-
-    # Next get a list of the files with any of the 'truth' suffixes
-    orig_files = set()
-    for suffix in suffixes:
-        orig_files.update([x for x in os.listdir(full_dir) if re.match(".*%s$" % suffix, x)])
-
-    # For each of the valid 'roots', see which suffixed versions exist
-    files = {}
-    for basename in truth_roots:
-        truth_suffixes = []
-        for suffix in suffixes:
-            filename = os.path.join(full_dir, basename + "." + suffix)
-            if os.path.isfile(filename):
-                truth_suffixes.append(suffix)
-        files[basename] = truth_suffixes
-
-    return files
+    return DirectorySnapshot(full_dir).truthFiles(suffixes)
 
 
 def runCmd(
@@ -808,18 +1390,28 @@ def runCmd(
     timeout=-1,
     shell="/bin/bash",
     output=False,
+    log_function=None,
+    usage=None,
 ):  # pylint: disable=unused-argument
-    """Run the shell command and return status and return code."""
+    """Run the shell command and return status and return code.
+
+    The command is logged with log_function(log_num, value), log by default.
+    If usage is a dictionary, it is updated with the resource usage of the
+    command, where known (see TestUsage).
+    """
+    if log_function is None:
+        log_function = log
+
     fullcmd = [cmd]
     fullcmd.extend(args)
     cmdstr = " ".join(fullcmd)
     curt = time.asctime()
-    log(log_num, "* Running '%s' in %s at %s" % (cmdstr, cwd, curt))
+    log_function(log_num, "* Running '%s' in %s at %s" % (cmdstr, cwd, curt))
 
     if environment_variables:
         environment_variables = environment_variables.copy()
     else:
-        environment_variables = os.environ.copy()
+        environment_variables = testEnvironment()
 
     # Needed to disable spurious ESC characters from being echoed to the
     # output. See: https://bugzilla.redhat.com/show_bug.cgi?id=304181
@@ -837,9 +1429,18 @@ def runCmd(
     # to get consistent output between C++ and Python print messages
     environment_variables["PYTHONUNBUFFERED"] = "1"
 
+    def watchProcessGroup(pgid):
+        """Sample the processes of the command with the other processes of its test, see TestMonitor."""
+        if resource_monitor is not None:
+            resource_monitor.watch(cwd, pgid)
+
     status = False
     output_file = None
     interrupted = False
+    if cancel_event is not None and cancel_event.is_set():
+        log_function(log_num, "  Cancelled before it started")
+        return (False, killableprocess.Cancelled())
+
     try:
         if not output:
             # For logging to file on error.
@@ -847,47 +1448,74 @@ def runCmd(
 
             os.chmod(output_file.name, 0o664)
 
-        raise ValueError("In general, calling Popen is unsafe, as it can run arbitrary bash commands. Therefore, it has been commented out. To run Dtest, you'll need to uncomment this or replace with something else that can run bash commands listed in DTESTDEFS files.")
-        #process = killableprocess.Popen(
-        #    # [shell, '-c', cmdstr],
-        #    # NOTE: If you re-enable use of 'shell' argument, remove pylint exception above
-        #    [cmdstr],
-        #    shell=True,
-        #    stdin=subprocess.PIPE,
-        #    stdout=output_file,
-        #    stderr=output_file,
-        #    cwd=cwd,
-        #    env=environment_variables,
-        #    # The default shell is /bin/sh, but we often use bashisms such as >& redirection
-        #    executable="/bin/bash",
-        #)
-
-        process.stdin.close()
+        if command_runner is not None:
+            # The runner kills the process group of the command when it is done.
+            try:
+                return_code = command_runner.run(
+                    cmdstr,
+                    cwd=cwd,
+                    env=environment_variables,
+                    output_file=output_file,
+                    timeout=timeout,
+                    cancel=cancel_event,
+                    on_start=watchProcessGroup,
+                )
+            except (killableprocess.TimeoutExpired, killableprocess.Cancelled) as exception:
+                return_code = exception
+            except KeyboardInterrupt:
+                interrupted = True
+                raise
+            else:
+                if return_code == 0:
+                    status = True
 
-        try:
-            return_code = process.wait(timeout)
-        except killableprocess.TimeoutExpired as exception:
-            return_code = exception
-        except KeyboardInterrupt:
-            interrupted = True
-            process.kill()
-            raise
+                if return_code < 0:
+                    log_function(log_num, "  Child was terminated by signal %d" % -return_code)
         else:
-            if return_code == 0:
-                status = True
+            raise ValueError("In general, calling Popen is unsafe, as it can run arbitrary bash commands. Therefore, it has been commented out. To run Dtest, you'll need to uncomment this or replace with something else that can run bash commands listed in DTESTDEFS files.")
+            #process = killableprocess.Popen(
+            #    # [shell, '-c', cmdstr],
+            #    # NOTE: If you re-enable use of 'shell' argument, remove pylint exception above
+            #    [cmdstr],
+            #    shell=True,
+            #    stdin=subprocess.PIPE,
+            #    stdout=output_file,
+            #    stderr=output_file,
+            #    cwd=cwd,
+            #    env=environment_variables,
+            #    # The default shell is /bin/sh, but we often use bashisms such as >& redirection
+            #    executable="/bin/bash",
+            #)
+
+            watchProcessGroup(process.pid)
+            process.stdin.close()
 
-            if return_code < 0:
-                log(log_num, "  Child was terminated by signal %d" % -return_code)
             try:
-                # Makes sure any lingering processes in the process group
-                # are killed
+                return_code = process.wait(timeout, cancel=cancel_event)
+            except (killableprocess.TimeoutExpired, killableprocess.Cancelled) as exception:
+                return_code = exception
+            except KeyboardInterrupt:
+                interrupted = True
                 process.kill()
-            except OSError as e:
-                # Handles the case where the process is already dead
-                if e.errno != errno.ESRCH:
-                    raise
+                raise
+            else:
+                if return_code == 0:
+                    status = True
+
+                if return_code < 0:
+                    log_function(log_num, "  Child was terminated by signal %d" % -return_code)
+                try:
+                    # Makes sure any lingering processes in the process group
+                    # are killed
+                    process.kill()
+                except OSError as e:
+                    # Handles the case where the process is already dead
+                    if e.errno != errno.ESRCH:
+                        raise
+            if usage is not None and process.rusage is not None:
+                usage.update(TestUsage.resourceUsage(process.rusage))
     except OSError as e:
-        log(log_num, "  Execution failed: %s" % e)
+        log_function(log_num, "  Execution failed: %s" % e)
         return_code = 99999
     finally:
         if output_file:
@@ -908,10 +1536,19 @@ def runCmd(
                     pass
 
     curt = time.asctime()
-    log(log_num, "   Completion status: {}, return_code={} ({})".format(status, return_code, curt))
+    log_function(log_num, "   Completion status: {}, return_code={} ({})".format(status, return_code, curt))
+    if usage:
+        log_function(log_num, "   Resource usage: " + TestUsage.usageLine(usage))
     return (status, return_code)
 
 
+def testEnvironment() -> Dict[str, str]:
+    """Return a copy of the environment to run test commands in. See thread_environment."""
+    environment_variables = os.environ.copy()
+    environment_variables.update(getattr(thread_environment, "variables", {}))
+    return environment_variables
+
+
 def log(log_num: int, value):
     """Log value to the log file."""
     logfile[log_num].write(value + "\n")
@@ -990,9 +1627,36 @@ def runUnitTest(
         logTee(log_num, msg + "  FAILED !!!")
         return success, failed, stats
 
+    # TestRunGraph is only imported here, as its concurrent.futures is slow to import.
+    from . import TestRunGraph
+
+    # The RUN commands each RUN command of a PARALLEL_RUN test runs after, see TestRunGraph.
+    after = {}
+    if TestRunGraph.parallelRun(new_config):
+        try:
+            after = TestRunGraph.runDependencies(new_config)
+        except ValueError as e:
+            # A bad RUN_AFTER section fails the test without running any of its commands.
+            logTee(log_num, " ERROR:      %s" % e)
+            stats = {
+                "sub_tests": {},
+                "sub_cmps": {},
+                "run": (0, len(new_config["RUN"])),
+                "cmp": (0, 0),
+                "timed_out": 0,
+                "elapsed_time": time.time() - start_time,
+                "error": str(e),
+            }
+            logTee(log_num, " STATUS:     RUN: 0/%d   CMP: 0/0  FAILED !!!" % len(new_config["RUN"]))
+            return 0, 1, stats
+
     status = True
 
-    environment_variables = os.environ.copy()
+    environment_variables = testEnvironment()
+
+    # export CHILD_TAGS info to the environment so it is available to the test Run
+    environment_variables["DTEST_CHILD_TAGS"] = ",".join(sorted(new_config.get("CHILD_TAGS", [])))
+
     for key, value in new_config.get("ENV", {}).items():
         environment_variables[key] = value
 
@@ -1009,10 +1673,26 @@ def runUnitTest(
 
     sub_tests = {}
     sub_cmps = {}
+    # The time of the phases of the test, see TestTiming.
+    phases: Dict[str, Any] = {"run": {}, "compare": {}}
     run_success = 0
     timed_out = 0
+    # Set if a command was cancelled (see cancel_event), in which case the remaining steps are skipped.
+    cancelled = False
     run_time_comparison_failures = 0
-    for key, cmd in new_config["RUN"].items():
+    cmp_success = 0
+    cmp_total = 0
+
+    # The output files whose truth files have been compared.
+    compared = set()
+
+    # Guards the results above, which the commands of a PARALLEL_RUN test update from several threads.
+    results_lock = threading.Lock()
+
+    def runCommand(key, cmd):
+        """Run the RUN command key and record its results."""
+        nonlocal status, run_success, timed_out, run_time_comparison_failures, cancelled
+
         scmd = stripJunk(cmd)
         if not scmd:
             raise ValueError("Test %s does not a run command defined" % (full_dir))
@@ -1021,8 +1701,7 @@ def runUnitTest(
 
         # The current command being run (can be used by the test program as
         # a tag, eg. usage info output)
-        environment_variables["DTEST_COMMAND"] = key
-        environment_variables["DTEST_CURDIR"] = full_dir
+        command_environment = dict(environment_variables, DTEST_COMMAND=key, DTEST_CURDIR=full_dir)
 
         if (
             gpu_allocation_status != GPUReservationStatus.SUCCESS
@@ -1034,211 +1713,163 @@ def runUnitTest(
         #     rstat = False
         #     return_code = 999999
         # else:
+        usage = {}
+        command_start_time = time.time()
         rstat, return_code = runCmd(
             cmd=cmd,
             args=[],
             cwd=full_dir,
             log_num=log_num,
-            environment_variables=environment_variables,
+            environment_variables=command_environment,
             timeout=int(new_config["TIMEOUT"]),
             shell=shell,
+            usage=usage,
         )
+        command_time = time.time() - command_start_time
 
         if not isinstance(return_code, int):
             return_code_sub = str(return_code)
         else:
             return_code_sub = return_code
 
-        sub_tests[cmd] = {
-            "completion_status": rstat,
-            "return_code": return_code_sub,
-        }
+        with results_lock:
+            phases["run"][key] = command_time
+            sub_tests[cmd] = {
+                "completion_status": rstat,
+                "return_code": return_code_sub,
+            }
+            if usage:
+                sub_tests[cmd]["rusage"] = usage
 
-        if rstat:
-            run_success += 1
-        else:
-            status = False
-        if isinstance(return_code, killableprocess.TimeoutExpired):
-            timed_out += 1
-            # delete_output = False
-        elif return_code == 139:
-            # Possibly a segfault.
-            # delete_output = False
-            pass
-        elif return_code == 10:
-            # This is our custom indicator for comparison failures.
-            run_time_comparison_failures += 1
-            run_success += 1
+            if rstat:
+                run_success += 1
+            else:
+                status = False
+            if isinstance(return_code, killableprocess.Cancelled):
+                cancelled = True
+            elif isinstance(return_code, killableprocess.TimeoutExpired):
+                timed_out += 1
+                # delete_output = False
+            elif return_code == 139:
+                # Possibly a segfault.
+                # delete_output = False
+                pass
+            elif return_code == 10:
+                # This is our custom indicator for comparison failures.
+                run_time_comparison_failures += 1
+                run_success += 1
 
         if parallel_mode:
             logTee(log_num, "   %-15s %-15s exit status - %s" % (relative_path, key, rstat))
         else:
             logTee(log_num, "   %-15s exit status - %s" % (key, rstat))
 
-    suffixes = getSuffixes(new_config)
-    tfiles = truthFiles(suffixes, full_dir=full_dir)
-    # Make a copy to iterate over since we are modifying tfiles as we go
-    tfiles_orig = copy.deepcopy(tfiles)
-
-    cmp_success = 0
-    cmp_total = len(tfiles) + run_time_comparison_failures
-    if "COMPARE" in new_config:
-        for pattern, cmd in new_config["COMPARE"].items():
-            # make a list of all files matching the specified pattern
-            log(log_num, "======")
-            log(log_num, "====== COMPARING %s OUTPUT FILES in %s" % (pattern, relative_path))
-            log(log_num, "======")
-
-            files = set()
-            for filename, truth_suffixes in tfiles_orig.items():
-
-                testable = getTestableFiles(full_dir, filename, truth_suffixes, pattern)
-                files.update(testable)
-
-                # Test the testable files
-                for fname in testable:
-                    num_checked = 0
-                    passed = False
-
-                    for suffix in truth_suffixes:
-                        # NB: truthFiles has already checked for file validity
-                        truth_filename = fname + "." + suffix
-
-                        fullcmd = [cmd[0]]
-                        fullcmd.extend([truth_filename, fname])
-                        cmdstr = " ".join(fullcmd)
-
-                        # make sure that all truth files have been processed
-                        if not os.path.isfile(os.path.join(full_dir, fname)):
-                            log(
-                                log_num,
-                                "  Could not find the "
-                                "'%s' output file for the %s truth file." % (fname, truth_filename),
-                            )
-                            logTee(log_num, "   %-15s missing. comparison  - %s" % (fname, False))
-                            # ??? status = False
-                            print("asdasd")
-                            sub_cmps[cmdstr] = {
-                                "completion_status": False,
-                                "return_code": "%-15s missing." % (fname),
-                            }
-                        else:
-                            rstat, return_code = runCmd(
-                                cmd=cmd[0],
-                                args=[truth_filename, fname],
-                                cwd=full_dir,
-                                log_num=log_num,
-                            )
-
-                            if not isinstance(return_code, int):
-                                return_code_sub = str(return_code)
-                            else:
-                                return_code_sub = return_code
-
-                            sub_cmps[cmdstr] = {
-                                "completion_status": rstat,
-                                "return_code": return_code_sub,
-                            }
-
-                            num_checked += 1
-                            if rstat:
-                                cmp_success += 1
-                                passed = True
-                                if delete_output:
-                                    os.remove(os.path.join(full_dir, fname))
-                            else:
-                                if num_checked == len(truth_suffixes):
-                                    status = False
-
-                            if return_code == -9 and num_checked == len(truth_suffixes):
-                                timed_out += 1
-
-                            if passed or num_checked == len(truth_suffixes):
-                                if parallel_mode:
-                                    logTee(log_num, "   %-15s %-15s comparison  - %s" % (relative_path, fname, rstat))
-                                else:
-                                    logTee(log_num, "   %-15s comparison  - %s" % (fname, rstat))
-                            if passed:
-                                break
-
-                # Remove the COMPARE files from the list of files to check
-                for fn in files:
-                    if fn in tfiles:
-                        del tfiles[fn]
-
-    # Process all the remaining truth files
-    if tfiles:
-        log(log_num, "======")
-        log(log_num, "====== COMPARING REMAINING OUTPUT FILES in %s" % relative_path)
-        log(log_num, "======")
-        cmd = new_config["CMP"]
-
-        for filename, truth_suffixes in tfiles.items():
-            num_checked = 0
-            passed = False
+    def compareOutputs(snapshot, tfiles):
+        """Compare the output files of the truth files tfiles, and record the results."""
+        nonlocal status, timed_out, cmp_success, cmp_total
 
-            for suffix in truth_suffixes:
-                # Note that truthFiles has already checked for file validity
-                truth_filename = filename + "." + suffix
-
-                fullcmd = [cmd[0]]
-                fullcmd.extend([truth_filename, filename])
-                cmdstr = " ".join(fullcmd)
-
-                # make sure that all truth files have been processed
-                if not os.path.isfile(os.path.join(full_dir, filename)):
-                    log(
-                        log_num,
-                        "  Could not find the " "'%s' output file for the %s truth file." % (filename, truth_filename),
-                    )
-                    logTee(log_num, "   %-15s missing. comparison  - %s" % (filename, False))
-                    status = False
-                    sub_cmps[cmdstr] = {
-                        "completion_status": False,
-                        "return_code": "%-15s missing." % (filename),
-                    }
-                else:
-                    rstat, return_code = runCmd(
-                        cmd=cmd[0],
-                        args=[truth_filename, filename],
-                        cwd=full_dir,
-                        log_num=log_num,
-                    )
+        results = compareTruthFiles(
+            new_config=new_config,
+            snapshot=snapshot,
+            tfiles=tfiles,
+            full_dir=full_dir,
+            relative_path=relative_path,
+            log_num=log_num,
+            delete_output=delete_output,
+        )
+        with results_lock:
+            sub_cmps.update(results["sub_cmps"])
+            phases["compare"].update(results["compare_times"])
+            cmp_success += results["cmp_success"]
+            cmp_total += len(tfiles)
+            timed_out += results["timed_out"]
+            if not results["status"]:
+                status = False
+
+    def testUsage():
+        """Return the total resource usage of the commands of the test, see TestUsage."""
+        records = list(sub_tests.values()) + list(sub_cmps.values())
+        return TestUsage.totalUsage(record.get("rusage") for record in records)
 
-                    if not isinstance(return_code, int):
-                        return_code_sub = str(return_code)
-                    else:
-                        return_code_sub = return_code
+    suffixes = getSuffixes(new_config)
 
-                    sub_cmps[cmdstr] = {
-                        "completion_status": rstat,
-                        "return_code": return_code_sub,
+    if TestRunGraph.parallelRun(new_config):
+        dependents = TestRunGraph.dependents(after)
+        # The commands whose RUN_OUTPUTS have not been compared yet.
+        outputs = dict(new_config.get("RUN_OUTPUTS") or {})
+        variables = getattr(thread_environment, "variables", {})
+        finished = set()
+
+        def runAndCompare(key):
+            """Run the RUN command key, and compare the RUN_OUTPUTS that no other command needs anymore."""
+            thread_environment.variables = variables
+            runCommand(key, new_config["RUN"][key])
+            if cancelled:
+                # Stops runGraph from starting the other commands.
+                raise killableprocess.Cancelled()
+
+            with results_lock:
+                finished.add(key)
+                # The outputs of a command may be read by the commands that run after it.
+                done = [k for k in outputs if k in finished and dependents.get(k, set()) <= finished]
+                patterns = [p for k in done for p in getListFromConfig(outputs, k)]
+                for k in done:
+                    del outputs[k]
+
+            if patterns:
+                snapshot = DirectorySnapshot(full_dir)
+                with results_lock:
+                    tfiles = {
+                        f: s
+                        for f, s in snapshot.truthFiles(suffixes).items()
+                        if f not in compared and TestRunGraph.matchesOutputs(f, patterns)
                     }
+                    compared.update(tfiles)
+                compareOutputs(snapshot, tfiles)
 
-                    num_checked += 1
-                    if rstat:
-                        cmp_success += 1
-                        passed = True
-                        if delete_output:
-                            os.remove(os.path.join(full_dir, filename))
-                    else:
-                        if num_checked == len(truth_suffixes):
-                            status = False
-
-                    if return_code == -9 and num_checked == len(truth_suffixes):
-                        timed_out += 1
+        try:
+            TestRunGraph.runGraph(
+                list(new_config["RUN"]), after, TestRunGraph.commandSlots(new_config), runAndCompare
+            )
+        except killableprocess.Cancelled:
+            pass
+    else:
+        for key, cmd in new_config["RUN"].items():
+            runCommand(key, cmd)
+            if cancelled:
+                break
+
+    if cancelled:
+        # The outputs are incomplete, so they are neither compared nor deleted.
+        logTee(
+            log_num,
+            " STATUS:     RUN: %d/%d   CMP: %d/%d  CANCELLED"
+            % (run_success, len(new_config["RUN"]), cmp_success, cmp_total),
+        )
+        stats = {
+            "sub_tests": sub_tests,
+            "sub_cmps": sub_cmps,
+            "run": (run_success, len(new_config["RUN"])),
+            "cmp": (cmp_success, cmp_total),
+            "timed_out": timed_out,
+            "elapsed_time": time.time() - start_time,
+            "rusage": testUsage(),
+            "phases": phases,
+            "cancelled": True,
+        }
+        return 0, 0, stats
 
-                    if passed or num_checked == len(truth_suffixes):
-                        if parallel_mode:
-                            logTee(log_num, "   %-15s %-15s comparison  - %s" % (relative_path, filename, rstat))
-                        else:
-                            logTee(log_num, "   %-15s comparison  - %s" % (filename, rstat))
-                    if passed:
-                        break
+    # List the directory once now that the RUN commands have produced their
+    # output, and match all the truth files against that listing.
+    snapshot = DirectorySnapshot(full_dir)
+    tfiles = {f: s for f, s in snapshot.truthFiles(suffixes).items() if f not in compared}
+    compareOutputs(snapshot, tfiles)
+    cmp_total += run_time_comparison_failures
 
     # Only delete files if there are no errors. The user may want to examine
     # the files in cases of error.
     if status and new_config.get("DELETE", []):
+        cleanup_start_time = time.time()
         files = []
         for root, dirs, sfiles in os.walk(full_dir):
             files.extend([os.path.join(root, f) for f in sfiles])
@@ -1255,6 +1886,11 @@ def runUnitTest(
                     os.remove(f)
                 except OSError as os_error:
                     print(os_error)
+        phases["cleanup"] = time.time() - cleanup_start_time
+
+    usage = testUsage()
+    if usage:
+        log(log_num, " USAGE:      " + TestUsage.usageLine(usage))
 
     # set the success, failed variables
     msg = " STATUS:     RUN: %d/%d   CMP: %d/%d" % (
@@ -1278,11 +1914,242 @@ def runUnitTest(
         "cmp": (cmp_success, cmp_total),
         "timed_out": timed_out,
         "elapsed_time": time.time() - start_time,
+        "rusage": usage,
+        "phases": phases,
     }
 
     return success, failed, stats
 
 
+def compareTruthFiles(
+    new_config, snapshot: DirectorySnapshot, tfiles, full_dir, relative_path, log_num, delete_output=False
+):
+    """Compare the output files of the truth files tfiles (see truthFiles) in snapshot.
+
+    The files matching a COMPARE pattern are compared with its program, the
+    others with CMP. Up to compare_jobs files are compared at once, and the
+    log is written in the same order as when comparing them one by one.
+    Returns a dictionary with the "sub_cmps" results, the "cmp_success" and
+    "timed_out" counts, the overall "status", and the "compare_times" of the
+    output files.
+    """
+    # Make a copy to iterate over since we are modifying tfiles as we go
+    tfiles_orig = dict(tfiles)
+    tfiles = dict(tfiles)
+
+    # The log headers (lists of lines) and the comparisons, in the order of the log.
+    steps: List[Union[List[str], ComparisonStep]] = []
+    if "COMPARE" in new_config:
+        for pattern, cmd in new_config["COMPARE"].items():
+            # make a list of all files matching the specified pattern
+            steps.append(["======", "====== COMPARING %s OUTPUT FILES in %s" % (pattern, relative_path), "======"])
+
+            files = set()
+            for filename in sorted(tfiles_orig):
+                truth_suffixes = tfiles_orig[filename]
+                testable = snapshot.testableFiles(filename, truth_suffixes, pattern)
+                files.update(testable)
+
+                # Test the testable files
+                for fname in sorted(testable):
+                    steps.append(ComparisonStep(fname, truth_suffixes, cmd[0], missing_fails=False))
+
+            # Remove the COMPARE files from the list of files to check
+            for fn in files:
+                tfiles.pop(fn, None)
+
+    # Process all the remaining truth files
+    if tfiles:
+        steps.append(["======", "====== COMPARING REMAINING OUTPUT FILES in %s" % relative_path, "======"])
+        cmd = new_config["CMP"]
+        for filename in sorted(tfiles):
+            steps.append(ComparisonStep(filename, tfiles[filename], cmd[0], missing_fails=True))
+
+    # The comparisons of the same output file run one after the other, in one job,
+    # since a passing comparison may delete the file.
+    jobs: Dict[str, List[ComparisonStep]] = {}
+    for step in steps:
+        if isinstance(step, ComparisonStep):
+            jobs.setdefault(step.filename, []).append(step)
+
+    def compareFile(file_steps, variables):
+        """Run the comparisons of one output file."""
+        thread_environment.variables = variables
+        for step in file_steps:
+            step.run(snapshot=snapshot, full_dir=full_dir, relative_path=relative_path, delete_output=delete_output)
+
+    variables = getattr(thread_environment, "variables", {})
+    if compare_jobs > 1 and len(jobs) > 1:
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(compare_jobs, len(jobs)), thread_name_prefix="dtest-compare"
+        ) as executor:
+            for future in [executor.submit(compareFile, file_steps, variables) for file_steps in jobs.values()]:
+                future.result()
+    else:
+        for file_steps in jobs.values():
+            compareFile(file_steps, variables)
+
+    status = True
+    sub_cmps = {}
+    compare_times: Dict[str, float] = {}
+    timed_out = 0
+    cmp_success = 0
+    for step in steps:
+        if not isinstance(step, ComparisonStep):
+            for line in step:
+                log(log_num, line)
+            continue
+
+        for tee, line in step.messages:
+            if tee:
+                logTee(log_num, line)
+            else:
+                log(log_num, line)
+        sub_cmps.update(step.sub_cmps)
+        compare_times[step.filename] = compare_times.get(step.filename, 0.0) + step.elapsed_time
+        cmp_success += step.cmp_success
+        timed_out += step.timed_out
+        if step.failed:
+            status = False
+
+    return {
+        "sub_cmps": sub_cmps,
+        "cmp_success": cmp_success,
+        "timed_out": timed_out,
+        "status": status,
+        "compare_times": compare_times,
+    }
+
+
+class ComparisonStep:
+    """Comparison of an output file with its truth files, the first of which that matches passes.
+
+    run records the results and the log messages in the step, so that steps
+    run on different threads can be logged in order.
+
+    Parameters
+    ----------
+    filename : str
+        The output file, relative to the test directory.
+    truth_suffixes : List[str]
+        The suffixes of its truth files, in the order they are tried.
+    cmd : str
+        The compare program.
+    missing_fails : bool
+        If True, a missing output file fails the test.
+    """
+
+    def __init__(self, filename: str, truth_suffixes: List[str], cmd: str, missing_fails: bool):
+        self.filename = filename
+        self.truth_suffixes = truth_suffixes
+        self.cmd = cmd
+        self.missing_fails = missing_fails
+
+        # (tee, line) pairs to log, see logTee.
+        self.messages: List[Tuple[bool, str]] = []
+        self.sub_cmps: Dict[str, Dict[str, Any]] = {}
+        self.cmp_success = 0
+        self.timed_out = 0
+        self.failed = False
+        # Seconds taken by run.
+        self.elapsed_time = 0.0
+
+    def record(self, value: str, tee: bool = False):
+        """Record value for the log, and for stdout if tee is True."""
+        self.messages.append((tee, value))
+
+    def run(self, snapshot: DirectorySnapshot, full_dir: str, relative_path: str, delete_output: bool):
+        """Compare the output file."""
+        start_time = time.time()
+        try:
+            self._compare(snapshot, full_dir, relative_path, delete_output)
+        finally:
+            self.elapsed_time += time.time() - start_time
+
+    def _compare(self, snapshot: DirectorySnapshot, full_dir: str, relative_path: str, delete_output: bool):
+        """Compare the output file. See run."""
+        fname = self.filename
+        num_checked = 0
+        passed = False
+
+        for suffix in self.truth_suffixes:
+            # NB: truthFiles has already checked for file validity
+            truth_filename = fname + "." + suffix
+
+            fullcmd = [self.cmd]
+            fullcmd.extend([truth_filename, fname])
+            cmdstr = " ".join(fullcmd)
+
+            # make sure that all truth files have been processed
+            if not snapshot.isfile(fname):
+                self.record("  Could not find the " "'%s' output file for the %s truth file." % (fname, truth_filename))
+                self.record("   %-15s missing. comparison  - %s" % (fname, False), tee=True)
+                if self.missing_fails:
+                    self.failed = True
+                self.sub_cmps[cmdstr] = {
+                    "completion_status": False,
+                    "return_code": "%-15s missing." % (fname),
+                }
+            else:
+                # dtest's own compare programs are run in process, see TestComparators.
+                from . import TestComparators
+
+                before = TestUsage.threadUsage()
+                return_code = TestComparators.compareInProcess(
+                    self.cmd, [truth_filename, fname], full_dir, testEnvironment()
+                )
+                if return_code is not None:
+                    rstat = return_code == 0
+                    usage = TestUsage.threadUsageSince(before)
+                    self.record("* Compared '%s' in process in %s at %s" % (cmdstr, full_dir, time.asctime()))
+                    self.record("   Completion status: {}, return_code={}".format(rstat, return_code))
+                else:
+                    usage = {}
+                    rstat, return_code = runCmd(
+                        cmd=self.cmd,
+                        args=[truth_filename, fname],
+                        cwd=full_dir,
+                        log_num=None,
+                        log_function=lambda _, value: self.record(value),
+                        usage=usage,
+                    )
+
+                if not isinstance(return_code, int):
+                    return_code_sub = str(return_code)
+                else:
+                    return_code_sub = return_code
+
+                self.sub_cmps[cmdstr] = {
+                    "completion_status": rstat,
+                    "return_code": return_code_sub,
+                }
+                if usage:
+                    self.sub_cmps[cmdstr]["rusage"] = usage
+
+                num_checked += 1
+                if rstat:
+                    self.cmp_success += 1
+                    passed = True
+                    if delete_output:
+                        snapshot.remove(fname)
+                else:
+                    if num_checked == len(self.truth_suffixes):
+                        self.failed = True
+
+                if return_code == -9 and num_checked == len(self.truth_suffixes):
+                    self.timed_out += 1
+
+                if passed or num_checked == len(self.truth_suffixes):
+                    if parallel_mode:
+                        self.record("   %-15s %-15s comparison  - %s" % (relative_path, fname, rstat), tee=True)
+                    else:
+                        self.record("   %-15s comparison  - %s" % (fname, rstat), tee=True)
+                if passed:
+                    break
+
+
 def getDiffSelection(new, old, suffixes):
     """Get user's selection of diff type for CHECK mode."""
     val = ""
@@ -1358,8 +2225,9 @@ def runUnitCmp(new_config, full_dir, root_dir, truth_suffix: Union[str, List[str
     print("=========================================")
 
     # make a list of all the "orig"
+    snapshot = DirectorySnapshot(full_dir)
     suffixes = getSuffixes(new_config)
-    tfiles = truthFiles(suffixes, full_dir=full_dir)
+    tfiles = snapshot.truthFiles(suffixes)
 
     # run the validation checks
     if "COMPARE" in new_config:
@@ -1368,15 +2236,13 @@ def runUnitCmp(new_config, full_dir, root_dir, truth_suffix: Union[str, List[str
             files = set()
 
             for filename, truth_suffixes in tfiles.items():
-                files.update(getTestableFiles(full_dir, filename, truth_suffixes, pattern))
+                files.update(snapshot.testableFiles(filename, truth_suffixes, pattern))
 
             for filename in files:
                 available_suffixes = []
                 for suffix in suffixes:
                     truth_filename = filename + "." + suffix
-                    if os.path.isfile(os.path.join(full_dir, truth_filename)) and os.path.isfile(
-                        os.path.join(full_dir, filename)
-                    ):
+                    if snapshot.isfile(truth_filename) and snapshot.isfile(filename):
                         available_suffixes.append(suffix)
                 # print('MMM', filename, available_suffixes)
                 for suffix in available_suffixes:
@@ -1408,9 +2274,7 @@ def runUnitCmp(new_config, full_dir, root_dir, truth_suffix: Union[str, List[str
             available_suffixes = []
             for ts in suffixes:
                 truth_filename = filename + "." + ts
-                if os.path.isfile(os.path.join(full_dir, truth_filename)) and os.path.isfile(
-                    os.path.join(full_dir, filename)
-                ):
+                if snapshot.isfile(truth_filename) and snapshot.isfile(filename):
                     available_suffixes.append(ts)
 
             for ts in available_suffixes:
@@ -1543,11 +2407,18 @@ def interactiveDiff(filename, truth_filename, diff_cmds, test_name, full_dir, lo
 
 
 def getListFromConfig(config, key):
-    """Return list with key in config."""
+    """Return list with key in config.
+
+    Works for ConfigObj sections as well as plain dictionaries.
+
+    """
     try:
-        return config.as_list(key)
+        result = config[key]
     except KeyError:
         return []
+    if isinstance(result, (tuple, list)):
+        return list(result)
+    return [result]
 
 
 def findTests(
@@ -1561,6 +2432,7 @@ def findTests(
     quarantined: bool = False,
     previous_config: bool = None,
     parallel_mode: bool = False,
+    index=None,
 ):
     """
     Find and generate all test subdirectories.
@@ -1579,21 +2451,34 @@ def findTests(
         Whether to generate the list in parallel_mode or not. If True, then
         this looks for the "SERIAL" tag in configs, and groups them together
         into a sub-list if True.
+    index : Optional[TestIndex.DiscoveryIndex]
+        If given, the directory listings and the discovery related config
+        values are taken from this index instead of the file system. The
+        configs passed down the tree are then the reduced discovery configs
+        of the index.
     """
     assert test_mode in ("REGULAR", "QUARANTINE", "ALL")
 
-    # If no config has been specified, then we are at the start directory. Get
-    # a default config by processing ones in the parent directory tree find.
-    if not previous_config:
-        previous_config = getDefaultConfig(full_dir, truth_suffix)
+    if index is not None:
+        if not previous_config:
+            previous_config = index.getDefaultConfig(full_dir)
 
-    # Load any local config that may exist, or use the ones.
-    new_config = getLocalConfig(previous_config, full_dir=full_dir, truth_suffix=truth_suffix)
-    if not new_config:
-        return
+        new_config, subtests = index.getLocalConfig(previous_config, full_dir)
+        if not new_config:
+            return
+    else:
+        # If no config has been specified, then we are at the start directory. Get
+        # a default config by processing ones in the parent directory tree find.
+        if not previous_config:
+            previous_config = getDefaultConfig(full_dir, truth_suffix)
+
+        # Load any local config that may exist, or use the ones.
+        new_config = getLocalConfig(previous_config, full_dir=full_dir, truth_suffix=truth_suffix)
+        if not new_config:
+            return
 
-    # Get list of local test directories.
-    subtests = set([x for x in os.listdir(full_dir) if isTestDir(os.path.join(full_dir, x))])
+        # Get list of local test directories.
+        subtests = set([x for x in os.listdir(full_dir) if isTestDir(os.path.join(full_dir, x))])
 
     # List of test cases to skip.
     skiptests = getListFromConfig(new_config, "SKIPTESTS")
@@ -1628,6 +2513,7 @@ def findTests(
                     quarantined=quarantined,
                     previous_config=previous_config,
                     parallel_mode=False,
+                    index=index,
                 )
             ]
             return
@@ -1656,7 +2542,10 @@ def findTests(
             # sub-directory, then we have to get the configs from
             # the intermediate directories
             if re.match(".*/.", testdir):
-                config = getDefaultConfig(subtest_path, truth_suffix)
+                if index is not None:
+                    config = index.getDefaultConfig(subtest_path)
+                else:
+                    config = getDefaultConfig(subtest_path, truth_suffix)
             else:
                 config = new_config
 
@@ -1671,6 +2560,7 @@ def findTests(
                 quarantined=quarantined or test_is_quarantined,
                 previous_config=config,
                 parallel_mode=parallel_mode,
+                index=index,
             ):
                 yield t
     else:
@@ -1731,14 +2621,26 @@ def dispatchTest(
     log_num,
     shell="/bin/bash",
     delete_output=True,
+    config=None,
 ) -> Tuple[int, int, Dict[str, Dict[str, Any]]]:
-    """Dispatch the tests in the directory."""
-    # If no config has been specified, then we are at the start directory. Get
-    # a default config by processing ones in the parent directory tree find.
-    previous_config = getDefaultConfig(full_dir, truth_suffix)
+    """Dispatch the tests in the directory.
+
+    If config is given (e.g., from an execution plan), it is used instead of
+    resolving the config files of the directory.
+    """
+    # The time of the phases before runUnitTest, see TestTiming.
+    phases = {}
+    if config is not None:
+        new_config = config
+    else:
+        config_start_time = time.time()
+        # If no config has been specified, then we are at the start directory. Get
+        # a default config by processing ones in the parent directory tree find.
+        previous_config = getDefaultConfig(full_dir, truth_suffix)
 
-    # Load any local config that may exist, or use the ones.
-    new_config = getLocalConfig(previous_config, full_dir=full_dir, truth_suffix=truth_suffix)
+        # Load any local config that may exist, or use the ones.
+        new_config = getLocalConfig(previous_config, full_dir=full_dir, truth_suffix=truth_suffix)
+        phases["config"] = time.time() - config_start_time
     if not new_config:
         sys.stderr.write("Unable to get test configuration data in {d} directory.".format(d=full_dir))
         return (0, 0, {})
@@ -1760,7 +2662,7 @@ def dispatchTest(
             shell=shell,
         )
     else:
-        new_config["TIMEOUT"] = str(int(scale_timeout * int(new_config["TIMEOUT"])))
+        new_config = new_config.replace(TIMEOUT=str(int(scale_timeout * int(new_config["TIMEOUT"]))))
 
         @contextlib.contextmanager
         def awaitGpuMem(gpu_mem_needed: str, timeout: float = 1800.0):
@@ -1803,14 +2705,14 @@ def dispatchTest(
 
                 # Ensure the graphics card has enough total memory reserved for testing to support this test
                 memory_needed = int(float(match.groups()[0]) * scale)
-                if memory_needed > total_gpu_memory:
+                if memory_needed > totalGpuMemory():
                     sys.stderr.write(
                         f"The desired memory for test {full_dir} is too large. Requested: '{memory_needed}' Total avaiable: '{getGPUMemTotal()}'"
                     )
                     return memory_allocated, GPUReservationStatus.TOO_MUCH_MEMORY, 0
 
                 # Caculate the maximum value the shared_gpu_mem can have based on the ratio
-                memory_shared_needed = total_gpu_memory * gpu_memory_ratio - memory_needed
+                memory_shared_needed = totalGpuMemory() * gpu_memory_ratio - memory_needed
                 total_time = 0
                 while total_time < timeout:
                     if gpu_mem_usage.value < memory_shared_needed:
@@ -1842,11 +2744,28 @@ def dispatchTest(
                     with gpu_mem_usage.get_lock():
                         gpu_mem_usage.value -= memory_needed
 
-        resources = new_config.get("RESOURCES", {})
-        gpu_mem = resources.get("GPU_MEM", None)
-        if has_cuda and gpu_mem is not None:
-            # GPU_MEM was specified. Check that we have enough available before running the test.
-            with awaitGpuMem(gpu_mem) as allocation_status:
+        # Sample the processes of the test, see --monitor.
+        monitored = resource_monitor.test(full_dir) if resource_monitor is not None else contextlib.nullcontext()
+        with monitored as samples:
+            resources = new_config.get("RESOURCES", {})
+            gpu_mem = resources.get("GPU_MEM", None)
+            if has_cuda and gpu_mem is not None:
+                # GPU_MEM was specified. Check that we have enough available before running the test.
+                gpu_wait_start_time = time.time()
+                with awaitGpuMem(gpu_mem) as allocation_status:
+                    phases["gpu_wait"] = time.time() - gpu_wait_start_time
+                    success, failed, stats = runUnitTest(
+                        new_config=new_config,
+                        full_dir=full_dir,
+                        root_dir=common_directory,
+                        test_command_modifier=test_command_modifier,
+                        truth_suffix=truth_suffix,
+                        log_num=log_num,
+                        shell=shell,
+                        delete_output=delete_output,
+                        gpu_allocation_status=allocation_status,
+                    )
+            else:
                 success, failed, stats = runUnitTest(
                     new_config=new_config,
                     full_dir=full_dir,
@@ -1856,19 +2775,7 @@ def dispatchTest(
                     log_num=log_num,
                     shell=shell,
                     delete_output=delete_output,
-                    gpu_allocation_status=allocation_status,
                 )
-        else:
-            success, failed, stats = runUnitTest(
-                new_config=new_config,
-                full_dir=full_dir,
-                root_dir=common_directory,
-                test_command_modifier=test_command_modifier,
-                truth_suffix=truth_suffix,
-                log_num=log_num,
-                shell=shell,
-                delete_output=delete_output,
-            )
 
         relative_path = full_dir.replace(os.path.commonprefix([full_dir, common_directory]), "").lstrip("/")
         if relative_path == "":
@@ -1885,6 +2792,17 @@ def dispatchTest(
                 "elapsed_time": stats["elapsed_time"],
             }
         }
+        if stats.get("rusage"):
+            test_data[relative_path]["rusage"] = stats["rusage"]
+        phases.update((phase, value) for phase, value in stats.get("phases", {}).items() if value != {})
+        test_data[relative_path]["phases"] = phases
+        if samples is not None:
+            test_data[relative_path]["peaks"] = samples.peaks()
+        if stats.get("cancelled"):
+            test_data[relative_path]["cancelled"] = True
+        if stats.get("error"):
+            # Listed with the failed test, see DtestCommon.failureLine.
+            test_data[relative_path]["error"] = stats["error"]
 
         # Show interactive diffs if requested.
         if interactive:
@@ -1952,19 +2870,7 @@ def getSuffixes(config, additional_suffixes: Optional[Union[str, List[str]]] = N
 
 def getTestableFiles(full_dir, filename, truth_suffixes, pattern=None):
     """Get all testable files in full_dir"""
-    if pattern:
-        matches = set([f for f in os.listdir(full_dir) if re.match(pattern, f)])
-    else:
-        matches = set([f for f in os.listdir(full_dir)])
-
-    # See if the potential matching files end with a truth suffix
-    testable = set()
-    for ts in truth_suffixes:
-        for f in matches:
-            if os.path.isfile(os.path.join(full_dir, f + "." + ts)) and f.startswith(filename):
-                testable.update([f])
-
-    return testable
+    return DirectorySnapshot(full_dir).testableFiles(filename, truth_suffixes, pattern)
 
 
 class LockException(Exception):
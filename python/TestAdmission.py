@@ -0,0 +1,565 @@
+"""Admission control for tests run in parallel.
+
+The workers of the pool ask the AdmissionController for the resources of a
+test before running it, and give them back when the test is done. The
+resources are declared in the RESOURCES section of the test config:
+
+    [RESOURCES]
+    CPUS = 8
+    MEM = 20GB
+    LICENSES = 1
+
+CPUS defaults to 1 and MEM to 0. Any other name (except GPU_MEM, which is
+handled by dispatchTest) is a named counter. The LOCKS of a test, e.g.,
+
+    LOCKS = display, shared-db
+
+are named counters of which the test needs one. A test is only started once all
+of its resources fit in what is left of the capacities, so tests of
+different sizes are packed onto the node as they fit, and a waiting test is
+started as soon as enough resources are given back. A test that needs more
+than the capacity of a resource is run once nothing else is running. Waiting
+tests are started in the order in which they asked for resources, and the
+resources of workers that died are given back (see AdmissionController).
+
+The capacities are:
+
+* CPUS: the CPUs dtest may run on (sched_getaffinity), limited by any cgroup
+  CPU quota (cpu.max for cgroup v2, cpu.cfs_quota_us for cgroup v1), scaled
+  by --max-load-saturation.
+* MEM: the physical memory, limited by any cgroup memory limit.
+* Named counters: 1, i.e., the tests using a counter (or holding a lock) run
+  one at a time.
+
+Each capacity can be overridden with --resource NAME=AMOUNT.
+
+Optionally, the CPU pressure stall information of the kernel
+(/proc/pressure/cpu) is used as feedback: while the share of time in which
+some task was waiting for a CPU is above --max-cpu-pressure, no new test is
+started unless none is running. Since the kernel only updates the pressure
+averages every few seconds, the pressure is re-checked every
+PRESSURE_INTERVAL seconds while tests are waiting.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import contextlib
+import ctypes
+import math
+import multiprocessing
+import multiprocessing.sharedctypes
+import os
+import re
+import time
+
+from Dutils.typing import Dict, Iterator, List, Optional, Tuple
+
+# Seconds between checks of the CPU pressure while tests are held back.
+PRESSURE_INTERVAL = 0.5
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PRESSURE_FILE = "/proc/pressure/cpu"
+MEMINFO_FILE = "/proc/meminfo"
+
+# Built-in resources.
+CPUS = "CPUS"
+MEM = "MEM"
+
+# Resources that are not handled by the AdmissionController.
+IGNORED_RESOURCES = ("GPU_MEM",)
+
+# Capacity of named counters that are not given with --resource.
+DEFAULT_CAPACITY = 1.0
+
+# Size of the shared table of resources.
+MAX_RESOURCES = 64
+MAX_NAME_LENGTH = 63
+
+# Default size of the shared table of the tests waiting for or holding resources. See AdmissionController.
+DEFAULT_MAX_GRANTS = 64
+
+# Seconds between checks for the resources of workers that died, while tests are waiting.
+RECLAIM_INTERVAL = 1.0
+
+_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def cpuCapacity() -> float:
+    """Return the number of CPUs available to this process, taking cgroup CPU quotas into account."""
+    try:
+        capacity = float(len(os.sched_getaffinity(0)))
+    except AttributeError:
+        capacity = float(os.cpu_count() or 1)
+
+    quota = cgroupCpuQuota()
+    if quota is not None:
+        capacity = min(capacity, quota)
+    return max(capacity, 1.0)
+
+
+def memoryCapacity() -> float:
+    """Return the physical memory available to this process in bytes, taking cgroup memory limits into account."""
+    capacity = float("inf")
+    try:
+        with open(MEMINFO_FILE, "r") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    capacity = float(parseAmount(line.split(":", 1)[1].replace(" ", "")))
+                    break
+    except (IOError, OSError, ValueError):
+        pass
+
+    limit = cgroupMemoryLimit()
+    if limit is not None:
+        capacity = min(capacity, limit)
+    return capacity
+
+
+def cgroupCpuQuota() -> Optional[float]:
+    """Return the CPU quota of the cgroup of this process in CPUs, or None if there is none.
+
+    The quotas of the parent cgroups apply as well, so the smallest one is returned.
+    """
+    quotas = []
+    for version, cgroup_dir in _cgroupDirs("cpu"):
+        if version == 2:
+            quotas.append(_readCpuMax(os.path.join(cgroup_dir, "cpu.max")))
+        else:
+            quotas.append(
+                _readCfsQuota(
+                    os.path.join(cgroup_dir, "cpu.cfs_quota_us"), os.path.join(cgroup_dir, "cpu.cfs_period_us")
+                )
+            )
+
+    quotas = [q for q in quotas if q is not None]
+    return min(quotas) if quotas else None
+
+
+def cgroupMemoryLimit() -> Optional[float]:
+    """Return the memory limit of the cgroup of this process in bytes, or None if there is none."""
+    limits = []
+    for version, cgroup_dir in _cgroupDirs("memory"):
+        filename = os.path.join(cgroup_dir, "memory.max" if version == 2 else "memory.limit_in_bytes")
+        try:
+            with open(filename, "r") as f:
+                limits.append(float(f.read().strip()))
+        except (IOError, OSError, ValueError):
+            # Missing, or "max".
+            pass
+
+    return min(limits) if limits else None
+
+
+def _cgroupDirs(controller: str) -> Iterator[Tuple[int, str]]:
+    """Yield (cgroup version, directory) of the cgroups of this process and their parents for controller."""
+    try:
+        with open("/proc/self/cgroup", "r") as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return
+
+    for line in lines:
+        hierarchy, controllers, path = line.split(":", 2)
+        if hierarchy == "0" and not controllers:
+            for cgroup_dir in _parentDirs(CGROUP_ROOT, path):
+                yield 2, cgroup_dir
+        elif controller in controllers.split(","):
+            for mount in sorted({controller, controllers, "cpu,cpuacct" if controller == "cpu" else controller}):
+                for cgroup_dir in _parentDirs(os.path.join(CGROUP_ROOT, mount), path):
+                    yield 1, cgroup_dir
+
+
+def _parentDirs(mount: str, path: str) -> Iterator[str]:
+    """Yield the directory of the cgroup path under mount and those of its parents."""
+    path = path.strip("/")
+    while True:
+        yield os.path.join(mount, path) if path else mount
+        if not path:
+            return
+        path = os.path.dirname(path)
+
+
+def _readCpuMax(filename: str) -> Optional[float]:
+    """Return the quota in a cgroup v2 cpu.max file in CPUs, or None if it is unlimited or missing."""
+    try:
+        with open(filename, "r") as f:
+            quota, period = f.read().split()[:2]
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _readCfsQuota(quota_file: str, period_file: str) -> Optional[float]:
+    """Return the quota of a cgroup v1 cpu controller in CPUs, or None if it is unlimited or missing."""
+    try:
+        with open(quota_file, "r") as f:
+            quota = int(f.read())
+        with open(period_file, "r") as f:
+            period = int(f.read())
+        if quota <= 0 or period <= 0:
+            return None
+        return quota / period
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def cpuPressure() -> Optional[float]:
+    """Return the percentage of the last 10 seconds in which some task waited for a CPU.
+
+    Returns None if the kernel does not provide pressure stall information.
+    """
+    try:
+        with open(PRESSURE_FILE, "r") as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == "some":
+                    return float(dict(field.split("=", 1) for field in fields[1:])["avg10"])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def parseAmount(value: str) -> float:
+    """Return the amount in a resource declaration, e.g., "4", "0.5" or "20GB" (in bytes)."""
+    match = re.match(r"^\s*(\d*\.?\d+)\s*([kmgtKMGT]?)[bB]?\s*$", str(value))
+    if match is None:
+        raise ValueError("Invalid resource amount '{}'".format(value))
+    return float(match.group(1)) * _UNITS[match.group(2).lower()]
+
+
+def checkName(name: str):
+    """Raise ValueError if name cannot be the name of a resource in the shared table."""
+    encoded = name.encode("utf-8")
+    if not encoded or len(encoded) > MAX_NAME_LENGTH:
+        raise ValueError("Invalid resource name '{}'; names have 1 to {} bytes".format(name, MAX_NAME_LENGTH))
+
+
+def resourceDemand(resources: Optional[Dict[str, str]], locks: Optional[List[str]] = None) -> Dict[str, float]:
+    """Return the resources a test needs, from the RESOURCES section and the LOCKS of its config.
+
+    A lock is a named counter of which the test needs one. Its name must not be
+    that of a built-in resource, or one in the RESOURCES of the test.
+    Raises ValueError for invalid declarations.
+    """
+    demand = {CPUS: 1.0}
+    for name, value in (resources or {}).items():
+        if name in IGNORED_RESOURCES:
+            continue
+        checkName(name)
+        demand[name] = parseAmount(value)
+    for name in locks or []:
+        checkName(name)
+        if name in (CPUS, MEM) + IGNORED_RESOURCES or name in (resources or {}):
+            raise ValueError("Invalid lock '{}'; it is the name of a resource".format(name))
+        demand[name] = 1.0
+
+    if len(demand) > MAX_RESOURCES:
+        raise ValueError("More than {} resources and locks".format(MAX_RESOURCES))
+    return demand
+
+
+def parseCapacities(specs: List[str]) -> Dict[str, float]:
+    """Return the capacities given as NAME=AMOUNT strings, e.g., on the command line."""
+    capacities = {}
+    for spec in specs:
+        for item in spec.split(","):
+            name, sep, value = item.partition("=")
+            if not sep or not name.strip():
+                raise ValueError("Invalid resource capacity '{}'; expected NAME=AMOUNT".format(item))
+            capacities[name.strip()] = parseAmount(value)
+    return capacities
+
+
+class _Resource(ctypes.Structure):
+    _fields_ = [("name", ctypes.c_char * (MAX_NAME_LENGTH + 1)), ("capacity", ctypes.c_double), ("used", ctypes.c_double)]
+
+
+class _Grant(ctypes.Structure):
+    """A test that waits for (held is False) or holds resources, by their index in the table of resources.
+
+    A ticket of 0 marks a free entry. The tickets give the order in which the tests asked for the resources.
+    """
+
+    _fields_ = [
+        ("ticket", ctypes.c_longlong),
+        ("pid", ctypes.c_int),
+        ("start_time", ctypes.c_ulonglong),
+        ("held", ctypes.c_bool),
+        ("count", ctypes.c_int),
+        ("resources", ctypes.c_int * MAX_RESOURCES),
+        ("amounts", ctypes.c_double * MAX_RESOURCES),
+    ]
+
+
+class _Taken(dict):
+    """The resources taken by acquire, with the index of their grant in the table of grants."""
+
+    def __init__(self, taken: Dict[str, float], index: int):
+        dict.__init__(self, taken)
+        self.index = index
+
+
+def processStartTime(pid: int) -> Optional[int]:
+    """Return the start time of process pid in clock ticks after boot, or None if it cannot be read.
+
+    Returns 0 if the process has exited, but has not been waited for yet.
+    """
+    try:
+        with open("/proc/{}/stat".format(pid), "r") as f:
+            # The command name may contain spaces, so the fields are counted from its end.
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (IOError, OSError, IndexError):
+        return None
+
+    try:
+        return 0 if fields[0] in ("Z", "X") else int(fields[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def processAlive(pid: int, start_time: int) -> bool:
+    """Return True if process pid is running, and is the one that started at start_time (if not 0)."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The pid is used by a process of another user.
+        return False
+
+    current_start_time = processStartTime(pid)
+    if current_start_time is None:
+        # No /proc, so only the pid can be checked.
+        return True
+    return current_start_time != 0 and (not start_time or current_start_time == start_time)
+
+
+class AdmissionController(object):
+    """Ledger of the resources in use by the workers of a multiprocessing pool.
+
+    Create it before the pool, so the workers inherit it, and set the capacities
+    with configure. max_grants is the number of tests that may wait for or hold
+    resources at once, i.e., at least the number of workers.
+
+    The tests are admitted in the order in which they asked for resources: the
+    resources of the tests that have waited longer are set aside for them, so a
+    test that needs many resources is not starved by smaller tests that keep
+    taking the free ones. Smaller tests still start next to it when there are
+    enough resources for both.
+
+    The resources of a test are given back by release. If a worker dies while
+    it waits for or holds resources, e.g., it segfaults or is killed, the
+    waiting tests give them back for it, checking for dead workers every
+    RECLAIM_INTERVAL seconds while they wait.
+    """
+
+    def __init__(self, max_grants: int = DEFAULT_MAX_GRANTS):
+        self._active = multiprocessing.Value("i", 0, lock=False)
+        self._max_pressure = multiprocessing.Value("d", 0.0, lock=False)
+        self._next_ticket = multiprocessing.Value("q", 1, lock=False)
+        self._last_reclaim = multiprocessing.Value("d", 0.0, lock=False)
+        self._resources = multiprocessing.sharedctypes.RawArray(_Resource, MAX_RESOURCES)
+        self._grants = multiprocessing.sharedctypes.RawArray(_Grant, max(1, max_grants))
+        self._condition = multiprocessing.Condition()
+        self._resource(CPUS).capacity = max(1, int(cpuCapacity()))
+        self._resource(MEM).capacity = memoryCapacity()
+
+    def configure(
+        self,
+        max_load_saturation: float,
+        max_cpu_pressure: Optional[float] = None,
+        capacities: Optional[Dict[str, float]] = None,
+    ):
+        """Set the capacities and the CPU pressure limit (None to ignore the pressure).
+
+        The CPUS capacity is the CPU capacity scaled by max_load_saturation, unless it is
+        given in capacities.
+        """
+        with self._condition:
+            self._resource(CPUS).capacity = max(1, int(math.floor(cpuCapacity() * max_load_saturation)))
+            self._resource(MEM).capacity = memoryCapacity()
+            for name, capacity in (capacities or {}).items():
+                self._resource(name).capacity = capacity
+            self._max_pressure.value = max_cpu_pressure if max_cpu_pressure is not None else 0.0
+            self._condition.notify_all()
+
+    @property
+    def slots(self) -> int:
+        """The number of tests with the default resources that may run at once."""
+        return int(self.capacity(CPUS))
+
+    @property
+    def active(self) -> int:
+        """The number of tests running."""
+        return self._active.value
+
+    def capacity(self, name: str) -> float:
+        with self._condition:
+            return self._resource(name).capacity
+
+    def used(self, name: str) -> float:
+        with self._condition:
+            return self._resource(name).used
+
+    def _resource(self, name: str) -> _Resource:
+        """Return the entry of name in the shared table, adding it if needed. Call with the condition held."""
+        return self._resources[self._resourceIndex(name)]
+
+    def _resourceIndex(self, name: str) -> int:
+        """Return the index of name in the shared table, adding it if needed. Call with the condition held."""
+        checkName(name)
+        encoded = name.encode("utf-8")
+        for index, resource in enumerate(self._resources):
+            if resource.name == encoded:
+                return index
+            if not resource.name:
+                resource.name = encoded
+                resource.capacity = DEFAULT_CAPACITY
+                resource.used = 0.0
+                return index
+
+        raise ValueError("More than {} resources and locks are in use".format(MAX_RESOURCES))
+
+    def checkDemand(self, demand: Dict[str, float]):
+        """Raise ValueError if the resources in demand do not fit in the shared table of resources.
+
+        The table holds the MAX_RESOURCES names used by all of the tests of the run.
+        """
+        with self._condition:
+            for name in demand:
+                self._resourceIndex(name)
+
+    def _fits(self, demand: Dict[str, float], reserved: Optional[Dict[int, float]] = None) -> bool:
+        """Return True if demand fits in the free resources, less the amounts in reserved (by index).
+
+        Call with the condition held.
+        """
+        if self._active.value < 1 and not reserved:
+            # Always allow one test, or nothing would ever run.
+            return True
+
+        for name, amount in demand.items():
+            index = self._resourceIndex(name)
+            resource = self._resources[index]
+            free = resource.capacity - resource.used - (reserved or {}).get(index, 0.0)
+            if min(amount, resource.capacity) > free + 1e-9:
+                return False
+
+        if self._max_pressure.value > 0 and self._active.value > 0:
+            pressure = cpuPressure()
+            if pressure is not None and pressure > self._max_pressure.value:
+                return False
+        return True
+
+    def _admissible(self, grant: _Grant, demand: Dict[str, float]) -> bool:
+        """Return True if the waiting grant may take demand now. Call with the condition held."""
+        # Set aside the resources of the tests that have waited longer.
+        reserved: Dict[int, float] = {}
+        for other in self._grants:
+            if other.ticket and not other.held and other.ticket < grant.ticket:
+                for k in range(other.count):
+                    index = other.resources[k]
+                    amount = min(other.amounts[k], self._resources[index].capacity)
+                    reserved[index] = reserved.get(index, 0.0) + amount
+        return self._fits(demand, reserved)
+
+    def _addGrant(self, demand: Dict[str, float]) -> Optional[int]:
+        """Add a waiting grant for demand, and return its index, or None if the table is full.
+
+        Call with the condition held.
+        """
+        for index, grant in enumerate(self._grants):
+            if grant.ticket:
+                continue
+            grant.count = 0
+            for name, amount in demand.items():
+                grant.resources[grant.count] = self._resourceIndex(name)
+                grant.amounts[grant.count] = amount
+                grant.count += 1
+            grant.pid = os.getpid()
+            grant.start_time = processStartTime(grant.pid) or 0
+            grant.held = False
+            grant.ticket = self._next_ticket.value
+            self._next_ticket.value += 1
+            return index
+        return None
+
+    def _removeGrant(self, grant: _Grant):
+        """Give back the resources of grant, if it holds them, and free its entry. Call with the condition held."""
+        if grant.held:
+            for k in range(grant.count):
+                self._resources[grant.resources[k]].used -= grant.amounts[k]
+            self._active.value -= 1
+        grant.ticket = 0
+        # Wake up all of the waiting tests, since tests of different sizes may fit now.
+        self._condition.notify_all()
+
+    def _reclaim(self):
+        """Remove the grants of processes that are gone, at most every RECLAIM_INTERVAL seconds.
+
+        Call with the condition held.
+        """
+        now = time.time()
+        if now - self._last_reclaim.value < RECLAIM_INTERVAL:
+            return
+        self._last_reclaim.value = now
+
+        for grant in self._grants:
+            if grant.ticket and not processAlive(grant.pid, grant.start_time):
+                self._removeGrant(grant)
+
+    def acquire(self, demand: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+        """Wait until demand (by default, one CPU) fits, and take it. Returns what must be passed to release."""
+        if demand is None:
+            demand = {CPUS: 1.0}
+
+        with self._condition:
+            index = None
+            try:
+                while True:
+                    if index is None:
+                        index = self._addGrant(demand)
+                    if index is not None and self._admissible(self._grants[index], demand):
+                        break
+
+                    # Without a pressure limit, only release can free up resources, unless a worker died.
+                    self._condition.wait(
+                        min(PRESSURE_INTERVAL, RECLAIM_INTERVAL) if self._max_pressure.value > 0 else RECLAIM_INTERVAL
+                    )
+                    self._reclaim()
+            except BaseException:
+                if index is not None:
+                    self._removeGrant(self._grants[index])
+                raise
+
+            grant = self._grants[index]
+            taken = {}
+            for k, name in enumerate(demand):
+                resource = self._resources[grant.resources[k]]
+                grant.amounts[k] = taken[name] = min(demand[name], resource.capacity)
+                resource.used += taken[name]
+            grant.held = True
+            self._active.value += 1
+            # The next waiting test may fit as well.
+            self._condition.notify_all()
+            return _Taken(taken, index)
+
+    def release(self, taken: Dict[str, float]):
+        """Give back the resources returned by acquire, and wake up the waiting tests."""
+        with self._condition:
+            self._removeGrant(self._grants[taken.index])
+
+    @contextlib.contextmanager
+    def slot(self, demand: Optional[Dict[str, float]] = None):
+        """Context manager that holds the resources in demand (by default, one CPU)."""
+        taken = self.acquire(demand)
+        try:
+            yield
+        finally:
+            self.release(taken)
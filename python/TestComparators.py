@@ -0,0 +1,320 @@
+"""Running the compare programs of dtest in the dtest process.
+
+Each CMP or COMPARE comparison normally runs its compare program with
+runCmd, which costs a temporary output file, a copy of the environment, a
+bash process, and the program itself: dtest-diff runs diff, grep and wc, and
+the Python compare programs start an interpreter and import their modules.
+For the compare programs that come with dtest, and for cmp, the comparison is
+done by an equivalent Python function in the dtest process instead:
+
+* dtest-diff passes files that are the same apart from white space, as
+  "diff -w" does. Files that differ otherwise are left to dtest-diff, as only
+  it can tell whether the filter file removes all of the differences.
+* dtest-numerical-diff.
+* compareDictsInFiles and compareCheckpointFiles without the verbose or
+  epsilon options, using Dutils.DCompareUtils.
+* cmp without options other than -s.
+
+A comparator returns the return code of the program it stands in for, or None
+to run the program after all, e.g., for options it does not support. A
+command is only compared in process if it has no shell syntax other than
+$VARIABLE references, and if its program, as found on the PATH of the test, is
+the one the comparator stands in for: a test that puts its own dtest-diff on
+the PATH still runs it. Other compare programs may be added with
+registerComparator.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import re
+import shutil
+import stat
+import threading
+from collections.abc import Mapping
+
+from Dutils.typing import Callable, Dict, List, Optional, Tuple
+
+# The directory of the dtest scripts, e.g., dtest-diff.
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "scripts")
+
+# Shell syntax that compareInProcess leaves to bash, apart from the VARIABLE references it expands.
+SHELL_SYNTAX = re.compile(r"[$|&;<>()`'\"\\*?\[\]{}~!#]")
+VARIABLE = re.compile(r"\$(?:\{([A-Za-z_][A-Za-z0-9_]*)\}|([A-Za-z_][A-Za-z0-9_]*))")
+
+# The comparator functions and the real paths of the programs they stand in
+# for, keyed by the name of the program. See registerComparator.
+comparators: Dict[str, Tuple[Callable[[List[str], str], Optional[int]], Tuple[str, ...]]] = {}
+
+# The programs that commands resolve to, keyed by (program, PATH, cwd).
+_program_cache: Dict[Tuple[str, str, str], Optional[str]] = {}
+_program_cache_lock = threading.Lock()
+
+
+def registerComparator(name: str, compare: Callable[[List[str], str], Optional[int]], programs: List[str]):
+    """Compare with compare(args, cwd) instead of running the name program.
+
+    args are the arguments of the program, and file names in them are relative
+    to cwd. compare returns the return code of the program, or None if the
+    program should be run after all. programs are the paths of the program that
+    compare stands in for; a command whose program resolves to another file is
+    run as usual.
+    """
+    comparators[name] = (compare, tuple(os.path.realpath(p) for p in programs))
+
+
+def compareInProcess(cmd: str, args: List[str], cwd: str, env: Mapping) -> Optional[int]:
+    """Return the return code of running cmd with args in cwd, without running it.
+
+    Returns None if there is no comparator for cmd, or if its comparator
+    declines, in which case the command has to be run. env is the environment
+    the command would be run in.
+    """
+    if SHELL_SYNTAX.search(VARIABLE.sub("", cmd)) or any(SHELL_SYNTAX.search(arg) for arg in args):
+        return None
+
+    # The values are not quoted, so bash would split them, and expand any patterns in them.
+    expanded = VARIABLE.sub(lambda m: env.get(m.group(1) or m.group(2), ""), cmd)
+    if SHELL_SYNTAX.search(expanded):
+        return None
+    argv = expanded.split() + list(args)
+    if not argv or os.path.basename(argv[0]) not in comparators:
+        return None
+
+    compare, programs = comparators[os.path.basename(argv[0])]
+    if findProgram(argv[0], env.get("PATH", ""), cwd) not in programs:
+        return None
+
+    try:
+        return compare(argv[1:], cwd)
+    except Exception:  # pylint: disable=broad-except
+        # Let the program report the problem.
+        return None
+
+
+def findProgram(program: str, path: str, cwd: str) -> Optional[str]:
+    """Return the real path of the file bash would run for program, or None if there is none."""
+    key = (program, path, cwd if "/" in program else "")
+    with _program_cache_lock:
+        if key in _program_cache:
+            return _program_cache[key]
+
+    if "/" in program:
+        found = os.path.join(cwd, program)
+        found = found if os.path.isfile(found) and os.access(found, os.X_OK) else None
+    else:
+        found = shutil.which(program, path=path)
+    if found is not None:
+        found = os.path.realpath(found)
+
+    with _program_cache_lock:
+        _program_cache[key] = found
+    return found
+
+
+def _whiteSpaceFree(content: bytes) -> Optional[List[bytes]]:
+    """Return the lines of content without any white space, or None if it is binary."""
+    # diff compares binary files byte by byte, even with -w.
+    if b"\0" in content:
+        return None
+    return [re.sub(rb"\s+", b"", line) for line in content.split(b"\n")]
+
+
+def dtestDiff(args: List[str], cwd: str) -> Optional[int]:
+    """Stand in for "dtest-diff <debug> <filter file> <file1> <file2>"."""
+    if len(args) != 4:
+        return 1
+    filter_file, file1, file2 = [os.path.join(cwd, a) for a in args[1:]]
+    if not os.path.isfile(filter_file):
+        return 1
+
+    # dtest-diff rejects filter files with blank lines, as they would filter out everything.
+    with open(filter_file, "rb") as f:
+        if any(not line.strip() for line in f.read().splitlines()):
+            return 1
+
+    # With a debug level other than 0, dtest-diff only prints the differences, and always fails.
+    if not os.path.isfile(file1) or not os.path.isfile(file2) or args[0] != "0":
+        return 1
+
+    with open(file1, "rb") as f1, open(file2, "rb") as f2:
+        content1 = f1.read()
+        content2 = f2.read()
+    if content1 == content2:
+        return 0
+    lines1 = _whiteSpaceFree(content1)
+    if lines1 is not None and lines1 == _whiteSpaceFree(content2):
+        return 0
+    return None
+
+
+def _declineOptions(message: str):
+    """Raise ValueError for options that a program would reject, so that it is run to report them."""
+    raise ValueError(message)
+
+
+def numericalDiff(args: List[str], cwd: str) -> Optional[int]:
+    """Stand in for dtest-numerical-diff."""
+    parser = argparse.ArgumentParser("dtest-numerical-diff", add_help=False)
+    parser.add_argument("-a", "--absolute-error", type=float, default=0.0)
+    parser.add_argument("-r", "--relative-error", type=float, default=0.0)
+    parser.add_argument("--filter-file", default="")
+    parser.add_argument("--separator", default=r"[\s,()]+")
+    parser.add_argument("file1")
+    parser.add_argument("file2")
+    parser.error = _declineOptions
+    options = parser.parse_args(args)
+    if options.absolute_error < 0.0 or options.relative_error < 0.0:
+        return None
+
+    filters = []
+    if options.filter_file:
+        with open(os.path.join(cwd, options.filter_file)) as f:
+            filters = [re.compile(line) for line in f.readlines()]
+
+    def lines(filename):
+        with open(os.path.join(cwd, filename)) as f:
+            # As dtest-numerical-diff does, including its r"\Z" suffix.
+            return [
+                line
+                for line in f.readlines()
+                if line.strip() and not any(_filter.match(line + r"\Z") for _filter in filters)
+            ]
+
+    try:
+        lines_1 = lines(options.file1)
+        lines_2 = lines(options.file2)
+    except IOError:
+        return 1
+
+    if len(lines_1) != len(lines_2):
+        return 2
+
+    def words(line):
+        return [w.strip() for w in re.split(options.separator, line) if w.strip()]
+
+    for line1, line2 in zip(lines_1, lines_2):
+        if line1 == line2:
+            continue
+        words1 = words(line1)
+        words2 = words(line2)
+        if len(words1) != len(words2):
+            return 2
+        for a, b in zip(words1, words2):
+            if not _sameNumber(a, b, options.absolute_error, options.relative_error):
+                return 2
+    return 0
+
+
+def _sameNumber(a: str, b: str, absolute_error: float, relative_error: float) -> bool:
+    """Return True if the words a and b are numerically equivalent, as dtest-numerical-diff does."""
+    if a == b:
+        return True
+    try:
+        x = float(a)
+        y = float(b)
+    except ValueError:
+        return False
+    if abs(x - y) <= absolute_error:
+        return True
+    if x != 0.0:
+        return abs((x - y) / x) <= relative_error
+    return abs((y - x) / y) <= relative_error
+
+
+def _dictOptions(args: List[str], dict_options: bool):
+    """Parse the options of compareDictsInFiles, or of compareCheckpointFiles without dict_options.
+
+    Returns None if the options are not supported in process.
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser(add_help_option=False)
+    parser.add_option("--verbose", "-v", action="store_true", default=False)
+    if dict_options:
+        parser.add_option("--start_re", default="<START>")
+        parser.add_option("--end_re", default="<END>")
+        parser.add_option("--wholeFile", action="store_true", default=False)
+        parser.add_option("--abs_eps", type="float", default=-1)
+        parser.add_option("--rel_eps", type="float", default=-1)
+    parser.error = _declineOptions
+    options, files = parser.parse_args(args)
+    if options.verbose or len(files) != 2:
+        return None
+
+    # The epsilons are global to DCompareUtils, so only the defaults can be used in process.
+    if dict_options and (options.abs_eps != -1 or options.rel_eps != -1):
+        return None
+    return options, files
+
+
+def compareDictsInFiles(args: List[str], cwd: str) -> Optional[int]:
+    """Stand in for compareDictsInFiles."""
+    parsed = _dictOptions(args, dict_options=True)
+    if parsed is None:
+        return None
+    try:
+        from Dutils import DCompareUtils
+    except ImportError:
+        return None
+
+    options, files = parsed
+    okay = DCompareUtils.cmpDictsInFiles(
+        os.path.join(cwd, files[0]),
+        os.path.join(cwd, files[1]),
+        options.start_re,
+        options.end_re,
+        options.wholeFile,
+    )
+    return 0 if okay else 1
+
+
+def compareCheckpointFiles(args: List[str], cwd: str) -> Optional[int]:
+    """Stand in for compareCheckpointFiles."""
+    parsed = _dictOptions(args, dict_options=False)
+    if parsed is None:
+        return None
+    try:
+        from Dutils import DCompareUtils
+    except ImportError:
+        return None
+
+    _, files = parsed
+    okay = DCompareUtils.cmpCheckpointFiles(os.path.join(cwd, files[0]), os.path.join(cwd, files[1]), False)
+    return 0 if okay else 1
+
+
+def cmp(args: List[str], cwd: str) -> Optional[int]:
+    """Stand in for cmp."""
+    files = [a for a in args if a not in ("-s", "--silent", "--quiet")]
+    if len(files) != 2 or any(f.startswith("-") for f in files):
+        return None
+
+    try:
+        with open(os.path.join(cwd, files[0]), "rb") as f1, open(os.path.join(cwd, files[1]), "rb") as f2:
+            stat1 = os.fstat(f1.fileno())
+            stat2 = os.fstat(f2.fileno())
+            if stat.S_ISREG(stat1.st_mode) and stat.S_ISREG(stat2.st_mode) and stat1.st_size != stat2.st_size:
+                return 1
+            while True:
+                chunk1 = f1.read(1 << 16)
+                if chunk1 != f2.read(1 << 16):
+                    return 1
+                if not chunk1:
+                    return 0
+    except (IOError, OSError):
+        return 2
+
+
+registerComparator("dtest-diff", dtestDiff, [os.path.join(SCRIPTS_DIR, "dtest-diff")])
+registerComparator("dtest-numerical-diff", numericalDiff, [os.path.join(SCRIPTS_DIR, "dtest-numerical-diff")])
+registerComparator("compareDictsInFiles", compareDictsInFiles, [os.path.join(SCRIPTS_DIR, "compareDictsInFiles")])
+registerComparator(
+    "compareCheckpointFiles", compareCheckpointFiles, [os.path.join(SCRIPTS_DIR, "compareCheckpointFiles")]
+)
+registerComparator("cmp", cmp, ["/usr/bin/cmp", "/bin/cmp"])
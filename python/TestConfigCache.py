@@ -0,0 +1,118 @@
+"""Persistent cache of compiled DTESTDEFS.cfg files.
+
+Parsing DTESTDEFS.cfg files with configobj, interpolating them and resolving
+the comparison programs is a measurable part of test discovery and dispatch.
+The ConfigCache stores the result of Test.compileConfig in a JSON file at
+the top of each test tree, keyed by the hash of the config file contents and
+the interpolation data (YAM_ROOT, YAM_TARGET, ROOTDIR). Test.loadCompiledConfig
+uses it instead of re-parsing the file, unless one of the compare programs
+that the config refers to was added or removed since (see
+Test.comparePrograms).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+
+from Dutils.typing import Dict, Any, Optional, Tuple
+
+from . import TestFiles
+
+# Name of the cache file created in the top test directory.
+CACHE_FILENAME = ".dtest_config_cache"
+
+# Bump this whenever the layout of the compiled configs changes.
+CACHE_VERSION = 3
+
+
+def _keyString(key) -> str:
+    """Return key as a string, which compares the same before and after a JSON round trip."""
+    return json.dumps(key, sort_keys=True)
+
+
+class ConfigCache:
+    """Cache of compiled configs for one or more test trees."""
+
+    def __init__(self):
+        # Compiled configs keyed by directory. The values are (key string, compiled config).
+        self._entries: Dict[str, Tuple[str, Any]] = {}
+
+        # Loaded test trees. The values are True if entries in the tree changed.
+        self._top_dirs: Dict[str, bool] = {}
+
+    def load(self, top_test_dir: str, rebuild: bool = False):
+        """Load the cache file of the test tree at top_test_dir.
+
+        If rebuild is True, the existing cache file is ignored and replaced
+        on the next save.
+        """
+        if top_test_dir in self._top_dirs:
+            return
+        self._top_dirs[top_test_dir] = rebuild
+
+        if rebuild:
+            return
+
+        try:
+            with open(os.path.join(top_test_dir, CACHE_FILENAME), "r") as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            # A missing, truncated or incompatible cache is simply rebuilt.
+            return
+
+        if isinstance(data, dict) and data.get("version") == CACHE_VERSION:
+            for full_dir, entry in data.get("entries", {}).items():
+                self._entries.setdefault(full_dir, entry)
+
+    def get(self, full_dir: str, key) -> Optional[Any]:
+        """Return the compiled config of full_dir if it was stored with key.
+
+        Tuples in the compiled config come back as lists once it was saved.
+        """
+        entry = self._entries.get(full_dir)
+        if entry is not None and entry[0] == _keyString(key):
+            return entry[1]
+        return None
+
+    def put(self, full_dir: str, key, compiled):
+        """Store the compiled config of full_dir."""
+        self._entries[full_dir] = (_keyString(key), compiled)
+
+        top_dir = self._topDir(full_dir)
+        if top_dir is not None:
+            self._top_dirs[top_dir] = True
+
+    def save(self):
+        """Write the cache files of the test trees that changed.
+
+        Failures are ignored, since the cache is only an optimization.
+        """
+        for top_dir, changed in self._top_dirs.items():
+            if not changed:
+                continue
+
+            prefix = os.path.join(top_dir, "")
+            entries = {
+                full_dir: entry
+                for full_dir, entry in self._entries.items()
+                if (full_dir == top_dir or full_dir.startswith(prefix)) and os.path.isdir(full_dir)
+            }
+
+            data = {"version": CACHE_VERSION, "entries": entries}
+            try:
+                TestFiles.writeAtomically(os.path.join(top_dir, CACHE_FILENAME), lambda f: json.dump(data, f))
+                self._top_dirs[top_dir] = False
+            except (IOError, OSError, TypeError, ValueError):
+                pass
+
+    def _topDir(self, full_dir: str) -> Optional[str]:
+        """Return the loaded test tree that contains full_dir."""
+        for top_dir in self._top_dirs:
+            if full_dir == top_dir or full_dir.startswith(os.path.join(top_dir, "")):
+                return top_dir
+        return None
@@ -0,0 +1,197 @@
+"""Running test commands from a single asyncio event loop.
+
+By default, each parallel job is a forked pool worker that runs its test
+commands with killableprocess.Popen and polls them until they exit. With
+"--executor async", the jobs are threads of a multiprocessing ThreadPool in
+the dtest process instead, and the commands of all jobs are run by one
+AsyncCommandRunner: an asyncio event loop in a background thread that starts
+each command in its own process group, waits for it to exit, enforces its
+timeout and kills what is left of its process group. The jobs hand their
+commands to the loop and block until they are done, so a job only costs a
+thread, and it wakes up as soon as its command exits.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import errno
+import os
+import signal
+import subprocess
+import threading
+
+from Dutils.typing import Callable, Dict, Optional
+
+from . import killableprocess
+
+# Seconds between the checks whether a command has been cancelled. See AsyncCommandRunner.run.
+CANCEL_POLL = 0.1
+
+
+class AsyncCommandRunner(object):
+    """Runs shell commands for many threads at once from one event loop.
+
+    Call start before running any commands, and close when done.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the event loop in a background thread."""
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="dtest-commands", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Kill the commands that are still running and stop the event loop."""
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._cancelAll(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+
+    def run(
+        self,
+        cmdstr: str,
+        cwd: str,
+        env: Dict[str, str],
+        output_file=None,
+        timeout: float = -1,
+        cancel=None,
+        on_start: Optional[Callable[[int], None]] = None,
+    ) -> int:
+        """Run cmdstr with bash and return its return code. This may be called from any thread.
+
+        The output of the command goes to output_file, or to the output of dtest if it is None.
+        If the command runs longer than timeout seconds (-1 for no timeout), its process group
+        is killed and killableprocess.TimeoutExpired is raised, as killableprocess.Popen.wait does.
+        If cancel, e.g., a threading.Event, is set while the command runs, its process group is
+        stopped and killableprocess.Cancelled is raised. on_start is called with the process
+        group of the command once it has started, from the thread of the event loop.
+        """
+        if self._loop is None:
+            raise RuntimeError("The command runner has not been started")
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(cmdstr, cwd, env, output_file, timeout, cancel, on_start), self._loop
+        )
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+
+    async def _run(
+        self, cmdstr: str, cwd: str, env: Dict[str, str], output_file, timeout: float, cancel, on_start
+    ) -> int:
+        """Run cmdstr and wait for it. See run."""
+        raise ValueError("In general, calling Popen is unsafe, as it can run arbitrary bash commands. Therefore, it has been commented out. To run Dtest, you'll need to uncomment this or replace with something else that can run bash commands listed in DTESTDEFS files.")
+        #process = await asyncio.create_subprocess_exec(
+        #    "/bin/bash",
+        #    "-c",
+        #    cmdstr,
+        #    stdin=subprocess.DEVNULL,
+        #    stdout=output_file,
+        #    stderr=output_file,
+        #    cwd=cwd,
+        #    env=env,
+        #    # Run the command in its own process group, as killableprocess.Popen does.
+        #    start_new_session=True,
+        #)
+
+        if on_start is not None:
+            on_start(process.pid)
+
+        try:
+            if cancel is None and (timeout is None or timeout < 0):
+                return_code = await process.wait()
+            else:
+                return_code = await self._wait(process, timeout, cancel)
+        except asyncio.CancelledError:
+            killProcessGroup(process.pid)
+            raise
+
+        # Makes sure any lingering processes in the process group are killed.
+        killProcessGroup(process.pid)
+        return return_code
+
+    async def _wait(self, process, timeout: float, cancel) -> int:
+        """Wait for process, enforcing timeout, and checking cancel every CANCEL_POLL seconds. See run."""
+        deadline = None if timeout is None or timeout < 0 else self._loop.time() + timeout
+        exited = asyncio.ensure_future(process.wait())
+        while True:
+            interval = CANCEL_POLL if cancel is not None else None
+            if deadline is not None:
+                remaining = max(0.0, deadline - self._loop.time())
+                interval = remaining if interval is None else min(interval, remaining)
+            try:
+                return await asyncio.wait_for(asyncio.shield(exited), interval)
+            except asyncio.TimeoutError:
+                pass
+
+            if cancel is not None and cancel.is_set():
+                await stopProcessGroup(process)
+                raise killableprocess.Cancelled()
+            if deadline is not None and self._loop.time() >= deadline:
+                killProcessGroup(process.pid)
+                await exited
+                raise killableprocess.TimeoutExpired(timeout)
+
+    async def _cancelAll(self):
+        """Cancel the commands that are still running, which kills their process groups."""
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def stopProcessGroup(process):
+    """Stop the process group of process as killableprocess.Popen.stop does: SIGTERM, then SIGKILL."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError as e:
+        if e.errno not in (errno.ESRCH, errno.EPERM):
+            raise
+    try:
+        await asyncio.wait_for(process.wait(), killableprocess.STOP_GRACE)
+    except asyncio.TimeoutError:
+        pass
+    killProcessGroup(process.pid)
+    await process.wait()
+
+
+def killProcessGroup(pgid: int):
+    """Kill the process group pgid. A process group that is already gone is ignored."""
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError as e:
+        if e.errno not in (errno.ESRCH, errno.EPERM):
+            raise
+
+
+def runsCommands() -> bool:
+    """Return whether AsyncCommandRunner can run commands.
+
+    It cannot while the Popen call in AsyncCommandRunner._run is commented out,
+    in which case running a command raises ValueError.
+    """
+    runner = AsyncCommandRunner()
+    runner.start()
+    try:
+        runner.run("true", cwd="/", env=dict(os.environ))
+    except ValueError:
+        return False
+    finally:
+        runner.close()
+    return True
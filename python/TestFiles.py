@@ -0,0 +1,64 @@
+"""Writing the files of dtest atomically.
+
+The index, cache and plan files are written with writeAtomically, to a
+temporary file from tempfile.mkstemp, which is then renamed over the old
+file. mkstemp creates the file with mode 0600, so without sharePermissions
+the file would only be readable by its owner, unlike the other files dtest
+writes, which get the usual 0666 masked by the umask.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import tempfile
+
+from Dutils.typing import Any, Callable
+
+
+def umask() -> int:
+    """Return the umask of the process.
+
+    It is read from /proc where possible, since os.umask can only read it by
+    changing it, which affects the files created by other threads meanwhile.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    mask = os.umask(0o22)
+    os.umask(mask)
+    return mask
+
+
+def sharePermissions(fd: int):
+    """Give the file open as fd the mode of a file created with open(), i.e., 0666 masked by the umask."""
+    os.fchmod(fd, 0o666 & ~umask())
+
+
+def writeAtomically(path: str, write_fn: Callable[[Any], None]):
+    """Write path atomically, with the file object passed to write_fn.
+
+    The file is written next to path and renamed over it, so readers see
+    either the old or the new contents. On errors the temporary file is
+    removed, and the error is raised.
+    """
+    fd, tmp_name = tempfile.mkstemp(prefix=os.path.basename(path) + ".", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            sharePermissions(f.fileno())
+            write_fn(f)
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
+        raise
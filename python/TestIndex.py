@@ -0,0 +1,236 @@
+"""Persistent index of the test directory tree.
+
+Discovering tests requires listing every directory in the test tree and
+parsing every DTESTDEFS.cfg file along the way. The DiscoveryIndex caches the
+per-directory results of that work (the test sub-directories and the
+SKIPTESTS, QUARANTINED, TAGS and CHILD_TAGS values of the local config file)
+in a file at the top of the test tree. Entries are keyed by the modification
+times of the directory and its config file, so only directories that changed
+since the last run are re-scanned.
+
+Validating the entries still costs a stat per directory, which dominates on
+network file systems. The prefetch function validates the entries of whole
+trees with a bounded thread pool before findTests walks them, so the walk
+itself is served from memory and keeps its deterministic order.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import concurrent.futures
+import json
+import os
+import stat
+
+from Dutils.typing import Dict, Any, Iterable, List, Optional, Set, Tuple, Union
+
+from . import Test
+from . import TestFiles
+
+# Name of the index file created in the top test directory.
+INDEX_FILENAME = ".dtest_index"
+
+# Bump this whenever the layout of the index entries changes.
+INDEX_VERSION = 1
+
+# Config keys that affect test discovery.
+DISCOVERY_KEYS = ("SKIPTESTS", "QUARANTINED", "TAGS", "CHILD_TAGS")
+
+# Default number of threads used to prefetch the index entries.
+PREFETCH_THREADS = 8
+
+
+class DiscoveryIndex:
+    """Cache of the test tree layout used by Test.findTests.
+
+    Parameters
+    ----------
+    top_test_dir : str
+        The top of the test tree. The index file is stored here.
+    truth_suffix : Union[str, List[str]]
+        Truth suffix(es) from the command line. Only used when a config file
+        has to be parsed.
+    """
+
+    def __init__(self, top_test_dir: str, truth_suffix: Union[str, List[str]]):
+        self.filename = os.path.join(top_test_dir, INDEX_FILENAME)
+        self.truth_suffix = truth_suffix
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty = False
+
+        # Directories whose entries were already validated by prefetch.
+        self._fresh: Set[str] = set()
+
+        self.load()
+
+    def load(self):
+        """Load the index from disk. A missing or stale index is ignored."""
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        if isinstance(data, dict) and data.get("version") == INDEX_VERSION:
+            self._entries = data.get("entries", {})
+
+    def save(self):
+        """Write the index to disk if it changed.
+
+        The file is written atomically. Failures are ignored, since the index
+        is only an optimization (e.g., the test tree may be read-only).
+        """
+        if not self._dirty:
+            return
+
+        data = {"version": INDEX_VERSION, "entries": self._entries}
+        try:
+            TestFiles.writeAtomically(self.filename, lambda f: json.dump(data, f))
+            self._dirty = False
+        except (IOError, OSError):
+            pass
+
+    def entry(self, full_dir: str) -> Optional[Dict[str, Any]]:
+        """Return the index entry for full_dir, re-scanning it if it changed.
+
+        Returns None if full_dir is not a directory.
+        """
+        if full_dir in self._fresh:
+            return self._entries[full_dir]
+
+        try:
+            dir_stat = os.stat(full_dir)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(dir_stat.st_mode):
+            return None
+
+        cached = self._entries.get(full_dir)
+        if cached is not None and cached["mtime"] == dir_stat.st_mtime_ns:
+            if cached["config"] is None or _mtime(cached["config"]) == cached["config_mtime"]:
+                return cached
+
+        new_entry = self._scan(full_dir, dir_stat.st_mtime_ns)
+        self._entries[full_dir] = new_entry
+        self._dirty = True
+        return new_entry
+
+    def prefetch(self, paths: Iterable[str], max_workers: int = PREFETCH_THREADS):
+        """Validate the entries of the test trees under paths concurrently.
+
+        See the prefetch function.
+        """
+        prefetch([(self, paths)], max_workers=max_workers)
+
+    def _validate(self, full_dir: str) -> List[str]:
+        """Validate the entry of full_dir and return the sub-directories to visit next.
+
+        Sub-directories listed in the SKIPTESTS of the directory are not visited.
+        """
+        try:
+            dir_entry = self.entry(full_dir)
+        except Exception:
+            # Errors are reported by the walk in findTests.
+            return []
+        if dir_entry is None:
+            return []
+        self._fresh.add(full_dir)
+
+        skiptests = dir_entry.get("SKIPTESTS", [])
+        return [
+            os.path.join(full_dir, testdir)
+            for testdir in dir_entry["subtests"]
+            if testdir not in skiptests and testdir + "/" not in skiptests
+        ]
+
+    def _scan(self, full_dir: str, mtime: int) -> Dict[str, Any]:
+        """Scan full_dir from scratch."""
+        subtests = sorted([x for x in os.listdir(full_dir) if Test.isTestDir(os.path.join(full_dir, x))])
+
+        config_path = Test.getConfigPath(full_dir)
+        new_entry: Dict[str, Any] = {
+            "mtime": mtime,
+            "config": config_path,
+            "config_mtime": _mtime(config_path) if config_path else None,
+            "subtests": subtests,
+        }
+
+        if config_path:
+            local_config = Test.getLocalConfig(None, full_dir=full_dir, truth_suffix=self.truth_suffix)
+            for key in DISCOVERY_KEYS:
+                new_entry[key] = Test.getListFromConfig(local_config, key)
+
+        return new_entry
+
+    def getLocalConfig(
+        self, previous_config: Optional[Dict[str, List[str]]], full_dir: str
+    ) -> Tuple[Optional[Dict[str, List[str]]], List[str]]:
+        """Return the discovery config and the test sub-directories of full_dir.
+
+        This mirrors Test.getLocalConfig for the DISCOVERY_KEYS: a directory
+        without a config file inherits the config of its parent, SKIPTESTS,
+        QUARANTINED and TAGS are local, and CHILD_TAGS accumulate.
+        """
+        dir_entry = self.entry(full_dir)
+        if dir_entry is None:
+            return None, []
+
+        if dir_entry["config"] is None:
+            return previous_config, dir_entry["subtests"]
+
+        new_config = {key: dir_entry[key] for key in DISCOVERY_KEYS}
+        if previous_config:
+            new_config["CHILD_TAGS"] = new_config["CHILD_TAGS"] + previous_config["CHILD_TAGS"]
+
+        return new_config, dir_entry["subtests"]
+
+    def getDefaultConfig(self, path: str) -> Optional[Dict[str, List[str]]]:
+        """Return the discovery config inherited from the parents of path.
+
+        This mirrors Test.getDefaultConfig.
+        """
+        parent_dir = os.path.split(path)[0]
+        parent_entry = self.entry(parent_dir)
+        if parent_entry is None or not parent_entry["subtests"]:
+            return None
+
+        new_config, _ = self.getLocalConfig(self.getDefaultConfig(parent_dir), parent_dir)
+        return new_config
+
+
+def prefetch(trees: Iterable[Tuple[DiscoveryIndex, Iterable[str]]], max_workers: int = PREFETCH_THREADS):
+    """Validate the index entries of several test trees concurrently.
+
+    The trees are walked breadth first with a pool of max_workers threads,
+    visiting every test sub-directory that is not in the SKIPTESTS of its
+    parent. Afterwards the entries are served from memory for the lifetime of
+    the indexes.
+
+    Parameters
+    ----------
+    trees : Iterable[Tuple[DiscoveryIndex, Iterable[str]]]
+        The index of each test tree and the directories to start walking from, e.g.,
+        the paths given on the command line or the test directories of dtest-sbox modules.
+    max_workers : int
+        Maximum number of threads.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Maps the pending futures to the index they validate an entry of.
+        pending = {executor.submit(index._validate, path): index for index, paths in trees for path in paths}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                for subtest_path in future.result():
+                    pending[executor.submit(index._validate, subtest_path)] = index
+
+
+def _mtime(path: str) -> Optional[int]:
+    """Return the modification time of path in ns, or None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
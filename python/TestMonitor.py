@@ -0,0 +1,278 @@
+"""Sampling the resources used by the processes of the running tests.
+
+With '--monitor', a ResourceMonitor thread samples the processes of the
+commands of the running tests every '--monitor-interval' seconds. Each
+command runs in its own process group (see killableprocess), so the monitor
+finds the processes of a test by reading the process group of every process
+in /proc, and adds up their resident set sizes, threads and CPU time. The
+peaks of each test are stored in the "peaks" entry of its record in the
+regtest data:
+
+* max_rss_kb, the largest total resident set size of its processes.
+* max_cpu, the most CPUs its processes used at once, averaged over an interval.
+* max_threads and max_processes, the most threads and processes at once.
+* samples, the number of samples taken, which is 0 for tests that finished
+  within an interval.
+
+Unlike the resource usage of the commands (see TestUsage), the peaks cover
+all the processes of a test at once, including the ones that commands leave
+running in the background. Other resources are sampled by plugins, e.g.,
+GpuMemoryPlugin for '--poll-gpu-memory'.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import contextlib
+import os
+import threading
+import time
+
+from Dutils.typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+# Seconds between samples. See ResourceMonitor.
+SAMPLE_INTERVAL = 0.5
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE_KB = (os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096) // 1024
+
+
+def readProcesses(pgids: Set[int]) -> Dict[int, List[Tuple[int, int, int, int]]]:
+    """Return the (pid, CPU ticks, RSS pages, threads) of the processes in the pgids process groups, by group."""
+    processes: Dict[int, List[Tuple[int, int, int, int]]] = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return processes
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry), "rb") as f:
+                stat = f.read()
+        except OSError:
+            # The process exited.
+            continue
+
+        # The command name may contain spaces and parentheses, so the fields are split after the last ')'.
+        fields = stat[stat.rfind(b")") + 2 :].split()
+        try:
+            pgid = int(fields[2])
+            if pgid not in pgids:
+                continue
+            processes.setdefault(pgid, []).append(
+                (int(entry), int(fields[11]) + int(fields[12]), int(fields[21]), int(fields[17]))
+            )
+        except (IndexError, ValueError):
+            continue
+    return processes
+
+
+class TestSamples(object):
+    """The peaks of the processes of one test. See ResourceMonitor."""
+
+    def __init__(self):
+        self.pgids: Set[int] = set()
+        self.max_rss_kb = 0
+        self.max_cpu = 0.0
+        self.max_threads = 0
+        self.max_processes = 0
+        self.samples = 0
+        # The CPU ticks of the processes at the previous sample, by pid.
+        self._ticks: Dict[int, int] = {}
+        self._sample_time: Optional[float] = None
+        # The peaks of the plugins. See MonitorPlugin.
+        self.plugin_peaks: Dict[str, Any] = {}
+
+    def add(self, processes: List[Tuple[int, int, int, int]], now: float):
+        """Add a sample of the processes of the test, as returned by readProcesses."""
+        if not processes:
+            return
+        ticks = {pid: process_ticks for pid, process_ticks, _, _ in processes}
+        if self._sample_time is not None and now > self._sample_time:
+            # A process that started since the previous sample used all of its CPU time since then.
+            used = sum(t - self._ticks.get(pid, 0) for pid, t in ticks.items())
+            self.max_cpu = max(self.max_cpu, used / CLOCK_TICKS / (now - self._sample_time))
+        self._ticks = ticks
+        self._sample_time = now
+
+        self.max_rss_kb = max(self.max_rss_kb, sum(rss for _, _, rss, _ in processes) * PAGE_SIZE_KB)
+        self.max_threads = max(self.max_threads, sum(threads for _, _, _, threads in processes))
+        self.max_processes = max(self.max_processes, len(processes))
+        self.samples += 1
+
+    def peaks(self) -> Dict[str, Any]:
+        """Return the peaks, for the regtest data."""
+        peaks = {
+            "max_rss_kb": self.max_rss_kb,
+            "max_cpu": round(self.max_cpu, 2),
+            "max_threads": self.max_threads,
+            "max_processes": self.max_processes,
+            "samples": self.samples,
+        }
+        peaks.update(self.plugin_peaks)
+        return peaks
+
+
+class MonitorPlugin(object):
+    """A resource that ResourceMonitor samples for each test, besides its processes."""
+
+    def begin(self, full_dir: str):
+        """Start sampling for the test in full_dir."""
+
+    def end(self, full_dir: str) -> Dict[str, Any]:
+        """Stop sampling for the test in full_dir, and return its peaks, for the "peaks" entry of the test."""
+        return {}
+
+
+class ResourceMonitor(object):
+    """Samples the process groups of the commands of the running tests in a background thread.
+
+    The thread is started by the first test of each process, so each forked
+    worker samples its own tests.
+
+    Parameters
+    ----------
+    interval : float
+        Seconds between samples.
+    plugins : List[MonitorPlugin]
+        Plugins that sample other resources for each test.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL, plugins: Optional[List[MonitorPlugin]] = None):
+        self.interval = interval
+        self.plugins = plugins or []
+        self._lock = threading.Lock()
+        # The samples of the running tests, by test directory.
+        self._tests: Dict[str, TestSamples] = {}
+        # The process that started the sampling thread.
+        self._pid: Optional[int] = None
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._afterFork)
+
+    @contextlib.contextmanager
+    def test(self, full_dir: str) -> Iterator[TestSamples]:
+        """Sample the processes of the test in full_dir (see watch) during the context.
+
+        Yields the samples of the test, which are complete once the context exits.
+        """
+        samples = TestSamples()
+        with self._lock:
+            self._start()
+            self._tests[full_dir] = samples
+        try:
+            for plugin in self.plugins:
+                plugin.begin(full_dir)
+            yield samples
+        finally:
+            with self._lock:
+                del self._tests[full_dir]
+            for plugin in self.plugins:
+                samples.plugin_peaks.update(plugin.end(full_dir))
+
+    def watch(self, full_dir: str, pgid: int):
+        """Sample the process group pgid with the test in full_dir, if it is being sampled. This may be called from any thread."""
+        with self._lock:
+            samples = self._tests.get(full_dir)
+            if samples is not None:
+                samples.pgids.add(pgid)
+
+    def sample(self):
+        """Add a sample of the processes of each running test."""
+        with self._lock:
+            tests = list(self._tests.values())
+            pgids = set().union(*(samples.pgids for samples in tests))
+        if not pgids:
+            return
+
+        processes = readProcesses(pgids)
+        now = time.monotonic()
+        with self._lock:
+            for samples in tests:
+                samples.add([p for pgid in samples.pgids for p in processes.get(pgid, [])], now)
+
+    def _start(self):
+        """Start the sampling thread of this process, if it is not running yet. Call with the lock held."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name="dtest-monitor", daemon=True).start()
+
+    def _afterFork(self):
+        """Forget the tests of the parent process in a forked child, which does not have the sampling thread."""
+        self._lock = threading.Lock()
+        self._tests = {}
+
+    def _run(self):
+        """Sample every interval seconds."""
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+
+def pollGpu(stop, result_queue, interval: float):
+    """Poll the GPU memory every interval seconds until stop is set. Then, put the
+    largest increase over the memory used at the start on the result queue."""
+    # Only available if we have cuda. It loads the cuda libraries, so it is not imported up front.
+    from Dtest.DtestGpuMem_Py import getGPUMemUsage
+
+    gpu_start = getGPUMemUsage()
+    max_gpu_usage = 0
+
+    while True:
+        max_gpu_usage = max(max_gpu_usage, getGPUMemUsage() - gpu_start)
+        if stop.wait(interval):
+            break
+
+    result_queue.put(max_gpu_usage)
+
+
+class GpuMemoryPlugin(MonitorPlugin):
+    """Samples the GPU memory used while each test runs, as "gpu_usage".
+
+    The GPU memory is polled in a separate process, so that dtest itself does
+    not initialize cuda. It covers all the processes using the GPU, so the
+    tests must run one at a time for the usage of each to be right.
+
+    Parameters
+    ----------
+    interval : float
+        Seconds between polls.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self._context = None
+        self._process = None
+
+    def begin(self, full_dir: str):
+        """Start polling the GPU memory."""
+        if self._context is None:
+            from multiprocessing import get_context
+
+            self._context = get_context("forkserver")
+            self._result_queue = self._context.Queue()
+            self._stop_event = self._context.Event()
+
+        self._stop_event.clear()
+        self._process = self._context.Process(
+            target=pollGpu, args=(self._stop_event, self._result_queue, self.interval)
+        )
+        self._process.start()
+
+    def end(self, full_dir: str) -> Dict[str, Any]:
+        """Stop polling, and return the "gpu_usage" of the test."""
+        if self._process is None:
+            return {}
+        self._stop_event.set()
+        self._process.join()
+        exitcode = self._process.exitcode
+        self._process = None
+        if exitcode != 0:
+            # E.g., cuda is not available.
+            return {}
+        return {"gpu_usage": self._result_queue.get()}
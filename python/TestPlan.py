@@ -0,0 +1,113 @@
+"""Machine-readable execution plans.
+
+"dtest --plan FILE" discovers the tests and writes a plan to FILE instead of
+running them. The plan is a JSON file with the test directories in the order
+they would be run, the SERIAL groups, and the resolved config, tags and truth
+files of every test:
+
+    {
+        "version": 1,
+        "directory": "/path/to/test",
+        "top_test_dir": "/path/to/test",
+        "tests": [
+            {"serial": [{"directory": "/path/to/test/test_a", ...}, ...]},
+            {"directory": "/path/to/test/test_b", "config": {...}, "tags": [...], "truth_files": {...}},
+            ...
+        ]
+    }
+
+"dtest --from-plan FILE" runs the tests of a plan with the configs in the
+plan, without walking the test tree or parsing any config files. A plan may
+be split up (e.g., to shard the tests across machines) by removing entries
+from "tests".
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+
+from Dutils.typing import Dict, Any, List, Union
+
+from . import Test
+from . import TestFiles
+
+# Bump this whenever the layout of the plan changes.
+PLAN_VERSION = 1
+
+NestedStringList = List[Union[str, List[str]]]
+
+
+def buildPlan(args: Test.DtestArgs, test_list: NestedStringList) -> Dict[str, Any]:
+    """Return the plan for test_list, as returned by generateTestList in parallel mode."""
+    tests: List[Dict[str, Any]] = []
+    for test in test_list:
+        if isinstance(test, str):
+            tests.append(_planEntry(args, test))
+        else:
+            tests.append({"serial": [_planEntry(args, t) for t in test]})
+
+    return {
+        "version": PLAN_VERSION,
+        "directory": args.directory,
+        "top_test_dir": args.top_test_dir,
+        "tests": tests,
+    }
+
+
+def _planEntry(args: Test.DtestArgs, full_dir: str) -> Dict[str, Any]:
+    """Return the plan entry of the test in full_dir."""
+    config = Test.getLocalConfig(
+        Test.getDefaultConfig(full_dir, args.truth_suffix), full_dir=full_dir, truth_suffix=args.truth_suffix
+    )
+    if not config:
+        raise Test.TestException("Unable to get test configuration data in {d} directory.".format(d=full_dir))
+
+    tags = set(Test.getListFromConfig(config, "TAGS")) | set(Test.getListFromConfig(config, "CHILD_TAGS"))
+    return {
+        "directory": full_dir,
+        "config": dict(config),
+        "tags": sorted(tags),
+        "truth_files": Test.DirectorySnapshot(full_dir).truthFiles(config["TRUTHSUFFIX"]),
+    }
+
+
+def writePlan(plan: Dict[str, Any], filename: str):
+    """Write plan to filename atomically."""
+    TestFiles.writeAtomically(filename, lambda f: json.dump(plan, f, indent=1, sort_keys=True))
+
+
+def loadPlan(filename: str) -> Dict[str, Any]:
+    """Load a plan written by writePlan."""
+    try:
+        with open(filename, "r") as f:
+            plan = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise Test.TestException("Could not read the plan {}: {}".format(filename, e))
+
+    if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+        raise Test.TestException("{} is not a version {} dtest plan".format(filename, PLAN_VERSION))
+
+    return plan
+
+
+def planTests(plan: Dict[str, Any]) -> NestedStringList:
+    """Return the test directories of plan. SERIAL groups are returned as lists."""
+    return [
+        [t["directory"] for t in test["serial"]] if "serial" in test else test["directory"] for test in plan["tests"]
+    ]
+
+
+def planConfigs(plan: Dict[str, Any]) -> Dict[str, Test.ResolvedTestConfig]:
+    """Return the resolved configs of the tests in plan, keyed by directory."""
+    configs = {}
+    for test in plan["tests"]:
+        for entry in test.get("serial", [test]):
+            config = dict(entry["config"])
+            # JSON turns the truth suffix tuple (see Test.getSuffixes) into a list.
+            config["TRUTHSUFFIX"] = tuple(config["TRUTHSUFFIX"])
+            configs[entry["directory"]] = Test.ResolvedTestConfig(config)
+    return configs
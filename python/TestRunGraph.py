@@ -0,0 +1,144 @@
+"""Concurrent RUN commands within a test directory.
+
+The RUN commands of a test normally run one after the other. With
+"PARALLEL_RUN = True" in its DTESTDEFS file, the commands of the test run
+concurrently instead, as many at once as the CPUS in its RESOURCES allow. A
+command that needs the results of other commands names them in the RUN_AFTER
+section, and only starts once they have finished:
+
+    PARALLEL_RUN = True
+
+    [RESOURCES]
+    CPUS = 2
+
+    [RUN]
+    inputs = ./make_inputs
+    scenario1 = ./run_scenario 1 >& scenario1.out
+    scenario2 = ./run_scenario 2 >& scenario2.out
+
+    [RUN_AFTER]
+    scenario1 = inputs
+    scenario2 = inputs
+
+    [RUN_OUTPUTS]
+    scenario1 = scenario1.*
+    scenario2 = scenario2.*
+
+The RUN_OUTPUTS section lists the output files of a command as shell
+patterns. Their truth files are compared as soon as the command, and the
+commands that run after it, have finished, while the other commands are
+still running. All other truth files are compared once all of the commands
+have finished.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import concurrent.futures
+import fnmatch
+from collections.abc import Mapping
+
+from Dutils.typing import Any, Callable, Dict, List, Set
+
+from . import TestAdmission
+
+
+def parallelRun(config: Mapping[str, Any]) -> bool:
+    """Return True if the RUN commands of config may run concurrently."""
+    return str(config.get("PARALLEL_RUN", "")).strip().lower() in ("true", "yes", "on", "1")
+
+
+def commandSlots(config: Mapping[str, Any]) -> int:
+    """Return the number of RUN commands of config that may run at once, i.e., its CPUS."""
+    try:
+        cpus = TestAdmission.resourceDemand(config.get("RESOURCES"))[TestAdmission.CPUS]
+    except ValueError:
+        return 1
+    return max(1, int(cpus))
+
+
+def runDependencies(config: Mapping[str, Any]) -> Dict[str, List[str]]:
+    """Return the RUN commands each RUN command of config runs after, from its RUN_AFTER section.
+
+    Raises ValueError if RUN_AFTER names a command that is not in RUN, or if
+    the commands depend on each other in a cycle.
+    """
+    keys = list(config.get("RUN") or {})
+    after = {}
+    for key, value in (config.get("RUN_AFTER") or {}).items():
+        if key not in keys:
+            raise ValueError("RUN_AFTER has an entry for '{}', which is not a RUN command".format(key))
+        dependencies = [d.strip() for d in (value if isinstance(value, (list, tuple)) else [value]) if d.strip()]
+        for dependency in dependencies:
+            if dependency not in keys:
+                raise ValueError(
+                    "'{}' runs after '{}' in RUN_AFTER, which is not a RUN command".format(key, dependency)
+                )
+        after[key] = dependencies
+
+    # Every command must eventually become ready.
+    done: List[str] = []
+    while len(done) < len(keys):
+        ready = [k for k in keys if k not in done and all(d in done for d in after.get(k, []))]
+        if not ready:
+            raise ValueError(
+                "The RUN_AFTER commands {} depend on each other in a cycle".format(
+                    ", ".join(k for k in keys if k not in done)
+                )
+            )
+        done.extend(ready)
+
+    return after
+
+
+def dependents(after: Dict[str, List[str]]) -> Dict[str, Set[str]]:
+    """Return the commands that run after each command, directly or indirectly, keyed by command."""
+    result: Dict[str, Set[str]] = {}
+
+    def collect(key: str) -> Set[str]:
+        if key not in result:
+            result[key] = set()
+            for other, dependencies in after.items():
+                if key in dependencies:
+                    result[key].add(other)
+                    result[key].update(collect(other))
+        return result[key]
+
+    for key in set(after).union(*after.values()):
+        collect(key)
+    return result
+
+
+def matchesOutputs(filename: str, patterns: List[str]) -> bool:
+    """Return True if filename matches any of the RUN_OUTPUTS patterns."""
+    return any(fnmatch.fnmatchcase(filename, pattern) for pattern in patterns)
+
+
+def runGraph(keys: List[str], after: Dict[str, List[str]], max_workers: int, run: Callable[[str], Any]):
+    """Call run(key) for each of keys, on up to max_workers threads at once.
+
+    A key is only run once all of the keys in after[key] have been run.
+    Otherwise, the keys are started in order. If run raises an exception, no
+    more keys are started, and the exception is raised once the running calls
+    have returned. after must not have cycles (see runDependencies).
+    """
+    max_workers = max(1, max_workers)
+    remaining = list(keys)
+    done = set()
+    running: Dict[concurrent.futures.Future, str] = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dtest-run") as executor:
+        while remaining or running:
+            for key in [k for k in remaining if all(d in done for d in after.get(k, []))]:
+                if len(running) >= max_workers:
+                    break
+                remaining.remove(key)
+                running[executor.submit(run, key)] = key
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                done.add(running.pop(future))
+                future.result()
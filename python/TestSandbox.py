@@ -0,0 +1,222 @@
+"""Native discovery of the module test directories of a YAM sandbox.
+
+dtest-sbox normally collects the test directory of every module in the
+sandbox with "make regtest-dir", which writes one line per module to
+regtest_directories.txt: the test directory, optionally followed by dtest
+arguments for that module (see testDirAndArgs in dtest-sbox). Running make
+over the whole sandbox is slow, so findTestDirs produces the same lines by
+reading the DTEST_TESTDIR setting of the module makefiles directly, e.g.,
+
+    DTEST_TESTDIR := test
+    DTEST_TESTDIR := test --jobs 1
+
+The makefiles are read in parallel, and the results are cached in a file at
+the top of the sandbox keyed by the modification time of each makefile. If a
+setting can only be resolved by make (e.g., it references other variables or
+is set conditionally), findTestDirs returns None and dtest-sbox falls back to
+"make regtest-dir".
+
+The module makefiles include the makefiles of the SiteDefs directory (e.g.,
+overall.mk and makefile-yam-tail.mk), which are not read like the module
+makefiles. A module that does not set DTEST_TESTDIR itself may get it from
+them, and they may change the settings of the modules, so findTestDirs also
+falls back to make in both cases. Modules without tests can set DTEST_TESTDIR
+to nothing. The SiteDefs makefiles are only checked for DTEST_TESTDIR again
+when their modification times change.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import concurrent.futures
+import json
+import os
+import re
+
+from Dutils.typing import Dict, Any, List, Optional
+
+from . import TestFiles
+
+# Name of the cache file created in the top of the sandbox.
+CACHE_FILENAME = ".dtest_sbox_dirs"
+
+# Bump this whenever the layout of the cache entries changes.
+CACHE_VERSION = 2
+
+# Makefiles of a module, in the order make looks for them.
+MAKEFILES = ("Makefile", "Makefile.yam")
+
+# The directory of the makefiles the module makefiles include, relative to the top of the sandbox.
+SITEDEFS_DIR = os.path.join("etc", "SiteDefs")
+
+_ASSIGNMENT = re.compile(r"^(?:override\s+)?DTEST_TESTDIR\s*(::=|:=|\?=|\+=|=)\s*(.*)$")
+_CONDITIONAL = re.compile(r"^(ifeq|ifneq|ifdef|ifndef)\b")
+
+
+def findTestDirs(yam_root: str, max_workers: int = 8) -> Optional[List[str]]:
+    """Return the regtest_directories.txt lines of the modules in the sandbox.
+
+    Parameters
+    ----------
+    yam_root : str
+        The top of the sandbox. The modules are the directories in its src directory.
+    max_workers : int
+        Maximum number of threads used to read the makefiles.
+
+    Returns
+    -------
+    Optional[List[str]]
+        One line per module with a DTEST_TESTDIR setting, sorted by module. None if the
+        settings have to be resolved by make instead.
+    """
+    src_dir = os.path.join(yam_root, "src")
+    try:
+        module_dirs = sorted(entry.path for entry in os.scandir(src_dir) if entry.is_dir())
+    except OSError:
+        return None
+
+    cache_path = os.path.join(yam_root, CACHE_FILENAME)
+    cache = _loadCache(cache_path)
+    sitedefs = _siteDefsEntry(os.path.join(yam_root, SITEDEFS_DIR), cache.get("sitedefs"))
+
+    modules = cache.get("modules", {})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        entries = list(executor.map(lambda module_dir: _moduleEntry(module_dir, modules.get(module_dir)), module_dirs))
+
+    new_cache = {"sitedefs": sitedefs, "modules": dict(zip(module_dirs, entries))}
+    if new_cache != cache:
+        _saveCache(cache_path, new_cache)
+
+    if sitedefs["mentions_testdir"] or not all(entry["resolved"] for entry in entries):
+        return None
+
+    return [entry["line"] for entry in entries if entry["line"]]
+
+
+def readTestDir(makefile: str) -> Optional[str]:
+    """Return the value of DTEST_TESTDIR in makefile.
+
+    Returns None if the value can only be resolved by make, including if
+    makefile does not set it, as it may then come from an included makefile.
+    """
+    with open(makefile, "r") as f:
+        # Join continuation lines like make does.
+        lines = re.sub(r"\s*\\\n\s*", " ", f.read()).splitlines()
+
+    value = None
+    depth = 0
+    for line in lines:
+        if line.startswith("\t"):
+            # Recipe lines are shell commands, not assignments.
+            continue
+        line = line.split("#", 1)[0].strip()
+
+        if _CONDITIONAL.match(line):
+            depth += 1
+            continue
+        if line == "endif":
+            depth -= 1
+            continue
+
+        match = _ASSIGNMENT.match(line)
+        if match is None:
+            continue
+
+        operator, rhs = match.groups()
+        if depth > 0 or "$" in rhs:
+            return None
+
+        if operator == "+=":
+            value = ((value or "") + " " + rhs).strip()
+        elif operator != "?=" or not value:
+            value = rhs.strip()
+
+    return value
+
+
+def _moduleEntry(module_dir: str, cached: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Return the cache entry of a module, re-reading its makefile if it changed."""
+    for name in MAKEFILES:
+        makefile = os.path.join(module_dir, name)
+        try:
+            mtime = os.stat(makefile).st_mtime_ns
+        except OSError:
+            continue
+
+        if cached is not None and cached["makefile"] == makefile and cached["mtime"] == mtime:
+            return cached
+
+        try:
+            test_dir = readTestDir(makefile)
+        except (IOError, OSError, UnicodeDecodeError):
+            test_dir = None
+
+        line = None
+        if test_dir:
+            # Arguments for the module follow the directory, as in regtest_directories.txt.
+            idx = test_dir.find(" --")
+            if idx < 0:
+                line = os.path.join(module_dir, test_dir)
+            else:
+                line = os.path.join(module_dir, test_dir[:idx].strip()) + test_dir[idx:]
+
+        return {"makefile": makefile, "mtime": mtime, "line": line, "resolved": test_dir is not None}
+
+    # Not a module.
+    return {"makefile": None, "mtime": None, "line": None, "resolved": True}
+
+
+def _siteDefsEntry(sitedefs_dir: str, cached: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Return the cache entry of the SiteDefs makefiles, re-reading them if any of them changed.
+
+    "mentions_testdir" is True if any of them mentions DTEST_TESTDIR, or cannot be read.
+    """
+    mtimes = {}
+    for root, dirs, files in os.walk(sitedefs_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(".mk"):
+                path = os.path.join(root, name)
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+
+    if cached is not None and cached["mtimes"] == mtimes:
+        return cached
+
+    mentions_testdir = False
+    for path in mtimes:
+        try:
+            with open(path, "r") as f:
+                mentions_testdir = "DTEST_TESTDIR" in f.read()
+        except (IOError, OSError, UnicodeDecodeError):
+            mentions_testdir = True
+        if mentions_testdir:
+            break
+
+    return {"mtimes": mtimes, "mentions_testdir": mentions_testdir}
+
+
+def _loadCache(cache_path: str) -> Dict[str, Dict[str, Any]]:
+    """Load the cache file. A missing or stale cache is ignored."""
+    try:
+        with open(cache_path, "r") as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    if isinstance(data, dict) and data.get("version") == CACHE_VERSION:
+        return {"sitedefs": data.get("sitedefs"), "modules": data.get("modules", {})}
+    return {}
+
+
+def _saveCache(cache_path: str, cache: Dict[str, Any]):
+    """Write the cache file atomically. Failures are ignored, since the cache is only an optimization."""
+    try:
+        TestFiles.writeAtomically(cache_path, lambda f: json.dump(dict(cache, version=CACHE_VERSION), f))
+    except (IOError, OSError):
+        pass
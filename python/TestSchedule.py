@@ -0,0 +1,143 @@
+"""Duration-aware ordering of the tests.
+
+In parallel mode the tests are handed to the pool in order, so a long test
+that happens to be discovered last extends the total run time. orderTests
+sorts the tests longest expected duration first (LPT), using the elapsed
+times of a previous run, read from regtest.data files or the regtest HDF5
+store. The tests of a SERIAL group run one after the other in one worker, so
+a group counts with the sum of the durations of its tests. Tests without a
+known duration keep their place relative to each other after the known ones.
+
+predictMakespan estimates the wall-clock time of a run from the same
+durations, which dtest reports next to the actual time at the end of the run.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import heapq
+import os
+import statistics
+
+from Dutils.typing import Dict, List, Optional, Union
+
+NestedStringList = List[Union[str, List[str]]]
+
+
+def loadDurations(filename: str, root_dir: str, module_name: str = "") -> Dict[str, float]:
+    """Return the elapsed times of the tests in a regtest.data file or a regtest HDF5 store.
+
+    Parameters
+    ----------
+    filename : str
+        A regtest.data file written by dtest, or a regtest HDF5 store (*.h5 or *.hdf5).
+    root_dir : str
+        The directory the test names in an HDF5 store are relative to.
+    module_name : str
+        The module to read from an HDF5 store.
+
+    Returns
+    -------
+    Dict[str, float]
+        The elapsed time in seconds, keyed by the full path of the test directory.
+        Empty if the file could not be read.
+    """
+    try:
+        if os.path.splitext(filename)[1] in (".h5", ".hdf5"):
+            return _loadHdf5Durations(filename, root_dir, module_name)
+        return _loadRegtestDataDurations(filename)
+    except Exception:
+        # The durations only affect the order of the tests.
+        return {}
+
+
+def _loadRegtestDataDurations(filename: str) -> Dict[str, float]:
+    """Return the elapsed times in a regtest.data file."""
+    namespace = {"datetime": datetime}
+    with open(filename, "r") as f:
+        exec(compile(f.read(), filename, "exec"), namespace)
+
+    durations = {}
+    for module_data in namespace.get("regdata", {}).values():
+        for test, test_data in module_data["tests"].items():
+            # A cancelled test did not run to the end.
+            if not test_data.get("cancelled"):
+                durations[os.path.join(module_data["root_dir"], test)] = float(test_data["elapsed_time"])
+    return durations
+
+
+def _loadHdf5Durations(filename: str, root_dir: str, module_name: str) -> Dict[str, float]:
+    """Return the elapsed times of module_name in the latest run of each sandbox in a regtest HDF5 store."""
+    import h5py
+
+    durations: Dict[str, float] = {}
+    with h5py.File(filename, "r") as store:
+        for sandbox in store:
+            # The file groups are named after the date of the run.
+            for file_key in sorted(store[sandbox], reverse=True):
+                if module_name not in store[sandbox][file_key]:
+                    continue
+                dataset = store[sandbox][file_key][module_name]
+                for name, elapsed_time in zip(dataset["name"], dataset["elapsed_time"]):
+                    if isinstance(name, bytes):
+                        name = name.decode("utf-8")
+                    durations.setdefault(os.path.join(root_dir, name), float(elapsed_time))
+                break
+    return durations
+
+
+def expectedDuration(test: Union[str, List[str]], durations: Dict[str, float]) -> Optional[float]:
+    """Return the expected duration of a test or a SERIAL group, or None if it is not known.
+
+    A SERIAL group is known if any of its tests is known.
+    """
+    if isinstance(test, str):
+        return durations.get(test)
+
+    known = [durations[t] for t in test if t in durations]
+    if not known:
+        return None
+    return sum(known)
+
+
+def orderTests(test_list: NestedStringList, durations: Dict[str, float]) -> NestedStringList:
+    """Return test_list with the tests of known duration first, longest first."""
+    known = []
+    unknown = []
+    for test in test_list:
+        duration = expectedDuration(test, durations)
+        if duration is None:
+            unknown.append(test)
+        else:
+            known.append((duration, test))
+
+    known.sort(key=lambda x: -x[0])
+    return [test for _, test in known] + unknown
+
+
+def predictMakespan(test_list: NestedStringList, durations: Dict[str, float], jobs: int) -> Optional[float]:
+    """Return the expected wall-clock time of running test_list in order on jobs workers.
+
+    Tests of unknown duration are assumed to take the median known duration.
+    Returns None if no durations are known.
+    """
+    known = [durations[t] for t in _flatten(test_list) if t in durations]
+    if not known:
+        return None
+    default = statistics.median(known)
+
+    workers = [0.0] * max(1, jobs)
+    for test in test_list:
+        tests = [test] if isinstance(test, str) else test
+        duration = sum(durations.get(t, default) for t in tests)
+        heapq.heappush(workers, heapq.heappop(workers) + duration)
+    return max(workers)
+
+
+def _flatten(test_list: NestedStringList) -> List[str]:
+    """Return the tests of test_list, with the SERIAL groups expanded."""
+    return [t for test in test_list for t in ([test] if isinstance(test, str) else test)]
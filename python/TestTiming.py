@@ -0,0 +1,84 @@
+"""Where the time of the tests goes.
+
+The elapsed_time of a test covers everything from resolving its config to
+cleaning up after it, so each test also records the time of its phases in
+the "phases" entry of its record in the regtest data, in seconds:
+
+* config: resolving the DTESTDEFS configs of the test.
+* queue: waiting for the resources of the test to be free (see TestAdmission).
+* gpu_wait: waiting for the GPU memory of the test (see GPU_MEM).
+* run: a dictionary of the time of each RUN command, by key.
+* compare: a dictionary of the time of comparing each output file with its
+  truth files, by output file name.
+* cleanup: deleting the DELETE files.
+
+Phases that a test does not go through are left out. With the
+'--timing-report' option, TimingReport adds up the phases of all tests, and
+the summary lists the total of each phase and the slowest phases of any test.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import heapq
+
+from Dutils.typing import Any, Dict, List, Tuple
+
+# The phases in the order of a test. See phaseTimes.
+PHASES = ["config", "queue", "gpu_wait", "run", "compare", "cleanup"]
+
+
+def phaseTimes(phases: Dict[str, Any]) -> List[Tuple[str, str, float]]:
+    """Return (phase, label, seconds) of each of phases, e.g., ("run", "run test1", 1.5)."""
+    times = []
+    for phase in PHASES:
+        value = phases.get(phase)
+        if isinstance(value, dict):
+            times.extend((phase, "{} {}".format(phase, name), seconds) for name, seconds in value.items())
+        elif value is not None:
+            times.append((phase, phase, value))
+    return times
+
+
+class TimingReport(object):
+    """Adds up the phases of the tests, and keeps the slowest ones.
+
+    Parameters
+    ----------
+    count : int
+        The number of slowest phases to list.
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self.totals: Dict[str, float] = {}
+        # A heap of the (seconds, test, label) of the slowest phases.
+        self._slowest: List[Tuple[float, str, str]] = []
+
+    def add(self, name: str, phases: Dict[str, Any]):
+        """Add the phases of the name test."""
+        for phase, label, seconds in phaseTimes(phases):
+            self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+            entry = (seconds, name, label)
+            if len(self._slowest) < self.count:
+                heapq.heappush(self._slowest, entry)
+            elif self._slowest and entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def lines(self) -> List[str]:
+        """Return the lines of the report."""
+        total = sum(self.totals.values())
+        lines = ["Time by phase:"]
+        for phase in PHASES:
+            if phase in self.totals:
+                seconds = self.totals[phase]
+                share = 100.0 * seconds / total if total else 0.0
+                lines.append("    {:<10} {:>10.2f} s {:>5.1f}%".format(phase, seconds, share))
+
+        lines.append("Slowest {} phases:".format(len(self._slowest)))
+        for seconds, name, label in sorted(self._slowest, reverse=True):
+            lines.append("    {:>10.2f} s  {}: {}".format(seconds, name, label))
+        return lines
@@ -0,0 +1,241 @@
+"""Tuning the RESOURCES and TIMEOUT of the tests from their measured usage.
+
+The dtest-update-resources script reads what the tests used in previous runs
+from regtest.data files (see TestMonitor, TestUsage and TestTiming) or from
+a regtest HDF5 store, and rewrites the DTESTDEFS files of the tests to
+match, with some headroom:
+
+* CPUS: the most CPUs the processes of the test used at once (max_cpu of its
+  "peaks", recorded with '--monitor'), or else the CPU time of its commands
+  divided by their run time, rounded up unless it is less than CPU_TOLERANCE
+  over a whole CPU. CPUS is left out if it is 1, the default.
+* MEM: the largest total resident set size of the processes of the test
+  (max_rss_kb of its "peaks"), plus the headroom. MEM is left out if it is
+  less than a minimum, as tests that use little memory can share the node
+  freely. The max_rss_kb of the "rusage" is not used, as it includes the
+  resident set of the forked dtest worker, so MEM is only tuned from runs
+  with '--monitor'.
+* TIMEOUT: the longest RUN command of the test (its "run" phases), or else
+  the elapsed time of the test. TIMEOUT applies to each command. Tests that
+  timed out are not used for it, as their time is that of the old TIMEOUT.
+
+The HDF5 store only records the elapsed time of each test, so it only tunes
+the TIMEOUT. With several runs, the largest usage of each test is used.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import math
+import os
+
+from Dutils.typing import Any, Dict, List, Optional
+
+# The CPUs a test may use over a whole number of CPUs without needing another one. See tunedSettings.
+CPU_TOLERANCE = 0.2
+
+# The units of the MEM amounts written, largest first. See formatAmount.
+MEM_UNITS = [("TB", 1024**4), ("GB", 1024**3), ("MB", 1024**2), ("kB", 1024)]
+
+
+def _maxInto(measurements: Dict[str, Dict[str, float]], test_dir: str, key: str, value: Optional[float]):
+    """Keep the largest value of key for test_dir."""
+    if value is None:
+        return
+    usage = measurements.setdefault(test_dir, {})
+    usage[key] = max(usage.get(key, 0.0), float(value))
+
+
+def testMeasurements(test_data: Dict[str, Any]) -> Dict[str, float]:
+    """Return the measured "cpus", "mem" (in bytes) and "command_time" of a test record in the regtest data.
+
+    Usages that were not recorded are left out.
+    """
+    measurements: Dict[str, float] = {}
+    peaks = test_data.get("peaks") or {}
+    rusage = test_data.get("rusage") or {}
+    run_times = list(((test_data.get("phases") or {}).get("run") or {}).values())
+
+    if peaks.get("samples"):
+        measurements["cpus"] = peaks["max_cpu"]
+    elif rusage and sum(run_times) > 0:
+        measurements["cpus"] = (rusage.get("user_time", 0.0) + rusage.get("system_time", 0.0)) / sum(run_times)
+
+    if peaks.get("samples"):
+        # Not the max_rss_kb of rusage, which counts the memory of the dtest worker that forked the commands.
+        measurements["mem"] = peaks["max_rss_kb"] * 1024.0
+
+    if not test_data.get("timed_out"):
+        measurements["command_time"] = max(run_times) if run_times else float(test_data["elapsed_time"])
+    return measurements
+
+
+def loadMeasurements(filenames: List[str], root_dir: str = "", module_name: str = "") -> Dict[str, Dict[str, float]]:
+    """Return the largest measurements of each test in regtest.data files or regtest HDF5 stores.
+
+    Parameters
+    ----------
+    filenames : List[str]
+        regtest.data files written by dtest, or regtest HDF5 stores (*.h5 or *.hdf5).
+    root_dir : str
+        The directory the test names in an HDF5 store are relative to.
+    module_name : str
+        The module to read from an HDF5 store.
+
+    Returns
+    -------
+    Dict[str, Dict[str, float]]
+        The measurements (see testMeasurements), keyed by the full path of the test directory.
+    """
+    measurements: Dict[str, Dict[str, float]] = {}
+    for filename in filenames:
+        if os.path.splitext(filename)[1] in (".h5", ".hdf5"):
+            _loadHdf5Measurements(measurements, filename, root_dir, module_name)
+            continue
+
+        namespace = {"datetime": datetime}
+        with open(filename, "r") as f:
+            exec(compile(f.read(), filename, "exec"), namespace)
+        for module_data in namespace.get("regdata", {}).values():
+            for test, test_data in module_data["tests"].items():
+                # A cancelled test did not run to the end.
+                if test_data.get("cancelled"):
+                    continue
+                test_dir = os.path.join(module_data["root_dir"], test)
+                for key, value in testMeasurements(test_data).items():
+                    _maxInto(measurements, test_dir, key, value)
+    return measurements
+
+
+def _loadHdf5Measurements(measurements: Dict[str, Dict[str, float]], filename: str, root_dir: str, module_name: str):
+    """Add the elapsed times of module_name in all the runs in a regtest HDF5 store to measurements."""
+    import h5py
+
+    with h5py.File(filename, "r") as store:
+        for sandbox in store:
+            for file_key in store[sandbox]:
+                if module_name not in store[sandbox][file_key]:
+                    continue
+                dataset = store[sandbox][file_key][module_name]
+                for name, elapsed_time, timed_out in zip(
+                    dataset["name"], dataset["elapsed_time"], dataset["timed_out"]
+                ):
+                    if isinstance(name, bytes):
+                        name = name.decode("utf-8")
+                    if not int(timed_out):
+                        _maxInto(measurements, os.path.join(root_dir, name), "command_time", float(elapsed_time))
+
+
+def formatAmount(amount: float) -> str:
+    """Return amount bytes in the largest unit it has at least 1 of, rounded up to 1 decimal, e.g., "1.3GB"."""
+    unit, size = next(((unit, size) for unit, size in MEM_UNITS if amount >= size), MEM_UNITS[-1])
+    value = math.ceil(amount / size * 10) / 10
+    return ("%.1f" % value).rstrip("0").rstrip(".") + unit
+
+
+def tunedSettings(
+    measurements: Dict[str, float], headroom: float, min_mem: float, timeout_factor: float, min_timeout: int
+) -> Dict[str, Optional[str]]:
+    """Return the CPUS, MEM and TIMEOUT settings for the measurements of a test.
+
+    A setting is None if it should be removed, i.e., the default is right.
+    Settings that were not measured are left out, so they are kept as they are.
+
+    Parameters
+    ----------
+    measurements : Dict[str, float]
+        The measurements of the test, see testMeasurements.
+    headroom : float
+        The fraction added to the measured MEM.
+    min_mem : float
+        The smallest MEM in bytes that is written.
+    timeout_factor : float
+        The TIMEOUT is the longest command time times this factor.
+    min_timeout : int
+        The smallest TIMEOUT in seconds that is written.
+    """
+    settings: Dict[str, Optional[str]] = {}
+    if "cpus" in measurements:
+        # The CPUs are averaged over the samples, so a test that keeps 2 CPUs busy may show 2.1.
+        cpus = max(1, math.ceil(measurements["cpus"] - CPU_TOLERANCE))
+        settings["CPUS"] = str(cpus) if cpus > 1 else None
+    if "mem" in measurements:
+        mem = measurements["mem"] * (1 + headroom)
+        settings["MEM"] = formatAmount(mem) if mem >= min_mem else None
+    if "command_time" in measurements:
+        settings["TIMEOUT"] = str(max(min_timeout, int(math.ceil(measurements["command_time"] * timeout_factor))))
+    return settings
+
+
+def _isSection(line: str) -> bool:
+    """Return whether line is a section header, e.g., "[RUN]"."""
+    return line.strip().startswith("[")
+
+
+def _entryIndex(lines: List[str], start: int, end: int, name: str) -> int:
+    """Return the index of the name entry in lines[start:end], or -1."""
+    for k in range(start, end):
+        key, sep, _ = lines[k].partition("=")
+        if sep and key.strip() == name:
+            return k
+    return -1
+
+
+def _setEntry(lines: List[str], start: int, end: int, name: str, value: Optional[str], indent: str):
+    """Set, add (at end) or remove (if value is None) the name entry in lines[start:end]."""
+    k = _entryIndex(lines, start, end, name)
+    if k >= 0:
+        line = lines[k]
+        old_value, _, comment = line.partition("=")[2].partition("#")
+        if value is None:
+            lines.pop(k)
+        elif old_value.strip() != value:
+            # Keep the indentation and any comment of the entry.
+            prefix = line[: len(line) - len(line.lstrip())]
+            lines[k] = "{}{} = {}{}\n".format(prefix, name, value, "  #" + comment.rstrip("\n") if comment else "")
+    elif value is not None:
+        # Add it after the last entry of the section, before any blank lines.
+        while end > start and not lines[end - 1].strip():
+            end -= 1
+        lines.insert(end, "{}{} = {}\n".format(indent, name, value))
+
+
+def updateConfigLines(lines: List[str], settings: Dict[str, Optional[str]]) -> List[str]:
+    """Return the lines of a DTESTDEFS file with the settings of tunedSettings.
+
+    TIMEOUT is a top-level entry, before the first section. CPUS and MEM are
+    entries of the RESOURCES section, which is added before the RUN section,
+    or at the end, if needed. Other lines are kept as they are, and lines is
+    returned as it is if the settings are already there.
+    """
+    new_lines = [line if line.endswith("\n") else line + "\n" for line in lines]
+    unchanged = list(new_lines)
+    _updateLines(new_lines, settings)
+    return lines if new_lines == unchanged else new_lines
+
+
+def _updateLines(lines: List[str], settings: Dict[str, Optional[str]]):
+    """Update lines in place. See updateConfigLines."""
+    if "TIMEOUT" in settings:
+        first_section = next((k for k, line in enumerate(lines) if _isSection(line)), len(lines))
+        _setEntry(lines, 0, first_section, "TIMEOUT", settings["TIMEOUT"], "")
+
+    resources = {name: settings[name] for name in ("CPUS", "MEM") if name in settings}
+    start = next((k + 1 for k, line in enumerate(lines) if line.strip() == "[RESOURCES]"), -1)
+    if start < 0:
+        if all(value is None for value in resources.values()):
+            return
+        run = next((k for k, line in enumerate(lines) if line.strip() == "[RUN]"), len(lines))
+        if run == len(lines) and lines and lines[-1].strip():
+            lines.append("\n")
+            run += 1
+        lines[run:run] = ["[RESOURCES]\n", "\n"] if run < len(lines) else ["[RESOURCES]\n"]
+        start = run + 1
+
+    for name, value in resources.items():
+        end = next((k for k in range(start, len(lines)) if _isSection(lines[k])), len(lines))
+        _setEntry(lines, start, end, name, value, "    ")
@@ -0,0 +1,109 @@
+"""The resources used by the commands of the tests.
+
+Each RUN and comparison command records its resource usage in the "rusage"
+entry of its sub_tests or sub_cmps record in the regtest data, and each test
+records the total of its commands in its own "rusage" entry. A usage is a
+dictionary with the keys in FIELDS:
+
+* user_time and system_time, the CPU seconds spent in user and kernel mode.
+* max_rss_kb, the peak resident set size in kilobytes. Linux counts the
+  process that a command is forked from until it runs bash, so this is at
+  least the size of the dtest process that ran it.
+* block_input and block_output, the number of file system reads and writes
+  that went to the block devices, i.e., that missed the page cache.
+* voluntary_context_switches, mostly waiting for I/O, and
+  involuntary_context_switches, mostly being preempted by other processes.
+
+The usage of a command is that of its bash process and of the processes that
+it waited for, as reported by os.wait4. Processes that the command leaves
+running in the background, which are killed once it is done, are not
+included. Comparisons done in process (see TestComparators) record the usage
+of their thread instead, without max_rss_kb, which is only known for the
+whole dtest process. Commands run by the async executor (see TestExecutor)
+are reaped by the event loop, so their usage is not known.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import resource
+
+from Dutils.typing import Any, Dict, Iterable, Optional
+
+# The keys of a usage, and the struct_rusage fields that they come from.
+FIELDS = {
+    "user_time": "ru_utime",
+    "system_time": "ru_stime",
+    "max_rss_kb": "ru_maxrss",
+    "block_input": "ru_inblock",
+    "block_output": "ru_oublock",
+    "voluntary_context_switches": "ru_nvcsw",
+    "involuntary_context_switches": "ru_nivcsw",
+}
+
+# The keys that are peaks rather than counts, so they are not added up. See totalUsage.
+PEAKS = {"max_rss_kb"}
+
+
+def resourceUsage(rusage) -> Dict[str, Any]:
+    """Return the usage of rusage, as returned by os.wait4 or resource.getrusage."""
+    usage = {key: getattr(rusage, field) for key, field in FIELDS.items()}
+    usage["user_time"] = round(usage["user_time"], 6)
+    usage["system_time"] = round(usage["system_time"], 6)
+    return usage
+
+
+def threadUsage():
+    """Return the resource.getrusage of the current thread, or None where that is not supported."""
+    if not hasattr(resource, "RUSAGE_THREAD"):
+        return None
+    return resource.getrusage(resource.RUSAGE_THREAD)
+
+
+def threadUsageSince(before) -> Optional[Dict[str, Any]]:
+    """Return the usage of the current thread since threadUsage returned before, or None."""
+    if before is None:
+        return None
+    after = resourceUsage(threadUsage())
+    usage = {key: value - getattr(before, FIELDS[key]) for key, value in after.items() if key not in PEAKS}
+    usage["user_time"] = round(usage["user_time"], 6)
+    usage["system_time"] = round(usage["system_time"], 6)
+    return usage
+
+
+def totalUsage(usages: Iterable[Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """Return the total of usages, the maximum of the PEAKS, or None if no usage is known.
+
+    Unknown usages (None) and keys are left out.
+    """
+    total: Dict[str, Any] = {}
+    for usage in usages:
+        for key, value in (usage or {}).items():
+            if key in PEAKS:
+                total[key] = max(total.get(key, 0), value)
+            else:
+                total[key] = total.get(key, 0) + value
+    if not total:
+        return None
+    for key in ("user_time", "system_time"):
+        if key in total:
+            total[key] = round(total[key], 6)
+    return total
+
+
+def usageLine(usage: Optional[Dict[str, Any]]) -> str:
+    """Return a short description of usage for the log."""
+    if not usage:
+        return "unknown"
+    line = "user %.2fs, sys %.2fs" % (usage.get("user_time", 0), usage.get("system_time", 0))
+    if "max_rss_kb" in usage:
+        line += ", max RSS %d kB" % usage["max_rss_kb"]
+    return line + ", blocks in/out %d/%d, context switches %d/%d" % (
+        usage.get("block_input", 0),
+        usage.get("block_output", 0),
+        usage.get("voluntary_context_switches", 0),
+        usage.get("involuntary_context_switches", 0),
+    )
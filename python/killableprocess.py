@@ -2,9 +2,8 @@
 # from http://svn.smedbergs.us/python-processes/trunk/killableprocess.py
 #
 # (Abhi) This subclasses supprocess.Popen and adds a timeout argument to
-# its wait() method. Apparently the timeout only works on the main
-# thread. python 3 I believe adds the timeout option to the subprocess
-# Popen class directly.
+# its wait() method. python 3 I believe adds the timeout option to the
+# subprocess Popen class directly.
 #
 # Parts of this module are copied from the subprocess.py file contained
 # in the Python distribution.
@@ -39,7 +38,14 @@
 """killableprocess - Subprocesses which can be reliably killed.
 
 It adds a timeout argument to wait() for a limited period of time before
-forcefully killing the process.
+forcefully killing the process, and a cancel argument to stop the process
+from another thread or process.
+
+wait() sleeps until the process exits, rather than polling for it: on a
+pidfd (Linux 5.3 and later), which becomes readable when the process exits,
+or else until a SIGCHLD arrives (see ChildWatcher). It may be called from
+any number of threads at once. Once the process has been waited for, its
+rusage attribute holds its resource usage, as returned by os.wait4.
 
 """
 from __future__ import division
@@ -47,10 +53,13 @@ from __future__ import print_function
 
 from __future__ import absolute_import
 
+import errno
+import math
 import os
-import sys
+import select
 import signal
 import subprocess
+import threading
 import time
 
 
@@ -64,8 +73,125 @@ class TimeoutExpired(Exception):
         return "TimeoutExpired({})".format(self.seconds)
 
 
-def do_nothing(*args):
-    pass
+class Cancelled(Exception):
+    """Raised if the wait is cancelled."""
+
+    def __str__(self):
+        return "Cancelled"
+
+
+# Seconds a stopped process group has to exit after SIGTERM, before it is killed.
+STOP_GRACE = 2.0
+
+# Seconds between the checks whether a wait has been cancelled.
+CANCEL_POLL = 0.1
+
+# Seconds between the checks whether a process has exited, if neither a pidfd
+# nor the SIGCHLD handler of ChildWatcher is available.
+POLL_INTERVAL = 0.05
+
+
+def pidfd_open(pid):
+    """Return a pidfd of the child process pid, or None if pidfds are not supported.
+
+    The pidfd becomes readable when the process exits. The process must not
+    have been waited for yet, or pid may refer to another process.
+    """
+    if not hasattr(os, "pidfd_open"):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        # ENOSYS before Linux 5.3, or EPERM, e.g., in some sandboxes.
+        return None
+
+
+class ChildWatcher(object):
+    """Wakes up the threads waiting for child processes when a SIGCHLD arrives.
+
+    This uses the wakeup fd of the signal module (see signal.set_wakeup_fd),
+    which the interpreter writes to as soon as a signal arrives, on whichever
+    thread it arrives, whereas Python signal handlers only run on the main
+    thread. A thread reading the wakeup fd notifies the waiting threads.
+    Installing it requires the main thread, and that nothing else, e.g., an
+    asyncio event loop, uses the wakeup fd.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._installed = False
+        self._fds = None
+
+    @property
+    def generation(self):
+        """The number of times the waiting threads have been woken up. See wait."""
+        with self._condition:
+            return self._generation
+
+    def install(self):
+        """Install the SIGCHLD handler, if possible. Returns True if it is installed."""
+        with self._lock:
+            if self._installed:
+                return True
+            if threading.current_thread() is not threading.main_thread():
+                return False
+
+            read_fd, write_fd = os.pipe()
+            os.set_blocking(write_fd, False)
+            try:
+                previous_fd = signal.set_wakeup_fd(write_fd, warn_on_full_buffer=False)
+            except (ValueError, OSError):
+                previous_fd = None
+            if previous_fd != -1:
+                if previous_fd is not None:
+                    signal.set_wakeup_fd(previous_fd)
+                os.close(read_fd)
+                os.close(write_fd)
+                return False
+
+            # The interpreter only writes to the wakeup fd for signals with a Python handler.
+            previous = signal.getsignal(signal.SIGCHLD)
+
+            def handler(signum, frame):
+                if callable(previous):
+                    previous(signum, frame)
+
+            signal.signal(signal.SIGCHLD, handler)
+            self._fds = (read_fd, write_fd)
+            threading.Thread(target=self._read, args=(read_fd,), name="killableprocess-sigchld", daemon=True).start()
+            self._installed = True
+            return True
+
+    def wait(self, generation, timeout):
+        """Wait up to timeout seconds (None for no limit) for a SIGCHLD after generation was read."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._generation != generation, timeout)
+
+    def _read(self, read_fd):
+        """Wake up the waiting threads whenever a signal is written to read_fd."""
+        while True:
+            os.read(read_fd, 512)
+            with self._condition:
+                self._generation += 1
+                self._condition.notify_all()
+
+    def _reset(self):
+        """Uninstall in a forked child, which does not have the reading thread. See install."""
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+        if self._installed:
+            signal.set_wakeup_fd(-1)
+            for fd in self._fds:
+                os.close(fd)
+            self._fds = None
+            self._installed = False
+
+
+child_watcher = ChildWatcher()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=child_watcher._reset)
 
 
 class Popen(subprocess.Popen):
@@ -73,6 +199,9 @@ class Popen(subprocess.Popen):
     # Override __init__ to set a preexec_fn
 
     def __init__(self, *args, **kwargs):
+        # Guards _pidfd, which a thread that reaps the process closes while others may wait on it.
+        self._pidfd_lock = threading.Lock()
+        self._pidfd = None
         if len(args) >= 7:
             raise Exception("Arguments preexec_fn and after must be passed by " "keyword.")
 
@@ -85,8 +214,54 @@ class Popen(subprocess.Popen):
 
         kwargs["preexec_fn"] = setpgid_preexec_fn
 
+        # The resource usage of the process, as returned by os.wait4, once it has been waited for.
+        self.rusage = None
         subprocess.Popen.__init__(self, *args, **kwargs)
 
+        # The process cannot have been waited for yet, so its pid is still its own.
+        self._pidfd = pidfd_open(self.pid)
+
+    def _handle_exitstatus(self, *args, **kwargs):
+        subprocess.Popen._handle_exitstatus(self, *args, **kwargs)
+        self._close_pidfd()
+
+    def _waitpid(self, pid, options):
+        """os.waitpid, also recording the resource usage of the process in rusage."""
+        pid, sts, rusage = os.wait4(pid, options)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
+
+    def _try_wait(self, wait_flags):
+        try:
+            return self._waitpid(self.pid, wait_flags)
+        except ChildProcessError:
+            # As subprocess does, e.g., if SIGCHLD is ignored.
+            return (self.pid, 0)
+
+    def _internal_poll(self, *args, **kwargs):
+        kwargs["_waitpid"] = self._waitpid
+        return subprocess.Popen._internal_poll(self, *args, **kwargs)
+
+    def _close_pidfd(self):
+        with self._pidfd_lock:
+            if self._pidfd is not None:
+                os.close(self._pidfd)
+                self._pidfd = None
+
+    def _dup_pidfd(self):
+        """Return a duplicate of the pidfd, which the caller must close, or None if there is none.
+
+        The duplicate stays open while another thread reaps the process and
+        closes the pidfd, so its number cannot be reused by another file.
+        """
+        with self._pidfd_lock:
+            return None if self._pidfd is None else os.dup(self._pidfd)
+
+    def __del__(self, *args, **kwargs):
+        self._close_pidfd()
+        subprocess.Popen.__del__(self, *args, **kwargs)
+
     def kill(self, group=True):
         """Kill the process.
 
@@ -99,45 +274,96 @@ class Popen(subprocess.Popen):
             os.kill(self.pid, signal.SIGKILL)
         self.returncode = -9
 
-    def wait(self, timeout=-1, group=True):
+    def _signal(self, signum, group):
+        """Send signum to the process, or its process group if group=True, unless they are gone."""
+        try:
+            if group:
+                os.killpg(self.pid, signum)
+            else:
+                os.kill(self.pid, signum)
+        except OSError as e:
+            # Handles the case where the process is already dead
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _wait_exit(self, timeout):
+        """Wait up to timeout seconds (None for no limit) for the process to exit.
+
+        Returns returncode attribute, which is None if the process is still running.
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            generation = child_watcher.generation
+            if self.poll() is not None:
+                return self.returncode
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+
+            pidfd = self._dup_pidfd()
+            if pidfd is not None:
+                try:
+                    poller = select.poll()
+                    poller.register(pidfd, select.POLLIN)
+                    poller.poll(None if remaining is None else math.ceil(remaining * 1000))
+                finally:
+                    os.close(pidfd)
+            elif child_watcher.install():
+                child_watcher.wait(generation, remaining)
+            else:
+                time.sleep(POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining))
+
+    def stop(self, group=True, grace=STOP_GRACE):
+        """Stop the process.
+
+        The process is sent SIGTERM, so it can clean up, and is killed if it
+        has not exited after grace seconds. If group=True, all sub-processes
+        are also stopped, and the ones that are left once the process has
+        exited are killed. Returns returncode attribute.
+
+        """
+        self._signal(signal.SIGTERM, group)
+        if self._wait_exit(grace) is None or group:
+            self._signal(signal.SIGKILL, group)
+        return self._wait_exit(None)
+
+    def wait(self, timeout=-1, group=True, cancel=None):
         """Wait for the process to terminate.
 
         Returns returncode attribute.
         If timeout seconds are reached and the process has not terminated,
         it will be forcefully killed. If timeout is -1, wait will not
-        time out.
+        time out. If cancel, e.g., a threading.Event, is set while waiting,
+        the process is stopped (see stop) and Cancelled is raised.
 
         """
 
         if self.returncode is not None:
             return self.returncode
 
-        if timeout == -1:
+        if timeout == -1 and cancel is None:
             subprocess.Popen.wait(self)
             return self.returncode
 
-        starttime = time.time()
+        deadline = None if timeout == -1 else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
 
-        # Make sure there is a signal handler for SIGCHLD installed
-        oldsignal = signal.signal(signal.SIGCHLD, do_nothing)
-
-        while time.time() < starttime + timeout - 0.01:
-            pid, sts = os.waitpid(self.pid, os.WNOHANG)
-            if pid != 0:
-                self._handle_exitstatus(sts)
-                signal.signal(signal.SIGCHLD, oldsignal)
+            # The exit of the process ends the wait right away, but a cancel is only seen every CANCEL_POLL seconds.
+            if cancel is not None:
+                remaining = CANCEL_POLL if remaining is None else min(CANCEL_POLL, remaining)
+            if self._wait_exit(remaining) is not None:
                 return self.returncode
 
-            # time.sleep is interrupted by signals (good!)
-            newtimeout = timeout - time.time() + starttime
-            if sys.version_info[0] >= 3:
-                # In python 3, need smaller times
-                # (maybe signal interruption is not working?)
-                newtimeout = min(0.5, newtimeout)
-            time.sleep(newtimeout)
-
-        self.kill(group)
-        signal.signal(signal.SIGCHLD, oldsignal)
-        subprocess.Popen.wait(self)
+            if cancel is not None and cancel.is_set():
+                self.stop(group)
+                raise Cancelled()
+
+        self._signal(signal.SIGKILL, group)
+        self._wait_exit(None)
 
         raise TimeoutExpired(timeout)
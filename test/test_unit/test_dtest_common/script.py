@@ -0,0 +1,160 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import datetime
+import os
+import types
+import unittest
+from Dtest import DtestCommon
+from Dtest import Test
+
+
+class ResultCollectorTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.__temporary_file_path = tempfile.mkdtemp()
+        self.data = os.path.join(self.__temporary_file_path, "regtest.data")
+        self.args = types.SimpleNamespace(
+            data=self.data,
+            directory=self.__temporary_file_path,
+            top_test_dir=self.__temporary_file_path,
+            uuid=0,
+            timing_report=False,
+            timing_report_count=10,
+        )
+        self.logged = []
+        self.__log_tee = Test.logTee
+        Test.logTee = lambda log_num, msg: self.logged.append(msg)
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        Test.logTee = self.__log_tee
+        shutil.rmtree(path=self.__temporary_file_path, ignore_errors=True)
+
+    def readData(self):
+        namespace = {}
+        with open(self.data, "r") as f:
+            exec(compile(f.read(), self.data, "exec"), namespace)
+        return namespace["regdata"]
+
+    def testRecordsAreWrittenAsTheyAreAdded(self):
+        start_time = datetime.datetime(2020, 1, 1)
+        collector = DtestCommon.ResultCollector(self.args, start_time, "Mod", report_failures=True)
+
+        collector.add((1, 0, {"test_a": {"elapsed_time": 1.0, "run": [1, 1]}}))
+        regdata = self.readData()
+        self.assertEqual(list(regdata["Mod"]["tests"]), ["test_a"])
+        self.assertEqual(regdata["Mod"]["start_time"], start_time)
+        self.assertEqual(self.logged, [])
+
+        collector.add(None)
+        collector.add((0, 1, {"test_b": {"elapsed_time": 2.0, "run": [0, 1]}}))
+        regdata = self.readData()
+        self.assertEqual(sorted(regdata["Mod"]["tests"]), ["test_a", "test_b"])
+        self.assertIsInstance(regdata["Mod"]["end_time"], datetime.datetime)
+        self.assertGreater(regdata["Mod"]["end_time"], start_time)
+
+        # The failure is reported right away, and only the failed records are kept.
+        self.assertEqual(len(self.logged), 1)
+        self.assertTrue(self.logged[0].startswith("FAILED: "))
+        self.assertIn("test_b", self.logged[0])
+        self.assertEqual((collector.success, collector.failed), (1, 1))
+        self.assertEqual(list(collector.failure_data), ["test_b"])
+
+    def testCancelledTests(self):
+        collector = DtestCommon.ResultCollector(self.args, datetime.datetime(2020, 1, 1), "Mod", report_failures=True)
+        collector.add((0, 1, {"test_a": {"run": [0, 1]}}))
+        collector.add((0, 0, {"test_b": {"run": [0, 1], "cancelled": True}}))
+
+        # Cancelled tests count as neither succeeded nor failed, and are reported as such.
+        self.assertEqual((collector.success, collector.failed, collector.cancelled), (0, 1, ["test_b"]))
+        self.assertEqual(list(collector.failure_data), ["test_a"])
+        self.assertTrue(self.logged[-1].startswith("CANCELLED: "))
+        self.assertEqual(sorted(self.readData()["Mod"]["tests"]), ["test_a", "test_b"])
+
+    def testErrors(self):
+        collector = DtestCommon.ResultCollector(self.args, datetime.datetime(2020, 1, 1), "Mod", report_failures=True)
+        collector.add((1, 0, {"test_a": {"run": [1, 1]}}))
+        collector.addError(ValueError("RUN_AFTER cycle"))
+
+        # The error counts as a failed test, so the summary agrees with the exit code.
+        self.assertEqual((collector.success, collector.failed), (1, 1))
+        self.assertTrue(self.logged[-1].startswith("FAILED: "))
+        self.assertTrue(self.logged[-1].endswith("error-1: ValueError: RUN_AFTER cycle"))
+        self.assertIn("error-1: ValueError: RUN_AFTER cycle", DtestCommon.failureMessage(collector.failure_data, "/"))
+        self.assertEqual(self.readData()["Mod"]["tests"]["error-1"]["error"], "ValueError: RUN_AFTER cycle")
+
+    def testTimingReport(self):
+        self.args.timing_report = True
+        self.args.timing_report_count = 2
+        collector = DtestCommon.ResultCollector(self.args, datetime.datetime(2020, 1, 1), "Mod")
+        collector.add((1, 0, {"test_a": {"run": [1, 1], "phases": {"config": 0.5, "run": {"a": 4.0, "b": 1.0}}}}))
+        collector.add((1, 0, {"test_b": {"run": [1, 1], "phases": {"queue": 2.0, "compare": {"out": 0.25}}}}))
+        self.assertEqual(collector.timing.totals, {"config": 0.5, "run": 5.0, "queue": 2.0, "compare": 0.25})
+        self.assertEqual(
+            collector.timing.lines()[-3:],
+            ["Slowest 2 phases:", "          4.00 s  test_a: run a", "          2.00 s  test_b: queue"],
+        )
+
+    def testModulesShareTheDataFile(self):
+        start_time = datetime.datetime(2020, 1, 1)
+        DtestCommon.ResultCollector(self.args, start_time, "Mod1").add((1, 0, {"test_a": {"run": [1, 1]}}))
+        DtestCommon.ResultCollector(self.args, start_time, "Mod2").add((1, 0, {"test_b": {"run": [1, 1]}}))
+
+        regdata = self.readData()
+        self.assertEqual(sorted(regdata), ["Mod1", "Mod2"])
+        self.assertEqual(list(regdata["Mod2"]["tests"]), ["test_b"])
+
+        # A module that is run again replaces its previous records.
+        DtestCommon.ResultCollector(self.args, start_time, "Mod1").add((1, 0, {"test_c": {"run": [1, 1]}}))
+        self.assertEqual(list(self.readData()["Mod1"]["tests"]), ["test_c"])
+
+
+class TestResourcesTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        from Dtest import TestAdmission
+
+        self.__controller = DtestCommon.admission_controller
+        DtestCommon.admission_controller = TestAdmission.AdmissionController()
+        self.__red = Test.red
+        self.reported = []
+        Test.red = self.reported.append
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        Test.red = self.__red
+        DtestCommon.admission_controller = self.__controller
+
+    def testInvalidDeclarationsGetTheDefaultResources(self):
+        config = {"RESOURCES": {"CPUS": "2"}, "LOCKS": ["display"]}
+        self.assertEqual(DtestCommon.testResources(config, "test_a"), {"CPUS": 2.0, "display": 1.0})
+        self.assertEqual(self.reported, [])
+
+        config = {"RESOURCES": {"CPUS": "lots"}, "LOCKS": ["display"]}
+        self.assertEqual(DtestCommon.testResources(config, "test_b"), {"CPUS": 1.0, "display": 1.0})
+        config = {"RESOURCES": {"CPUS": "2"}, "LOCKS": ["display", "MEM"]}
+        self.assertEqual(DtestCommon.testResources(config, "test_c"), {"CPUS": 1.0})
+        config = {"LOCKS": ["x" * 64]}
+        self.assertEqual(DtestCommon.testResources(config, "test_d"), {"CPUS": 1.0})
+        self.assertEqual([message.split()[-5] for message in self.reported], ["test_b;", "test_c;", "test_d;"])
+
+    def testFullResourceTable(self):
+        from Dtest import TestAdmission
+
+        for i in range(TestAdmission.MAX_RESOURCES - 2):
+            DtestCommon.testResources({"LOCKS": ["lock{}".format(i)]}, "test_{}".format(i))
+        self.assertEqual(self.reported, [])
+
+        # The table holds CPUS, MEM and 62 locks, so there is no room for another one.
+        self.assertEqual(DtestCommon.testResources({"LOCKS": ["late"]}, "test_late"), {"CPUS": 1.0})
+        self.assertEqual(len(self.reported), 1)
+        self.assertEqual(DtestCommon.testResources({"LOCKS": ["lock0"]}, "test_0"), {"CPUS": 1.0, "lock0": 1.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
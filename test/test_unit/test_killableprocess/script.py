@@ -0,0 +1,127 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import threading
+import time
+import unittest
+from Dtest import killableprocess
+
+
+class PidfdTests(unittest.TestCase):
+    """Tests of killableprocess.Popen, waiting on pidfds where supported."""
+
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.__temporary_file_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        shutil.rmtree(path=self.__temporary_file_path, ignore_errors=True)
+
+    def popen(self, cmdstr):
+        return killableprocess.Popen(["/bin/bash", "-c", cmdstr], cwd=self.__temporary_file_path)
+
+    def testExitEndsTheWait(self):
+        process = self.popen("sleep 0.2; exit 4")
+        start = time.time()
+        self.assertEqual(process.wait(timeout=10), 4)
+        self.assertLess(time.time() - start, 0.45)
+
+    def testTimeout(self):
+        process = self.popen("sleep 10 & sleep 10")
+        start = time.time()
+        with self.assertRaises(killableprocess.TimeoutExpired):
+            process.wait(timeout=0.3)
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(process.returncode, -9)
+
+    def testResourceUsage(self):
+        process = self.popen("head -c 20000000 /dev/zero | sort > /dev/null")
+        self.assertIsNone(process.rusage)
+        self.assertEqual(process.wait(timeout=10), 0)
+
+        # The usage includes the processes that bash waited for.
+        self.assertGreater(process.rusage.ru_utime + process.rusage.ru_stime, 0)
+        self.assertGreater(process.rusage.ru_maxrss, 10000)
+
+        # A process that is killed on timeout has been waited for too.
+        process = self.popen("sleep 10")
+        with self.assertRaises(killableprocess.TimeoutExpired):
+            process.wait(timeout=0.1)
+        self.assertIsNotNone(process.rusage)
+
+    def testManyThreads(self):
+        return_codes = {}
+
+        def waitForOne(i):
+            return_codes[i] = self.popen("sleep 0.%d; exit %d" % (i % 5, i % 3)).wait(timeout=10)
+
+        threads = [threading.Thread(target=waitForOne, args=(i,)) for i in range(20)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(return_codes, {i: i % 3 for i in range(20)})
+        self.assertLess(time.time() - start, 2)
+
+    def testManyThreadsWaitForOneProcess(self):
+        fds = len(os.listdir("/proc/self/fd"))
+        process = self.popen("sleep 0.3; exit 5")
+        return_codes = []
+
+        # Whichever thread reaps the process closes its pidfd while the others still wait on it.
+        threads = [threading.Thread(target=lambda: return_codes.append(process.wait(timeout=10))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(return_codes, [5] * 10)
+        self.assertEqual(len(os.listdir("/proc/self/fd")), fds)
+
+    def testCancel(self):
+        cancel = threading.Event()
+        threading.Timer(0.3, cancel.set).start()
+
+        process = self.popen("trap 'echo stopped > stopped; exit 3' TERM; sleep 10 & wait")
+        start = time.time()
+        with self.assertRaises(killableprocess.Cancelled):
+            process.wait(cancel=cancel)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(process.returncode, 3)
+        self.assertTrue(os.path.exists(os.path.join(self.__temporary_file_path, "stopped")))
+
+        # A process that ignores SIGTERM is killed after the grace period.
+        process = self.popen("trap '' TERM; sleep 10")
+        time.sleep(0.2)
+        self.assertEqual(process.stop(grace=0.2), -9)
+
+
+class ChildWatcherTests(PidfdTests):
+    """The same tests, waiting for SIGCHLD instead, as without pidfds."""
+
+    def setUp(self):
+        """Automatically called before each test* method."""
+        super(ChildWatcherTests, self).setUp()
+        self.__pidfd_open = killableprocess.pidfd_open
+        killableprocess.pidfd_open = lambda pid: None
+
+        # The handler can only be installed from the main thread.
+        self.assertTrue(killableprocess.child_watcher.install())
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        killableprocess.pidfd_open = self.__pidfd_open
+        super(ChildWatcherTests, self).tearDown()
+
+
+if __name__ == "__main__":
+    unittest.main()
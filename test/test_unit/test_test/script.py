@@ -4,6 +4,7 @@ from __future__ import absolute_import
 import os
 import unittest
 from Dtest import Test
+from Dtest import TestUsage
 from Dtest import configobj
 
 
@@ -153,6 +154,69 @@ class MainTests(unittest.TestCase):
             ),
         )
 
+    def testRunUnitTestCancelled(self):
+        import threading
+
+        config = configobj.ConfigObj()
+        config["RUN"] = {"test1": "ls", "test2": "ls -a"}
+        config["TIMEOUT"] = -1
+        with open(os.path.join(self.__temporary_file_path, "output.orig"), "w"):
+            pass
+
+        # Once the tests are cancelled, no more commands are run, and the outputs are not compared.
+        Test.cancel_event = threading.Event()
+        Test.cancel_event.set()
+        try:
+            self.assertEqual(
+                (
+                    0,
+                    0,
+                    {
+                        "run": (0, 2),
+                        "timed_out": 0,
+                        "cmp": (0, 0),
+                        "sub_tests": {"ls": {"completion_status": False, "return_code": "Cancelled"}},
+                        "sub_cmps": {},
+                        "cancelled": True,
+                    },
+                ),
+                filter_results(
+                    Test.runUnitTest(
+                        new_config=config,
+                        full_dir=self.__temporary_file_path,
+                        root_dir=self.__temporary_file_path,
+                        truth_suffix="",
+                        test_command_modifier=lambda cmd, _, __: cmd,
+                        log_num=0,
+                    )
+                ),
+            )
+        finally:
+            Test.cancel_event = None
+
+    def testRunUnitTestBadRunAfter(self):
+        config = configobj.ConfigObj()
+        config["RUN"] = {"test1": "touch first", "test2": "touch second"}
+        config["RUN_AFTER"] = {"test1": "test2", "test2": "test1"}
+        config["PARALLEL_RUN"] = "True"
+        config["TIMEOUT"] = -1
+
+        # A cycle in RUN_AFTER fails the test, and none of its commands are run.
+        success, failed, stats = filter_results(
+            Test.runUnitTest(
+                new_config=config,
+                full_dir=self.__temporary_file_path,
+                root_dir=self.__temporary_file_path,
+                truth_suffix="",
+                test_command_modifier=lambda cmd, _, __: cmd,
+                log_num=0,
+            )
+        )
+        self.assertEqual((success, failed), (0, 1))
+        self.assertEqual((stats["run"], stats["cmp"], stats["sub_tests"]), ((0, 2), (0, 0), {}))
+        self.assertIn("cycle", stats["error"])
+        self.assertEqual(os.listdir(self.__temporary_file_path), [])
+
     def testRunUnitTestWithDeletion(self):
         config = configobj.ConfigObj()
         config["RUN"] = {"test1": "ls"}
@@ -307,6 +371,69 @@ class MainTests(unittest.TestCase):
             ),
         )
 
+    def testRunUnitTestResourceUsage(self):
+        config = configobj.ConfigObj()
+        config["RUN"] = {"test1": "head -c 20000000 /dev/zero | sort > /dev/null", "test2": "true"}
+        config["TIMEOUT"] = -1
+        config["CMP"] = ("dtest-numerical-diff",)
+        with open(os.path.join(self.__temporary_file_path, "me.orig"), "w") as f:
+            f.write("1.0\n" * 1000)
+        with open(os.path.join(self.__temporary_file_path, "me"), "w") as f:
+            f.write("1.0\n" * 1000)
+
+        _, _, stats = Test.runUnitTest(
+            new_config=config,
+            full_dir=self.__temporary_file_path,
+            root_dir=self.__temporary_file_path,
+            truth_suffix="",
+            test_command_modifier=lambda cmd, _, __: cmd,
+            log_num=0,
+        )
+
+        # The usage of a command includes the processes it waited for, here sort.
+        sort_usage = stats["sub_tests"][config["RUN"]["test1"]]["rusage"]
+        self.assertGreater(sort_usage["user_time"] + sort_usage["system_time"], 0)
+        self.assertGreater(sort_usage["max_rss_kb"], 10000)
+        self.assertEqual(set(sort_usage), set(TestUsage.FIELDS))
+
+        # The comparison is done in process, so its usage is that of its thread, without the peak RSS.
+        compare_usage = stats["sub_cmps"]["dtest-numerical-diff me.orig me"]["rusage"]
+        self.assertEqual(set(compare_usage), set(TestUsage.FIELDS) - TestUsage.PEAKS)
+
+        # The test records the total usage of its commands.
+        true_usage = stats["sub_tests"]["true"]["rusage"]
+        self.assertEqual(stats["rusage"]["max_rss_kb"], max(sort_usage["max_rss_kb"], true_usage["max_rss_kb"]))
+        self.assertEqual(
+            stats["rusage"]["voluntary_context_switches"],
+            sum(u["voluntary_context_switches"] for u in (sort_usage, true_usage, compare_usage)),
+        )
+
+    def testRunUnitTestPhases(self):
+        config = configobj.ConfigObj()
+        config["RUN"] = {"test1": "sleep 0.2", "test2": "true"}
+        config["TIMEOUT"] = -1
+        config["CMP"] = ("cmp",)
+        config["DELETE"] = ["junk.*"]
+        for name in ("me.orig", "me", "junk.txt"):
+            with open(os.path.join(self.__temporary_file_path, name), "w"):
+                pass
+
+        _, _, stats = Test.runUnitTest(
+            new_config=config,
+            full_dir=self.__temporary_file_path,
+            root_dir=self.__temporary_file_path,
+            truth_suffix="",
+            test_command_modifier=lambda cmd, _, __: cmd,
+            log_num=0,
+        )
+
+        phases = stats["phases"]
+        self.assertEqual(sorted(phases), ["cleanup", "compare", "run"])
+        self.assertEqual(sorted(phases["run"]), ["test1", "test2"])
+        self.assertGreaterEqual(phases["run"]["test1"], 0.2)
+        self.assertEqual(list(phases["compare"]), ["me"])
+        self.assertLess(sum(phases["run"].values()) + phases["compare"]["me"], stats["elapsed_time"])
+
     def testRunUnitTestWithComparisonForSpecificSuffix(self):
         config = configobj.ConfigObj()
         config["RUN"] = {"test1": "ls"}
@@ -543,12 +670,246 @@ class UtilityTests(unittest.TestCase):
 
         os.rmdir(temporary_directory)
 
+    def testGetLocalConfigIsCached(self):
+        import shutil
+        import tempfile
+
+        temporary_directory = tempfile.mkdtemp()
+        config_path = os.path.join(temporary_directory, "DTESTDEFS.cfg")
+        with open(config_path, "w") as f:
+            f.write("TIMEOUT = 10\n")
+
+        first = Test.getLocalConfig(None, temporary_directory, [])
+        self.assertIs(first, Test.getLocalConfig(None, temporary_directory, []))
+        self.assertIsNot(first, Test.getLocalConfig(first, temporary_directory, []))
+
+        with open(config_path, "w") as f:
+            f.write("TIMEOUT = 20\n")
+        stat_result = os.stat(config_path)
+        os.utime(config_path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10**9))
+
+        self.assertEqual("20", Test.getLocalConfig(None, temporary_directory, [])["TIMEOUT"])
+
+        shutil.rmtree(temporary_directory)
+
+    def testCompiledConfigCacheChecksLocalComparePrograms(self):
+        import shutil
+        import tempfile
+        from Dtest import TestConfigCache
+
+        temporary_directory = tempfile.mkdtemp()
+        config_path = os.path.join(temporary_directory, "DTESTDEFS.cfg")
+        with open(config_path, "w") as f:
+            f.write("CMP = my-diff -q\n")
+        local_program = os.path.join(temporary_directory, "my-diff")
+
+        Test.compiled_config_cache = TestConfigCache.ConfigCache()
+        try:
+            self.assertEqual(["my-diff -q"] * 2, Test.loadCompiledConfig(config_path, temporary_directory)["CMP"])
+
+            # A compare program added to the test directory is used instead of the one on the PATH.
+            with open(local_program, "w") as f:
+                f.write("#!/bin/sh\n")
+            os.chmod(local_program, 0o755)
+            self.assertEqual(
+                [local_program + " -q"] * 2, Test.loadCompiledConfig(config_path, temporary_directory)["CMP"]
+            )
+
+            os.remove(local_program)
+            self.assertEqual(["my-diff -q"] * 2, Test.loadCompiledConfig(config_path, temporary_directory)["CMP"])
+        finally:
+            Test.compiled_config_cache = None
+            shutil.rmtree(temporary_directory)
+
+    def testCompiledConfigCacheIsReadableByOthers(self):
+        import shutil
+        import tempfile
+        from Dtest import TestConfigCache
+
+        temporary_directory = tempfile.mkdtemp()
+        cache = TestConfigCache.ConfigCache()
+        cache.load(temporary_directory)
+        cache.put(temporary_directory, "key", {})
+        old_umask = os.umask(0o022)
+        try:
+            cache.save()
+        finally:
+            os.umask(old_umask)
+
+        mode = os.stat(os.path.join(temporary_directory, TestConfigCache.CACHE_FILENAME)).st_mode & 0o777
+        self.assertEqual(mode, 0o644)
+        shutil.rmtree(temporary_directory)
+
+    def testCompiledConfigCacheIsJson(self):
+        import json
+        import shutil
+        import tempfile
+        from unittest import mock
+        from Dtest import TestConfigCache
+
+        temporary_directory = tempfile.mkdtemp()
+        config_path = os.path.join(temporary_directory, "DTESTDEFS.cfg")
+        with open(config_path, "w") as f:
+            f.write("TIMEOUT = 20\nDELETE = a, b\n[RUN]\nrun = echo hello\n")
+
+        try:
+            Test.compiled_config_cache = TestConfigCache.ConfigCache()
+            Test.compiled_config_cache.load(temporary_directory)
+            config = Test.loadCompiledConfig(config_path, temporary_directory)
+            Test.compiled_config_cache.save()
+            with open(os.path.join(temporary_directory, TestConfigCache.CACHE_FILENAME), "r") as f:
+                self.assertEqual(list(json.load(f)["entries"]), [temporary_directory])
+
+            # A new cache loads the compiled config from the file instead of compiling it again.
+            Test.compiled_config_cache = TestConfigCache.ConfigCache()
+            Test.compiled_config_cache.load(temporary_directory)
+            with mock.patch.object(Test, "compileConfig", side_effect=AssertionError("compiled again")):
+                self.assertEqual(Test.loadCompiledConfig(config_path, temporary_directory), config)
+            self.assertEqual(
+                (config["TIMEOUT"], config["DELETE"], config["RUN"]), ("20", ["a", "b"], {"run": "echo hello"})
+            )
+        finally:
+            Test.compiled_config_cache = None
+            shutil.rmtree(temporary_directory)
+
+    def testResolvedTestConfig(self):
+        import pickle
+        import shutil
+        import tempfile
+
+        temporary_directory = tempfile.mkdtemp()
+        with open(os.path.join(temporary_directory, "DTESTDEFS.cfg"), "w") as f:
+            f.write("TIMEOUT = 10\nCHILD_TAGS = red\nEMAIL = me\n[RUN]\ntest = ls\n")
+
+        config = Test.getLocalConfig(None, temporary_directory, [])
+        self.assertIsInstance(config, Test.ResolvedTestConfig)
+        self.assertEqual(config["RUN"], {"test": "ls"})
+        self.assertEqual(config["CHILD_TAGS"], ["red"])
+        self.assertEqual(Test.getListFromConfig(config, "EMAIL"), ["me"])
+        self.assertNotIn("ENV", config)
+        self.assertEqual(config.get("ENV", {}), {})
+        self.assertEqual(pickle.loads(pickle.dumps(config)), config)
+
+        with self.assertRaises(AttributeError):
+            config.TIMEOUT = "20"
+        with self.assertRaises(TypeError):
+            config["TIMEOUT"] = "20"
+
+        scaled = config.replace(TIMEOUT="20")
+        self.assertEqual((config["TIMEOUT"], scaled["TIMEOUT"]), ("10", "20"))
+
+        shutil.rmtree(temporary_directory)
+
+    def testLocksAreInherited(self):
+        import shutil
+        import tempfile
+
+        temporary_directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temporary_directory, "test_a"))
+        with open(os.path.join(temporary_directory, "DTESTDEFS.cfg"), "w") as f:
+            f.write("LOCKS = display, shared-db\n[RUN]\ntest = ls\n")
+        with open(os.path.join(temporary_directory, "test_a", "DTESTDEFS.cfg"), "w") as f:
+            f.write("LOCKS = port-range-A, display\n")
+
+        config = Test.getLocalConfig(None, temporary_directory, [])
+        self.assertEqual(config["LOCKS"], ["display", "shared-db"])
+
+        full_dir = os.path.join(temporary_directory, "test_a")
+        config = Test.getLocalConfig(Test.getDefaultConfig(full_dir, []), full_dir, [])
+        self.assertEqual(config["LOCKS"], ["display", "shared-db", "port-range-A"])
+
+        shutil.rmtree(temporary_directory)
+
+    def testRunAfterIsInheritedWithRun(self):
+        import shutil
+        import tempfile
+
+        temporary_directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temporary_directory, "test_a"))
+        os.makedirs(os.path.join(temporary_directory, "test_b"))
+        with open(os.path.join(temporary_directory, "DTESTDEFS.cfg"), "w") as f:
+            f.write("PARALLEL_RUN = True\n[RUN]\nprep = ls\nsim = ls\n[RUN_AFTER]\nsim = prep\n")
+        with open(os.path.join(temporary_directory, "test_a", "DTESTDEFS.cfg"), "w") as f:
+            f.write("TAGS = a\n")
+        with open(os.path.join(temporary_directory, "test_b", "DTESTDEFS.cfg"), "w") as f:
+            f.write("[RUN]\ntest = ls\n")
+
+        # The RUN_AFTER dependencies come with the inherited RUN commands, but not with new ones.
+        full_dir = os.path.join(temporary_directory, "test_a")
+        config = Test.getLocalConfig(Test.getDefaultConfig(full_dir, []), full_dir, [])
+        self.assertEqual((config["PARALLEL_RUN"], dict(config["RUN_AFTER"])), ("True", {"sim": "prep"}))
+
+        full_dir = os.path.join(temporary_directory, "test_b")
+        config = Test.getLocalConfig(Test.getDefaultConfig(full_dir, []), full_dir, [])
+        self.assertEqual(config["PARALLEL_RUN"], "True")
+        self.assertNotIn("RUN_AFTER", config)
+
+        shutil.rmtree(temporary_directory)
+
+    def testCompareTruthFilesLogsInOrder(self):
+        import shutil
+        import tempfile
+
+        temporary_directory = tempfile.mkdtemp()
+        for name in ["out3.orig", "out1.orig", "out2.orig", "log.orig"]:
+            with open(os.path.join(temporary_directory, name), "w"):
+                pass
+
+        logged = []
+        log, log_tee = Test.log, Test.logTee
+        Test.log = lambda log_num, value: logged.append(value)
+        Test.logTee = lambda log_num, value: logged.append(value)
+        try:
+            snapshot = Test.DirectorySnapshot(temporary_directory)
+            config = {"CMP": ["diff"], "COMPARE": {"log": ["diff"]}}
+            results = Test.compareTruthFiles(
+                config, snapshot, snapshot.truthFiles(["orig"]), temporary_directory, "test", 0
+            )
+        finally:
+            Test.log, Test.logTee = log, log_tee
+
+        # None of the output files exist, so they are all missing, in order.
+        missing = [line.split()[0] for line in logged if "missing. comparison" in line]
+        self.assertEqual(missing, ["log", "out1", "out2", "out3"])
+        self.assertEqual(len(results["sub_cmps"]), 4)
+        self.assertEqual((results["cmp_success"], results["status"]), (0, False))
+
+        shutil.rmtree(temporary_directory)
+
+    def testDirectorySnapshot(self):
+        import shutil
+        import tempfile
+
+        temporary_directory = tempfile.mkdtemp()
+        for name in ["output", "output.orig", "output.truth", "output2", "output2.orig", "plot.orig", "readme"]:
+            with open(os.path.join(temporary_directory, name), "w"):
+                pass
+
+        snapshot = Test.DirectorySnapshot(temporary_directory)
+        self.assertEqual(
+            {"output": ["orig", "truth"], "output2": ["orig"], "plot": ["orig"]},
+            snapshot.truthFiles(("orig", "truth")),
+        )
+        self.assertEqual({"output", "output2"}, snapshot.testableFiles("output", ["orig"]))
+        self.assertEqual({"output2"}, snapshot.testableFiles("output", ["orig"], pattern=".*2"))
+        self.assertEqual(set(), snapshot.testableFiles("plot", ["orig"]))
+
+        snapshot.remove("output2")
+        self.assertFalse(snapshot.isfile("output2"))
+        self.assertEqual({"output"}, snapshot.testableFiles("output", ["orig"]))
+
+        shutil.rmtree(temporary_directory)
+
 
 def filter_results(result):
     """Remove non-deterministic keys."""
     a = result[0]
     b = result[1]
-    dictionary = {k: result[2][k] for k in result[2] if k != "elapsed_time"}
+    dictionary = {k: result[2][k] for k in result[2] if k not in ("elapsed_time", "rusage", "phases")}
+    for key in ("sub_tests", "sub_cmps"):
+        dictionary[key] = {
+            cmd: {k: v for k, v in record.items() if k != "rusage"} for cmd, record in dictionary[key].items()
+        }
     return (a, b, dictionary)
 
 
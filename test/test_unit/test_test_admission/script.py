@@ -0,0 +1,206 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+from Dtest import TestAdmission
+
+
+def holdSlot(controller, events):
+    """Hold a slot of controller for a moment, and record when it was held."""
+    with controller.slot():
+        events.put(("start", time.time(), controller.active))
+        time.sleep(0.2)
+        events.put(("end", time.time(), controller.active))
+
+
+def dieWithSlot(controller):
+    """Take a slot of controller, and exit without giving it back, as a worker that crashes."""
+    controller.acquire({"CPUS": 1, "LICENSES": 1})
+    os._exit(1)
+
+
+class AdmissionTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.__temporary_file_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        shutil.rmtree(path=self.__temporary_file_path, ignore_errors=True)
+
+    def writeFile(self, name, text):
+        path = os.path.join(self.__temporary_file_path, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def testCgroupQuota(self):
+        self.assertEqual(TestAdmission._readCpuMax(self.writeFile("cpu.max", "250000 100000\n")), 2.5)
+        self.assertIsNone(TestAdmission._readCpuMax(self.writeFile("cpu.max", "max 100000\n")))
+        self.assertIsNone(TestAdmission._readCpuMax(os.path.join(self.__temporary_file_path, "missing")))
+
+        period = self.writeFile("cpu.cfs_period_us", "100000\n")
+        self.assertEqual(TestAdmission._readCfsQuota(self.writeFile("cpu.cfs_quota_us", "50000\n"), period), 0.5)
+        self.assertIsNone(TestAdmission._readCfsQuota(self.writeFile("cpu.cfs_quota_us", "-1\n"), period))
+
+        self.assertEqual(list(TestAdmission._parentDirs("/cg", "/a/b")), ["/cg/a/b", "/cg/a", "/cg"])
+        self.assertGreaterEqual(TestAdmission.cpuCapacity(), 1.0)
+
+    def testCpuPressure(self):
+        pressure_file = TestAdmission.PRESSURE_FILE
+        try:
+            TestAdmission.PRESSURE_FILE = self.writeFile(
+                "cpu", "some avg10=12.50 avg60=3.00 avg300=1.00 total=100\nfull avg10=0.00 avg60=0.00 avg300=0.00 total=0\n"
+            )
+            self.assertEqual(TestAdmission.cpuPressure(), 12.5)
+
+            TestAdmission.PRESSURE_FILE = os.path.join(self.__temporary_file_path, "missing")
+            self.assertIsNone(TestAdmission.cpuPressure())
+        finally:
+            TestAdmission.PRESSURE_FILE = pressure_file
+
+    def testResourceDemand(self):
+        self.assertEqual(TestAdmission.parseAmount("0.5"), 0.5)
+        self.assertEqual(TestAdmission.parseAmount("20GB"), 20 * 1024**3)
+        self.assertEqual(TestAdmission.parseAmount("512m"), 512 * 1024**2)
+        with self.assertRaises(ValueError):
+            TestAdmission.parseAmount("lots")
+
+        self.assertEqual(TestAdmission.resourceDemand(None), {"CPUS": 1.0})
+        self.assertEqual(
+            TestAdmission.resourceDemand({"CPUS": "8", "MEM": "1kb", "GPU_MEM": "1gb", "LICENSES": "2"}),
+            {"CPUS": 8.0, "MEM": 1024.0, "LICENSES": 2.0},
+        )
+        self.assertEqual(
+            TestAdmission.resourceDemand({"LICENSES": "2"}, ["display", "shared-db"]),
+            {"CPUS": 1.0, "LICENSES": 2.0, "display": 1.0, "shared-db": 1.0},
+        )
+        for resources, locks in [
+            (None, ["CPUS"]),
+            (None, ["MEM"]),
+            ({"LICENSES": "2"}, ["LICENSES"]),
+            (None, ["x" * (TestAdmission.MAX_NAME_LENGTH + 1)]),
+            (None, [""]),
+            ({"y" * (TestAdmission.MAX_NAME_LENGTH + 1): "1"}, None),
+            (None, ["lock{}".format(i) for i in range(TestAdmission.MAX_RESOURCES)]),
+        ]:
+            with self.assertRaises(ValueError):
+                TestAdmission.resourceDemand(resources, locks)
+        self.assertEqual(TestAdmission.parseCapacities(["MEM=2k,LICENSES=4", "CPUS=64"]), {"MEM": 2048.0, "LICENSES": 4.0, "CPUS": 64.0})
+        with self.assertRaises(ValueError):
+            TestAdmission.parseCapacities(["MEM"])
+
+    def testBinPacking(self):
+        controller = TestAdmission.AdmissionController()
+        controller.configure(max_load_saturation=1.0, capacities={"CPUS": 4, "MEM": 10, "LICENSES": 2})
+        self.assertEqual(controller.capacity("OTHER"), TestAdmission.DEFAULT_CAPACITY)
+
+        big = controller.acquire({"CPUS": 3, "MEM": 4})
+        with controller._condition:
+            self.assertFalse(controller._fits({"CPUS": 2}))
+            self.assertFalse(controller._fits({"CPUS": 1, "MEM": 7}))
+            self.assertTrue(controller._fits({"CPUS": 1, "MEM": 6, "LICENSES": 2}))
+        small = controller.acquire({"CPUS": 1, "LICENSES": 1})
+        self.assertEqual((controller.used("CPUS"), controller.used("MEM"), controller.used("LICENSES")), (4, 4, 1))
+
+        controller.release(big)
+        controller.release(small)
+        self.assertEqual((controller.active, controller.used("CPUS"), controller.used("LICENSES")), (0, 0, 0))
+
+        # A test that needs more than there is runs alone.
+        huge = controller.acquire({"CPUS": 100})
+        self.assertEqual(huge, {"CPUS": 4})
+        with controller._condition:
+            self.assertFalse(controller._fits({"CPUS": 1}))
+        controller.release(huge)
+
+    def testSlots(self):
+        controller = TestAdmission.AdmissionController()
+        controller.configure(max_load_saturation=1.0 / TestAdmission.cpuCapacity())
+        self.assertEqual(controller.slots, 1)
+
+        events = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=holdSlot, args=(controller, events)) for _ in range(3)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+
+        results = sorted(events.get() for _ in range(6))
+        self.assertEqual(controller.active, 0)
+
+        # Only one test ran at a time, and the next one started right after the previous one ended.
+        self.assertTrue(all(active == 1 for _, _, active in results))
+        times = sorted((t, kind) for kind, t, _ in results)
+        self.assertEqual([kind for _, kind in times], ["start", "end"] * 3)
+        for (end, _), (start, _) in zip(times[1::2], times[2::2]):
+            self.assertLess(start - end, 0.1)
+
+    def testArrivalOrder(self):
+        controller = TestAdmission.AdmissionController()
+        controller.configure(max_load_saturation=1.0, capacities={"CPUS": 2})
+        first = controller.acquire()
+        order = []
+
+        def acquire(name, demand):
+            taken = controller.acquire(demand)
+            order.append(name)
+            time.sleep(0.1)
+            controller.release(taken)
+
+        big = threading.Thread(target=acquire, args=("big", {"CPUS": 2}))
+        big.start()
+        time.sleep(0.1)
+        small = threading.Thread(target=acquire, args=("small", {"CPUS": 1}))
+        small.start()
+
+        # The free CPU is set aside for the test that has waited longer, so the small test waits too.
+        time.sleep(0.3)
+        self.assertEqual(order, [])
+        controller.release(first)
+        big.join(5)
+        small.join(5)
+        self.assertEqual(order, ["big", "small"])
+        self.assertEqual((controller.active, controller.used("CPUS")), (0, 0))
+
+    def testDeadWorker(self):
+        reclaim_interval = TestAdmission.RECLAIM_INTERVAL
+        TestAdmission.RECLAIM_INTERVAL = 0.1
+        try:
+            controller = TestAdmission.AdmissionController()
+            controller.configure(max_load_saturation=1.0, capacities={"CPUS": 1})
+            process = multiprocessing.Process(target=dieWithSlot, args=(controller,))
+            process.start()
+            process.join()
+            self.assertEqual((controller.active, controller.used("LICENSES")), (1, 1))
+
+            # The resources of the worker are given back by the next test that waits for them.
+            waiter = threading.Thread(target=lambda: controller.release(controller.acquire({"CPUS": 1, "LICENSES": 1})))
+            waiter.daemon = True
+            waiter.start()
+            waiter.join(5)
+            self.assertFalse(waiter.is_alive())
+            self.assertEqual((controller.active, controller.used("CPUS"), controller.used("LICENSES")), (0, 0, 0))
+        finally:
+            TestAdmission.RECLAIM_INTERVAL = reclaim_interval
+
+    def testProcessAlive(self):
+        self.assertTrue(TestAdmission.processAlive(os.getpid(), TestAdmission.processStartTime(os.getpid())))
+        self.assertFalse(TestAdmission.processAlive(os.getpid(), TestAdmission.processStartTime(os.getpid()) + 1))
+
+        process = multiprocessing.Process(target=time.sleep, args=(0,))
+        process.start()
+        process.join()
+        self.assertFalse(TestAdmission.processAlive(process.pid, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import unittest
+from Dtest import TestComparators
+
+
+class ComparatorTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+        self.env = {"PATH": TestComparators.SCRIPTS_DIR + os.pathsep + "/usr/bin:/bin"}
+        self.write("regexp.lst", "^[0-9]+c[0-9]+$\n")
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        shutil.rmtree(path=self.directory, ignore_errors=True)
+
+    def write(self, name, content):
+        with open(os.path.join(self.directory, name), "w") as f:
+            f.write(content)
+
+    def compare(self, cmd, *args):
+        return TestComparators.compareInProcess(cmd, list(args), self.directory, self.env)
+
+    def testDtestDiff(self):
+        self.write("out.orig", "a  b\nc\n")
+        self.write("out", "a b \nc\n")
+        self.write("other", "a c\nc\n")
+        self.assertEqual(self.compare("dtest-diff 0 regexp.lst", "out.orig", "out"), 0)
+        self.assertEqual(self.compare("dtest-diff 1 regexp.lst", "out.orig", "out"), 1)
+        self.assertEqual(self.compare("dtest-diff 0 regexp.lst", "out.orig", "missing"), 1)
+
+        # Only dtest-diff can tell if the filter file covers the differences.
+        self.assertIsNone(self.compare("dtest-diff 0 regexp.lst", "out.orig", "other"))
+
+        self.write("blank.lst", "abc\n\n")
+        self.assertEqual(self.compare("dtest-diff 0 blank.lst", "out.orig", "out"), 1)
+
+    def testNumericalDiff(self):
+        self.write("out.orig", "x = 1.0, 2.0\n\nskip 1\n")
+        self.write("out", "x = 1.001, 2.0\nskip 2\n")
+        self.write("filter", "skip.*\n")
+        self.assertEqual(self.compare("dtest-numerical-diff -a 0.01 --filter-file filter", "out.orig", "out"), 0)
+        self.assertEqual(self.compare("dtest-numerical-diff -r 1e-6 --filter-file filter", "out.orig", "out"), 2)
+        self.assertEqual(self.compare("dtest-numerical-diff -a 0.01", "out.orig", "out"), 2)
+        self.assertEqual(self.compare("dtest-numerical-diff", "out.orig", "missing"), 1)
+
+        # Bad options are left to the program to report.
+        self.assertIsNone(self.compare("dtest-numerical-diff --bad", "out.orig", "out"))
+
+    def testCmp(self):
+        self.write("out.orig", "abc")
+        self.write("out", "abc")
+        self.write("other", "abd")
+        self.assertEqual(self.compare("cmp -s", "out.orig", "out"), 0)
+        self.assertEqual(self.compare("cmp", "out.orig", "other"), 1)
+        self.assertEqual(self.compare("cmp", "out.orig", "missing"), 2)
+        self.assertIsNone(self.compare("cmp -l", "out.orig", "out"))
+
+    def testCommandsThatAreRun(self):
+        self.write("out.orig", "abc\n")
+        self.write("out", "abc\n")
+
+        # Unknown programs, shell syntax, and other programs of the same name are left to bash.
+        self.assertIsNone(self.compare("diff", "out.orig", "out"))
+        self.assertIsNone(self.compare("cmp -s", "out.orig", "out", ">", "log"))
+        self.assertIsNone(self.compare("dtest-diff 0 regexp.lst 2>&1", "out.orig", "out"))
+        self.assertIsNone(self.compare("./dtest-diff 0 regexp.lst", "out.orig", "out"))
+
+        # Variables are expanded with the environment of the test.
+        self.env["FILTER"] = "regexp.lst"
+        self.assertEqual(self.compare("dtest-diff 0 ${FILTER}", "out.orig", "out"), 0)
+        self.assertEqual(self.compare("dtest-diff 0 $FILTER", "out.orig", "out"), 0)
+        self.env["FILTER"] = "*.lst"
+        self.assertIsNone(self.compare("dtest-diff 0 $FILTER", "out.orig", "out"))
+
+    def testRegisterComparator(self):
+        self.write("out.orig", "abc\n")
+        self.write("out", "abc\n")
+        self.write("mycompare", "#!/bin/sh\nexit 1\n")
+        os.chmod(os.path.join(self.directory, "mycompare"), 0o755)
+
+        calls = []
+        TestComparators.registerComparator(
+            "mycompare", lambda args, cwd: calls.append(args) or 0, [os.path.join(self.directory, "mycompare")]
+        )
+        try:
+            self.assertEqual(self.compare("./mycompare --fast", "out.orig", "out"), 0)
+            self.assertEqual(calls, [["--fast", "out.orig", "out"]])
+        finally:
+            del TestComparators.comparators["mycompare"]
+
+
+if __name__ == "__main__":
+    unittest.main()
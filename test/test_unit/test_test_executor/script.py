@@ -0,0 +1,91 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import threading
+import time
+import unittest
+from Dtest import TestExecutor
+from Dtest import killableprocess
+
+# The runner cannot run commands while its Popen call is commented out.
+RUNS_COMMANDS = TestExecutor.runsCommands()
+
+
+class ExecutorTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.__temporary_file_path = tempfile.mkdtemp()
+        self.runner = TestExecutor.AsyncCommandRunner()
+        self.runner.start()
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        self.runner.close()
+        shutil.rmtree(path=self.__temporary_file_path, ignore_errors=True)
+
+    def run_(self, cmdstr, **kwargs):
+        return self.runner.run(cmdstr, cwd=self.__temporary_file_path, env=dict(os.environ), **kwargs)
+
+    @unittest.skipUnless(RUNS_COMMANDS, "AsyncCommandRunner cannot run commands")
+    def testReturnCodeAndOutput(self):
+        self.assertEqual(self.run_("exit 3"), 3)
+
+        output_path = os.path.join(self.__temporary_file_path, "output")
+        with open(output_path, "w") as output_file:
+            self.assertEqual(self.run_("echo out; echo err >&2", output_file=output_file), 0)
+        with open(output_path, "r") as f:
+            self.assertEqual(f.read().split(), ["out", "err"])
+
+    @unittest.skipUnless(RUNS_COMMANDS, "AsyncCommandRunner cannot run commands")
+    def testTimeout(self):
+        start = time.time()
+        with self.assertRaises(killableprocess.TimeoutExpired):
+            self.run_("sleep 10 & sleep 10", timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+
+    @unittest.skipUnless(RUNS_COMMANDS, "AsyncCommandRunner cannot run commands")
+    def testCancel(self):
+        cancel = threading.Event()
+        threading.Timer(0.3, cancel.set).start()
+
+        # The command gets SIGTERM first, so it can clean up.
+        start = time.time()
+        with self.assertRaises(killableprocess.Cancelled):
+            self.run_("trap 'echo stopped > stopped; exit 3' TERM; sleep 10 & wait", cancel=cancel)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(os.path.exists(os.path.join(self.__temporary_file_path, "stopped")))
+
+        # A command that is not cancelled runs as usual.
+        self.assertEqual(self.run_("exit 2", cancel=threading.Event()), 2)
+
+    @unittest.skipUnless(RUNS_COMMANDS, "AsyncCommandRunner cannot run commands")
+    def testConcurrentCommands(self):
+        return_codes = []
+
+        def runOne(i):
+            return_codes.append(self.run_("sleep 0.5; exit %d" % (i % 2)))
+
+        threads = [threading.Thread(target=runOne, args=(i,)) for i in range(50)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(return_codes), [0] * 25 + [1] * 25)
+        self.assertLess(time.time() - start, 5)
+
+    def testNotStarted(self):
+        runner = TestExecutor.AsyncCommandRunner()
+        with self.assertRaises(RuntimeError):
+            runner.run("true", cwd=self.__temporary_file_path, env={})
+        runner.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
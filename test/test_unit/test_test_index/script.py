@@ -0,0 +1,126 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import unittest
+from Dtest import Test
+from Dtest import TestIndex
+
+
+def writeFile(path, text=""):
+    """Write text to path, creating the parent directories."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(text)
+
+
+class DiscoveryIndexTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.__temporary_file_path = tempfile.mkdtemp()
+        self.top = os.path.join(self.__temporary_file_path, "test")
+
+        Test.log = lambda *_: None
+        Test.logTee = lambda *_: None
+
+        writeFile(
+            os.path.join(self.top, "DTESTDEFS.cfg"),
+            "SKIPTESTS = test_skipped\nQUARANTINED = test_quarantined\nCHILD_TAGS = red\n[RUN]\ntest = ls\n",
+        )
+        writeFile(os.path.join(self.top, "test_a", "output.orig"))
+        writeFile(os.path.join(self.top, "test_skipped", "output.orig"))
+        writeFile(os.path.join(self.top, "test_quarantined", "output.orig"))
+        writeFile(os.path.join(self.top, "test_blue", "DTESTDEFS.cfg"), "TAGS = blue\n")
+        writeFile(os.path.join(self.top, "test_serial", "DTESTDEFS.cfg"), "TAGS = SERIAL\nCHILD_TAGS = green\n")
+        writeFile(os.path.join(self.top, "test_serial", "test_one", "output.orig"))
+        writeFile(os.path.join(self.top, "test_serial", "test_two", "DTESTDEFS.cfg"), "TAGS = skip\n")
+        writeFile(os.path.join(self.top, "test_serial", "test_three", "output.orig"))
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        shutil.rmtree(path=self.__temporary_file_path, ignore_errors=True)
+
+    def find(self, index, **kwargs):
+        options = dict(
+            full_dir=self.top,
+            test_mode="REGULAR",
+            log_num=0,
+            exclude_tags=set(),
+            run_only_tags=set(),
+            truth_suffix=[],
+            quiet_mode=True,
+        )
+        options.update(kwargs)
+        return list(Test.findTests(index=index, **options))
+
+    def testSameAsColdWalk(self):
+        for kwargs in [
+            {},
+            {"parallel_mode": True},
+            {"test_mode": "QUARANTINE"},
+            {"test_mode": "ALL"},
+            {"exclude_tags": {"blue"}},
+            {"run_only_tags": {"green"}},
+            {"full_dir": os.path.join(self.top, "test_serial")},
+        ]:
+            expected = self.find(None, **kwargs)
+            # Cold index and warm index.
+            self.assertEqual(expected, self.find(TestIndex.DiscoveryIndex(self.top, []), **kwargs))
+            index = TestIndex.DiscoveryIndex(self.top, [])
+            self.find(index, **kwargs)
+            index.save()
+            self.assertEqual(expected, self.find(TestIndex.DiscoveryIndex(self.top, []), **kwargs))
+
+    def testPrefetchedWalk(self):
+        for kwargs in [{}, {"parallel_mode": True}, {"test_mode": "ALL"}]:
+            expected = self.find(None, **kwargs)
+            index = TestIndex.DiscoveryIndex(self.top, [])
+            index.prefetch([self.top], max_workers=4)
+            self.assertIn(os.path.join(self.top, "test_serial", "test_one"), index._fresh)
+            self.assertNotIn(os.path.join(self.top, "test_skipped"), index._fresh)
+            self.assertEqual(expected, self.find(index, **kwargs))
+
+    def testChangedConfigIsRescanned(self):
+        index = TestIndex.DiscoveryIndex(self.top, [])
+        self.assertIn(os.path.join(self.top, "test_blue"), self.find(index))
+        index.save()
+
+        config_path = os.path.join(self.top, "test_blue", "DTESTDEFS.cfg")
+        writeFile(config_path, "TAGS = skip\n")
+        stat_result = os.stat(config_path)
+        os.utime(config_path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10**9))
+
+        self.assertNotIn(os.path.join(self.top, "test_blue"), self.find(TestIndex.DiscoveryIndex(self.top, [])))
+
+    def testNewDirectoryIsFound(self):
+        index = TestIndex.DiscoveryIndex(self.top, [])
+        self.find(index)
+        index.save()
+
+        writeFile(os.path.join(self.top, "test_new", "output.orig"))
+        top_stat = os.stat(self.top)
+        os.utime(self.top, ns=(top_stat.st_atime_ns, top_stat.st_mtime_ns + 10**9))
+
+        self.assertIn(os.path.join(self.top, "test_new"), self.find(TestIndex.DiscoveryIndex(self.top, [])))
+
+    def testIndexIsReadableByOthers(self):
+        index = TestIndex.DiscoveryIndex(self.top, [])
+        self.find(index)
+        old_umask = os.umask(0o022)
+        try:
+            index.save()
+        finally:
+            os.umask(old_umask)
+
+        # Like the other files dtest writes, rather than the 0600 of mkstemp.
+        mode = os.stat(os.path.join(self.top, TestIndex.INDEX_FILENAME)).st_mode & 0o777
+        self.assertEqual(mode, 0o644)
+
+
+if __name__ == "__main__":
+    unittest.main()
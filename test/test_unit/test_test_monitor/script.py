@@ -0,0 +1,84 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import subprocess
+import time
+import unittest
+from Dtest import TestMonitor
+
+
+class MonitorTests(unittest.TestCase):
+    def testSamples(self):
+        samples = TestMonitor.TestSamples()
+        samples.add([], 1.0)
+        self.assertEqual(samples.samples, 0)
+
+        samples.add([(1, 100, 10, 1), (2, 0, 20, 3)], 1.0)
+        self.assertEqual(samples.max_cpu, 0.0)
+
+        # A new process used all of its CPU time since the previous sample.
+        ticks = TestMonitor.CLOCK_TICKS
+        samples.add([(1, 100 + ticks, 5, 1), (3, ticks, 5, 1)], 2.0)
+        self.assertEqual(samples.max_cpu, 2.0)
+
+        self.assertEqual(
+            samples.peaks(),
+            {
+                "max_rss_kb": 30 * TestMonitor.PAGE_SIZE_KB,
+                "max_cpu": 2.0,
+                "max_threads": 4,
+                "max_processes": 2,
+                "samples": 2,
+            },
+        )
+
+    def testReadProcesses(self):
+        process = subprocess.Popen(["/bin/bash", "-c", "sleep 10 & sleep 10 & wait"], start_new_session=True)
+        try:
+            time.sleep(0.2)
+            processes = TestMonitor.readProcesses({process.pid})
+            self.assertEqual(list(processes), [process.pid])
+            self.assertEqual(len(processes[process.pid]), 3)
+            self.assertIn(process.pid, [pid for pid, _, _, _ in processes[process.pid]])
+            self.assertTrue(all(rss > 0 and threads == 1 for _, _, rss, threads in processes[process.pid]))
+        finally:
+            os.killpg(process.pid, 9)
+            process.wait()
+
+    def testResourceMonitor(self):
+        class Plugin(TestMonitor.MonitorPlugin):
+            def end(self, full_dir):
+                return {"dir": full_dir}
+
+        monitor = TestMonitor.ResourceMonitor(0.05, [Plugin()])
+        with monitor.test("/test1") as samples:
+            # Process groups of other tests are not sampled.
+            monitor.watch("/test2", os.getpgrp())
+            monitor.sample()
+            self.assertEqual(samples.samples, 0)
+
+            process = subprocess.Popen(
+                ["/bin/bash", "-c", "sleep 10 & while true; do :; done"], start_new_session=True
+            )
+            try:
+                monitor.watch("/test1", process.pid)
+                time.sleep(0.5)
+            finally:
+                os.killpg(process.pid, 9)
+                process.wait()
+
+        peaks = samples.peaks()
+        self.assertGreater(peaks["samples"], 2)
+        self.assertEqual(peaks["max_processes"], 2)
+        self.assertGreater(peaks["max_rss_kb"], 0)
+        self.assertGreater(peaks["max_cpu"], 0.2)
+        self.assertEqual(peaks["dir"], "/test1")
+
+        # The samples of a test are complete once it is done.
+        time.sleep(0.1)
+        self.assertEqual(samples.peaks(), peaks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import types
+import unittest
+from Dtest import Test
+from Dtest import TestPlan
+
+
+def writeFile(path, text=""):
+    """Write text to path, creating the parent directories."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(text)
+
+
+class PlanTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.__temporary_file_path = tempfile.mkdtemp()
+        self.top = os.path.join(self.__temporary_file_path, "test")
+
+        Test.log = lambda *_: None
+        Test.logTee = lambda *_: None
+
+        writeFile(os.path.join(self.top, "DTESTDEFS.cfg"), "CHILD_TAGS = red\nTIMEOUT = 10\n[RUN]\ntest = ls\n")
+        writeFile(os.path.join(self.top, "test_a", "output.orig"))
+        writeFile(os.path.join(self.top, "test_serial", "DTESTDEFS.cfg"), "TAGS = SERIAL\n")
+        writeFile(os.path.join(self.top, "test_serial", "test_one", "DTESTDEFS.cfg"), "TAGS = blue\n")
+        writeFile(os.path.join(self.top, "test_serial", "test_two", "output.orig"))
+
+        self.args = types.SimpleNamespace(directory=self.top, top_test_dir=self.top, truth_suffix=[])
+        self.filename = os.path.join(self.__temporary_file_path, "plan.json")
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        shutil.rmtree(path=self.__temporary_file_path, ignore_errors=True)
+
+    def testRoundTrip(self):
+        test_list = [
+            [os.path.join(self.top, "test_serial", "test_one"), os.path.join(self.top, "test_serial", "test_two")],
+            os.path.join(self.top, "test_a"),
+        ]
+        TestPlan.writePlan(TestPlan.buildPlan(self.args, test_list), self.filename)
+
+        plan = TestPlan.loadPlan(self.filename)
+        self.assertEqual(TestPlan.planTests(plan), test_list)
+        self.assertEqual(plan["tests"][0]["serial"][0]["tags"], ["blue", "red"])
+        self.assertEqual(plan["tests"][1]["truth_files"], {"output": ["orig"]})
+
+        configs = TestPlan.planConfigs(plan)
+        for full_dir in [test_list[1]] + test_list[0]:
+            expected = Test.getLocalConfig(Test.getDefaultConfig(full_dir, []), full_dir, [])
+            self.assertEqual(configs[full_dir], expected)
+
+    def testPlanIsReadableByOthers(self):
+        old_umask = os.umask(0o022)
+        try:
+            TestPlan.writePlan(TestPlan.buildPlan(self.args, []), self.filename)
+        finally:
+            os.umask(old_umask)
+
+        self.assertEqual(os.stat(self.filename).st_mode & 0o777, 0o644)
+
+    def testFailedWriteKeepsThePlan(self):
+        TestPlan.writePlan({"version": 1}, self.filename)
+        with self.assertRaises(TypeError):
+            TestPlan.writePlan({"version": object()}, self.filename)
+
+        # The old plan is intact, and the temporary file is removed.
+        with open(self.filename, "r") as f:
+            self.assertEqual(f.read(), '{\n "version": 1\n}')
+        self.assertEqual([name for name in os.listdir(self.__temporary_file_path) if name.startswith("plan.json.")], [])
+
+    def testArgsFromPlan(self):
+        import sys
+        from unittest import mock
+
+        TestPlan.writePlan(TestPlan.buildPlan(self.args, [os.path.join(self.top, "test_a")]), self.filename)
+
+        # The directories come from the plan rather than from the current directory.
+        with mock.patch.object(sys, "argv", ["dtest", "--from-plan", self.filename]):
+            args = Test.processDtestOptions()
+        self.assertEqual((args.directory, args.top_test_dir), (self.top, self.top))
+        self.assertEqual(args.data, os.path.join(self.top, "regtest.data"))
+
+        with mock.patch.object(sys, "argv", ["dtest", "--from-plan", self.filename, "-d", self.top]):
+            self.assertEqual(Test.processDtestOptions().directory, self.top)
+
+        with mock.patch.object(sys, "argv", ["dtest", "--from-plan", self.filename, "-d", self.__temporary_file_path]):
+            with self.assertRaises(ValueError):
+                Test.processDtestOptions()
+
+    def testBadPlan(self):
+        writeFile(self.filename, '{"version": 0, "tests": []}')
+        with self.assertRaises(Test.TestException):
+            TestPlan.loadPlan(self.filename)
+        with self.assertRaises(Test.TestException):
+            TestPlan.loadPlan(os.path.join(self.__temporary_file_path, "missing.json"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import threading
+import time
+import unittest
+from Dtest import TestRunGraph
+
+
+class RunGraphTests(unittest.TestCase):
+    def testParallelRun(self):
+        self.assertTrue(TestRunGraph.parallelRun({"PARALLEL_RUN": "True"}))
+        self.assertTrue(TestRunGraph.parallelRun({"PARALLEL_RUN": "yes"}))
+        self.assertFalse(TestRunGraph.parallelRun({"PARALLEL_RUN": "False"}))
+        self.assertFalse(TestRunGraph.parallelRun({}))
+
+    def testCommandSlots(self):
+        self.assertEqual(TestRunGraph.commandSlots({}), 1)
+        self.assertEqual(TestRunGraph.commandSlots({"RESOURCES": {"CPUS": "4"}}), 4)
+        self.assertEqual(TestRunGraph.commandSlots({"RESOURCES": {"CPUS": "0.5"}}), 1)
+        self.assertEqual(TestRunGraph.commandSlots({"RESOURCES": {"CPUS": "many"}}), 1)
+
+    def testRunDependencies(self):
+        run = {"prep": "ls", "a": "ls", "b": "ls", "report": "ls"}
+        config = {"RUN": run, "RUN_AFTER": {"a": "prep", "b": "prep", "report": ["a", "b"]}}
+        self.assertEqual(
+            TestRunGraph.runDependencies(config), {"a": ["prep"], "b": ["prep"], "report": ["a", "b"]}
+        )
+        self.assertEqual(TestRunGraph.runDependencies({"RUN": run}), {})
+
+        with self.assertRaises(ValueError):
+            TestRunGraph.runDependencies({"RUN": run, "RUN_AFTER": {"missing": "prep"}})
+        with self.assertRaises(ValueError):
+            TestRunGraph.runDependencies({"RUN": run, "RUN_AFTER": {"a": "missing"}})
+        with self.assertRaises(ValueError):
+            TestRunGraph.runDependencies({"RUN": run, "RUN_AFTER": {"a": "b", "b": "a"}})
+
+    def testDependents(self):
+        after = {"a": ["prep"], "b": ["prep"], "report": ["a"]}
+        self.assertEqual(
+            TestRunGraph.dependents(after),
+            {"prep": {"a", "b", "report"}, "a": {"report"}, "b": set(), "report": set()},
+        )
+
+    def testMatchesOutputs(self):
+        self.assertTrue(TestRunGraph.matchesOutputs("scenario1.out", ["scenario1.*"]))
+        self.assertFalse(TestRunGraph.matchesOutputs("scenario2.out", ["scenario1.*", "other"]))
+
+    def testRunGraph(self):
+        lock = threading.Lock()
+        events = []
+        running = [0]
+        peak = [0]
+
+        def run(key):
+            with lock:
+                events.append(("start", key))
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                events.append(("end", key))
+                running[0] -= 1
+
+        after = {"a": ["prep"], "b": ["prep"], "c": ["prep"], "report": ["a", "b", "c"]}
+        TestRunGraph.runGraph(["prep", "a", "b", "c", "report"], after, 2, run)
+
+        # Each command starts after the commands it runs after have ended, and at most 2 run at once.
+        for key, dependencies in after.items():
+            for dependency in dependencies:
+                self.assertLess(events.index(("end", dependency)), events.index(("start", key)))
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(len(events), 10)
+
+    def testRunGraphRaises(self):
+        ran = []
+
+        def run(key):
+            ran.append(key)
+            if key == "prep":
+                raise RuntimeError("failed")
+
+        with self.assertRaises(RuntimeError):
+            TestRunGraph.runGraph(["prep", "a"], {"a": ["prep"]}, 2, run)
+        self.assertEqual(ran, ["prep"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import unittest
+from Dtest import TestSandbox
+
+
+def writeFile(path, text=""):
+    """Write text to path, creating the parent directories."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(text)
+
+
+class SandboxTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.yam_root = tempfile.mkdtemp()
+        self.src = os.path.join(self.yam_root, "src")
+
+        writeFile(os.path.join(self.src, "ModA", "Makefile"), "# comment\nDTEST_TESTDIR := test\n")
+        writeFile(os.path.join(self.src, "ModB", "Makefile.yam"), "DTEST_TESTDIR := test --jobs 1 # comment\n")
+        writeFile(os.path.join(self.src, "ModC", "Makefile"), "DTEST_TESTDIR :=\nall:\n\tDTEST_TESTDIR=test echo\n")
+        writeFile(os.path.join(self.src, "ModD", "README"))
+        self.sitedefs = os.path.join(self.yam_root, TestSandbox.SITEDEFS_DIR)
+        writeFile(os.path.join(self.sitedefs, "makefile-yam-tail.mk"), "regtest-dir:\n\techo\n")
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        shutil.rmtree(path=self.yam_root, ignore_errors=True)
+
+    def testFindTestDirs(self):
+        expected = [
+            os.path.join(self.src, "ModA", "test"),
+            os.path.join(self.src, "ModB", "test") + " --jobs 1",
+        ]
+        self.assertEqual(TestSandbox.findTestDirs(self.yam_root), expected)
+        self.assertTrue(os.path.isfile(os.path.join(self.yam_root, TestSandbox.CACHE_FILENAME)))
+
+        # Cached
+        self.assertEqual(TestSandbox.findTestDirs(self.yam_root), expected)
+
+    def testCacheIsReadableByOthers(self):
+        old_umask = os.umask(0o022)
+        try:
+            TestSandbox.findTestDirs(self.yam_root)
+        finally:
+            os.umask(old_umask)
+
+        mode = os.stat(os.path.join(self.yam_root, TestSandbox.CACHE_FILENAME)).st_mode & 0o777
+        self.assertEqual(mode, 0o644)
+
+    def testChangedMakefileIsReread(self):
+        TestSandbox.findTestDirs(self.yam_root)
+
+        makefile = os.path.join(self.src, "ModA", "Makefile")
+        writeFile(makefile, "DTEST_TESTDIR := regtests\n")
+        stat_result = os.stat(makefile)
+        os.utime(makefile, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10**9))
+
+        self.assertIn(os.path.join(self.src, "ModA", "regtests"), TestSandbox.findTestDirs(self.yam_root))
+
+    def testUnresolvedSettings(self):
+        for text in ["DTEST_TESTDIR := $(TESTDIR)\n", "ifdef FOO\nDTEST_TESTDIR := test\nendif\n"]:
+            writeFile(os.path.join(self.src, "ModE", "Makefile"), text)
+            self.assertIsNone(TestSandbox.findTestDirs(self.yam_root))
+
+        self.assertIsNone(TestSandbox.findTestDirs(os.path.join(self.yam_root, "missing")))
+
+    def testModuleWithoutSetting(self):
+        # The setting may come from the SiteDefs makefiles the module includes.
+        writeFile(os.path.join(self.src, "ModE", "Makefile"), "include $(YAM_ROOT)/etc/SiteDefs/makefile-yam-tail.mk\n")
+        self.assertIsNone(TestSandbox.findTestDirs(self.yam_root))
+
+    def testSiteDefsSetting(self):
+        self.assertIsNotNone(TestSandbox.findTestDirs(self.yam_root))
+
+        # A change of the SiteDefs makefiles is seen, although the module makefiles did not change.
+        tail = os.path.join(self.sitedefs, "makefile-yam-tail.mk")
+        writeFile(tail, "DTEST_TESTDIR ?= test\n")
+        stat_result = os.stat(tail)
+        os.utime(tail, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10**9))
+        self.assertIsNone(TestSandbox.findTestDirs(self.yam_root))
+
+    def testReadTestDir(self):
+        makefile = os.path.join(self.yam_root, "Makefile")
+        writeFile(makefile, "DTEST_TESTDIR = test \\\n  --quiet\nDTEST_TESTDIR += --jobs 2\nDTEST_TESTDIR ?= other\n")
+        self.assertEqual(TestSandbox.readTestDir(makefile), "test --quiet --jobs 2")
+
+        writeFile(makefile, "DTEST_TESTDIR :=\n")
+        self.assertEqual(TestSandbox.readTestDir(makefile), "")
+        writeFile(makefile, "all:\n\ttrue\n")
+        self.assertIsNone(TestSandbox.readTestDir(makefile))
+
+
+if __name__ == "__main__":
+    unittest.main()
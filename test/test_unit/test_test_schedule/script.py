@@ -0,0 +1,65 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import unittest
+from Dtest import TestSchedule
+
+
+class ScheduleTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.__temporary_file_path = tempfile.mkdtemp()
+        self.top = os.path.join(self.__temporary_file_path, "test")
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        shutil.rmtree(path=self.__temporary_file_path, ignore_errors=True)
+
+    def testLoadRegtestData(self):
+        filename = os.path.join(self.__temporary_file_path, "regtest.data")
+        with open(filename, "w") as f:
+            f.write(
+                "import datetime\n"
+                "try:\n"
+                "    regdata\n"
+                "except:\n"
+                "    regdata = {}\n"
+                "regdata.update({'Mod': {'root_dir': %r, 'start_time': datetime.datetime(2020, 1, 1), "
+                "'tests': {'test_a': {'elapsed_time': 2.5}, 'test_b/test_c': {'elapsed_time': 40}, "
+                "'test_d': {'elapsed_time': 1.0, 'cancelled': True}}}})\n" % self.top
+            )
+
+        # Cancelled tests did not run to the end, so their times are not used.
+        self.assertEqual(
+            TestSchedule.loadDurations(filename, self.top),
+            {os.path.join(self.top, "test_a"): 2.5, os.path.join(self.top, "test_b", "test_c"): 40.0},
+        )
+        self.assertEqual(TestSchedule.loadDurations(os.path.join(self.__temporary_file_path, "missing"), self.top), {})
+
+    def testOrderTests(self):
+        durations = {"a": 1.0, "b": 30.0, "s1": 10.0, "s2": 25.0}
+        test_list = [["s1", "s2"], ["u1", "u2"], "a", "u3", "b", "u4"]
+
+        # Known tests longest first, SERIAL groups by their total, then the rest in the original order.
+        self.assertEqual(TestSchedule.orderTests(test_list, durations), [["s1", "s2"], "b", "a", ["u1", "u2"], "u3", "u4"])
+        self.assertEqual(TestSchedule.orderTests(test_list, {}), test_list)
+
+    def testPredictMakespan(self):
+        durations = {"a": 40.0, "b": 10.0, "c": 10.0, "d": 10.0, "e": 10.0}
+
+        self.assertEqual(TestSchedule.predictMakespan(["a", "b", "c", "d", "e"], durations, 2), 40.0)
+        self.assertEqual(TestSchedule.predictMakespan(["b", "c", "d", "e", "a"], durations, 2), 60.0)
+        self.assertEqual(TestSchedule.predictMakespan([["b", "c"], "a"], durations, 1), 60.0)
+
+        # Unknown tests take the median known duration.
+        self.assertEqual(TestSchedule.predictMakespan(["a", "b", "x"], durations, 1), 75.0)
+        self.assertIsNone(TestSchedule.predictMakespan(["x"], durations, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+from Dtest import TestTiming
+
+
+class TimingTests(unittest.TestCase):
+    def testPhaseTimes(self):
+        self.assertEqual(
+            TestTiming.phaseTimes(
+                {"cleanup": 0.5, "run": {"test1": 2.0, "test2": 1.0}, "config": 0.1, "compare": {"out.txt": 0.2}}
+            ),
+            [
+                ("config", "config", 0.1),
+                ("run", "run test1", 2.0),
+                ("run", "run test2", 1.0),
+                ("compare", "compare out.txt", 0.2),
+                ("cleanup", "cleanup", 0.5),
+            ],
+        )
+        self.assertEqual(TestTiming.phaseTimes({}), [])
+
+    def testTimingReport(self):
+        report = TestTiming.TimingReport(3)
+        report.add("a", {"config": 1.0, "run": {"x": 6.0, "y": 0.5}})
+        report.add("b", {"queue": 2.0, "run": {"x": 0.5}, "compare": {"out": 3.0}})
+        report.add("c", {})
+
+        self.assertEqual(report.totals, {"config": 1.0, "run": 7.0, "queue": 2.0, "compare": 3.0})
+        self.assertEqual(
+            report.lines(),
+            [
+                "Time by phase:",
+                "    config           1.00 s   7.7%",
+                "    queue            2.00 s  15.4%",
+                "    run              7.00 s  53.8%",
+                "    compare          3.00 s  23.1%",
+                "Slowest 3 phases:",
+                "          6.00 s  a: run x",
+                "          3.00 s  b: compare out",
+                "          2.00 s  b: queue",
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
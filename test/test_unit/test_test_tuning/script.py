@@ -0,0 +1,130 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import unittest
+from Dtest import TestTuning
+
+
+class TuningTests(unittest.TestCase):
+    def setUp(self):
+        """Automatically called before each test* method."""
+        import tempfile
+
+        self.__temporary_file_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Automatically called after each test* method."""
+        import shutil
+
+        shutil.rmtree(path=self.__temporary_file_path, ignore_errors=True)
+
+    def testMeasurements(self):
+        # The peaks of --monitor are used first.
+        self.assertEqual(
+            TestTuning.testMeasurements(
+                {
+                    "elapsed_time": 9.0,
+                    "peaks": {"max_cpu": 3.5, "max_rss_kb": 2048, "samples": 4},
+                    "rusage": {"user_time": 1.0, "system_time": 1.0, "max_rss_kb": 4096},
+                    "phases": {"run": {"a": 2.0, "b": 6.0}},
+                }
+            ),
+            {"cpus": 3.5, "mem": 2048 * 1024.0, "command_time": 6.0},
+        )
+
+        # Otherwise, the resource usage of the commands, but not for the MEM, as their max_rss_kb includes the worker.
+        self.assertEqual(
+            TestTuning.testMeasurements(
+                {
+                    "elapsed_time": 9.0,
+                    "peaks": {"max_cpu": 0.0, "max_rss_kb": 0, "samples": 0},
+                    "rusage": {"user_time": 3.0, "system_time": 1.0, "max_rss_kb": 1024},
+                    "phases": {"run": {"a": 2.0}},
+                }
+            ),
+            {"cpus": 2.0, "command_time": 2.0},
+        )
+
+        # Tests that timed out only tell that the TIMEOUT was too small.
+        self.assertEqual(TestTuning.testMeasurements({"elapsed_time": 9.0, "timed_out": 1}), {})
+        self.assertEqual(TestTuning.testMeasurements({"elapsed_time": 9.0}), {"command_time": 9.0})
+
+    def testLoadMeasurements(self):
+        filenames = []
+        for k, (cpus, elapsed_time) in enumerate([(2.5, 10.0), (1.5, 30.0)]):
+            filename = os.path.join(self.__temporary_file_path, "regtest%d.data" % k)
+            with open(filename, "w") as f:
+                f.write("import datetime\n")
+                f.write("regdata = {}\n")
+                f.write(
+                    "regdata[''] = %r\n"
+                    % {
+                        "root_dir": "/mod",
+                        "tests": {
+                            "test_a": {
+                                "elapsed_time": elapsed_time,
+                                "peaks": {"max_cpu": cpus, "max_rss_kb": 1, "samples": 1},
+                            },
+                            "test_b": {"elapsed_time": 99.0, "cancelled": True},
+                        },
+                    }
+                )
+            filenames.append(filename)
+
+        self.assertEqual(
+            TestTuning.loadMeasurements(filenames),
+            {"/mod/test_a": {"cpus": 2.5, "mem": 1024.0, "command_time": 30.0}},
+        )
+
+    def testTunedSettings(self):
+        gb = 1024.0**3
+        self.assertEqual(
+            TestTuning.tunedSettings({"cpus": 2.1, "mem": 4 * gb, "command_time": 100.2}, 0.25, 0.5 * gb, 3.0, 60),
+            {"CPUS": "2", "MEM": "5GB", "TIMEOUT": "301"},
+        )
+        self.assertEqual(
+            TestTuning.tunedSettings(
+                {"cpus": 1.0, "mem": 100 * 1024.0**2, "command_time": 1.0}, 0.25, 0.5 * gb, 3.0, 60
+            ),
+            {"CPUS": None, "MEM": None, "TIMEOUT": "60"},
+        )
+        self.assertEqual(TestTuning.tunedSettings({"cpus": 2.5}, 0.25, 0, 3.0, 60), {"CPUS": "3"})
+
+        self.assertEqual(TestTuning.formatAmount(1.01 * gb), "1.1GB")
+        self.assertEqual(TestTuning.formatAmount(300 * 1024.0**2), "300MB")
+        self.assertEqual(TestTuning.formatAmount(10), "0.1kB")
+
+    def testUpdateConfigLines(self):
+        lines = ["# A test\n", "TIMEOUT = 30  # seconds\n", "\n", "[RUN]\n", "a = run\n"]
+        self.assertEqual(
+            TestTuning.updateConfigLines(lines, {"TIMEOUT": "90", "CPUS": "2", "MEM": None}),
+            [
+                "# A test\n",
+                "TIMEOUT = 90  # seconds\n",
+                "\n",
+                "[RESOURCES]\n",
+                "    CPUS = 2\n",
+                "\n",
+                "[RUN]\n",
+                "a = run\n",
+            ],
+        )
+
+        # Entries of the other sections and settings that are already there are kept.
+        lines = ["[RESOURCES]\n", "  LICENSES = 1\n", "  CPUS=2\n", "  MEM = 1GB\n", "[ENV]\n", "TIMEOUT = 5"]
+        self.assertIs(TestTuning.updateConfigLines(lines, {"CPUS": "2"}), lines)
+        self.assertEqual(
+            TestTuning.updateConfigLines(lines, {"CPUS": None, "MEM": "2GB", "TIMEOUT": "60"}),
+            ["TIMEOUT = 60\n", "[RESOURCES]\n", "  LICENSES = 1\n", "  MEM = 2GB\n", "[ENV]\n", "TIMEOUT = 5\n"],
+        )
+
+        self.assertEqual(
+            TestTuning.updateConfigLines([], {"MEM": "1GB", "TIMEOUT": "60"}),
+            ["TIMEOUT = 60\n", "\n", "[RESOURCES]\n", "    MEM = 1GB\n"],
+        )
+        self.assertEqual(TestTuning.updateConfigLines(["[RUN]\n"], {"CPUS": None}), ["[RUN]\n"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import resource
+import unittest
+from Dtest import TestUsage
+
+
+class UsageTests(unittest.TestCase):
+    def testResourceUsage(self):
+        usage = TestUsage.resourceUsage(resource.getrusage(resource.RUSAGE_SELF))
+        self.assertEqual(set(usage), set(TestUsage.FIELDS))
+        self.assertGreater(usage["max_rss_kb"], 0)
+
+    def testThreadUsageSince(self):
+        before = TestUsage.threadUsage()
+        if before is None:
+            self.skipTest("RUSAGE_THREAD is not supported")
+        sum(i * i for i in range(10**6))
+        usage = TestUsage.threadUsageSince(before)
+
+        # The peak RSS of a thread is that of the whole process, so it is left out.
+        self.assertEqual(set(usage), set(TestUsage.FIELDS) - TestUsage.PEAKS)
+        self.assertGreater(usage["user_time"] + usage["system_time"], 0)
+        self.assertIsNone(TestUsage.threadUsageSince(None))
+
+    def testTotalUsage(self):
+        self.assertIsNone(TestUsage.totalUsage([]))
+        self.assertIsNone(TestUsage.totalUsage([None, {}]))
+        self.assertEqual(
+            TestUsage.totalUsage(
+                [
+                    {"user_time": 0.1, "system_time": 0.2, "max_rss_kb": 1000, "block_input": 8},
+                    None,
+                    {"user_time": 0.2, "system_time": 0.1, "max_rss_kb": 3000, "block_input": 0},
+                    {"user_time": 0.3, "block_output": 16},
+                ]
+            ),
+            {"user_time": 0.6, "system_time": 0.3, "max_rss_kb": 3000, "block_input": 8, "block_output": 16},
+        )
+
+    def testUsageLine(self):
+        self.assertEqual(TestUsage.usageLine(None), "unknown")
+        self.assertEqual(
+            TestUsage.usageLine(
+                {
+                    "user_time": 1.234,
+                    "system_time": 0.5,
+                    "max_rss_kb": 2048,
+                    "block_input": 1,
+                    "block_output": 2,
+                    "voluntary_context_switches": 3,
+                    "involuntary_context_switches": 4,
+                }
+            ),
+            "user 1.23s, sys 0.50s, max RSS 2048 kB, blocks in/out 1/2, context switches 3/4",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()